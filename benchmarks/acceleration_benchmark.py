@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Compares the accelerations (none, channels-last, compile) : the
+# warm-up time before the worker accepts jobs, and the batches speed.
+#
+# Each acceleration is benchmarked by "sdworker.py benchmark", in its own
+# process, like benchmarks/memory_policies_benchmark.py. compile runs
+# twice, with the same compile cache directory : once with an empty
+# cache, and once with the kernels compiled by the first run, like after
+# a restart of the bot.
+#
+# Usage :
+#   python benchmarks/acceleration_benchmark.py [--real] [--width 64] [--height 64]
+# By default, the tiny random model runs on CPU. --real uses the model
+# and the device configured in the .env file.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPOSITORY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+from myylibs.acceleration import ACCELERATIONS
+
+def benchmark_acceleration(acceleration:str, arguments, output_filepath:str, compile_cache_dir:str) -> dict:
+    command = [
+        sys.executable, "sdworker.py", "benchmark",
+        "--acceleration", acceleration,
+        "--only", "generate_batch",
+        "--images", str(arguments.images),
+        "--batch-size", str(arguments.batch_size),
+        "--width", str(arguments.width),
+        "--height", str(arguments.height),
+        "--output", output_filepath]
+    if arguments.real:
+        command.append("--real")
+    environment = dict(os.environ, COMPILE_CACHE_DIR = compile_cache_dir)
+    # The output is only shown on failure
+    completed = subprocess.run(command, cwd = REPOSITORY_DIRECTORY, env = environment, capture_output = True, text = True)
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:])
+        print(completed.stderr[-2000:])
+        raise RuntimeError(f"The {acceleration} benchmark failed")
+    with open(output_filepath, "r", encoding="utf-8") as results_file:
+        return json.load(results_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Warm-up time and speed of each acceleration")
+    parser.add_argument("--real", action = "store_true", help = "Use the configured model and device, instead of a tiny random model on CPU")
+    parser.add_argument("--images", type = int, default = 8)
+    parser.add_argument("--batch-size", type = int, default = 2)
+    parser.add_argument("--width", type = int, default = 64, help = "Ignored with --real. Set IMAGES_WIDTH instead.")
+    parser.add_argument("--height", type = int, default = 64, help = "Ignored with --real. Set IMAGES_HEIGHT instead.")
+    arguments = parser.parse_args()
+
+    runs = [(acceleration, acceleration) for acceleration in ACCELERATIONS]
+    runs.append(("compile, cached", "compile"))
+    print(f"{'Acceleration':<16} {'Warm-up':>9} {'Batch p50':>10} {'Images/s':>9} {'Speedup':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        compile_cache_dir = os.path.join(directory, "compiled")
+        eager_p50 = None
+        for index, (label, acceleration) in enumerate(runs):
+            results = benchmark_acceleration(acceleration, arguments, os.path.join(directory, f"{index}.json"), compile_cache_dir)
+            batch = results["benchmarks"]["generate_batch"]
+            if acceleration == "none":
+                eager_p50 = batch["p50"]
+            speedup = f"{eager_p50 / batch['p50']:.2f}x" if eager_p50 else "-"
+            print(
+                f"{label:<16} {results['metadata']['warmup_seconds']:>8.1f}s {batch['p50'] * 1e3:>8.0f}ms "
+                f"{batch['items_per_second']:>9.2f} {speedup:>8}",
+                flush = True)
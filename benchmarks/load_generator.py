@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Submits jobs to the local submission API of the bot, following an
+# arrival pattern, then measures how fast and in which order their
+# messages were delivered.
+#
+# Start the bot without Discord, with stub workers (no GPU, no model) :
+#   WORKERS_MODE=stub python degu_diffusion_v0.py serve-api
+# or with the tiny random model, to include the special tags :
+#   STABLEDIFFUSION_MODEL_NAME=tiny-random TORCH_DEVICES=cpu STABLEDIFFUSION_LOCAL_ONLY=true python degu_diffusion_v0.py serve-api
+#
+# Then run :
+#   python benchmarks/load_generator.py --pattern poisson --rate 2 --duration 30
+#
+# Arrival patterns :
+# * constant : One job every 1/rate seconds
+# * poisson  : Random arrivals, rate jobs per second on average
+# * burst    : burst_size jobs at once, every burst_size/rate seconds
+# * ramp     : From 0 to 2*rate jobs per second, over the duration
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import aiohttp # (installed with discord.py)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from myylibs.jobsmanager import percentile
+
+PATTERNS = ("constant", "poisson", "burst", "ramp")
+
+PLAIN_PROMPTS = (
+    "A degu sleeping on a pile of hay",
+    "Portrait of a degu wearing a tiny hat",
+    "Two degus sharing a carrot, watercolor",
+)
+TAG_HEAVY_PROMPT = "Degu by {random_artists}, {random_artists}, {random_tags}, {random_tags}, {random_tags}, {random_tags}"
+
+# The messages sent before and after the images of a job
+STARTED_MESSAGE = "Your job has started !"
+FINISHED_MESSAGES = ("Job finished !", "Job canceled", "Ow... The whole thing broke")
+
+def arrival_times(pattern:str, rate:float, duration:float, burst_size:int, rng:random.Random) -> list[float]:
+    """Submission times of the jobs, in seconds from the start"""
+    times = []
+    if pattern == "constant":
+        times = [index / rate for index in range(int(duration * rate))]
+    elif pattern == "poisson":
+        at = rng.expovariate(rate)
+        while at < duration:
+            times.append(at)
+            at += rng.expovariate(rate)
+    elif pattern == "burst":
+        period = burst_size / rate
+        for burst in range(max(1, int(duration / period))):
+            times.extend([burst * period] * burst_size)
+    elif pattern == "ramp":
+        # The rate grows linearly, so the n-th job arrives when
+        # rate * t^2 / duration = n
+        for index in range(int(rate * duration)):
+            times.append(math.sqrt(index * duration / rate))
+    return times
+
+def parse_sizes(sizes_description:str) -> list[tuple[int, float]]:
+    """Parse "n_images:weight,n_images:weight" descriptions"""
+    sizes = []
+    for size in sizes_description.split(","):
+        n_images, _, weight = size.partition(":")
+        sizes.append((int(n_images), float(weight or 1)))
+    return sizes
+
+def job_parameters(arguments, rng:random.Random) -> dict:
+    n_images = rng.choices(
+        [n_images for n_images, _ in arguments.sizes],
+        weights = [weight for _, weight in arguments.sizes])[0]
+    tag_heavy = rng.random() < arguments.tag_heavy
+    parameters = {
+        "prompt": TAG_HEAVY_PROMPT if tag_heavy else rng.choice(PLAIN_PROMPTS),
+        "n_images": n_images,
+        "n_inferences": arguments.inferences,
+        "guidance_scale": 7.5,
+        "user_id": rng.randrange(arguments.users),
+    }
+    # Fixed seeds come from a small pool, so that some jobs repeat
+    # previous ones, and hit the results cache
+    if rng.random() < arguments.fixed_seeds:
+        parameters["seed"] = rng.randrange(1, 8)
+    return parameters
+
+def is_image(delivery:dict) -> bool:
+    return bool(delivery["filenames"])
+
+def check_ordering(job:dict) -> list[str]:
+    """Problems in the deliveries order of a finished job"""
+    deliveries = job["deliveries"]
+    problems = []
+    if not deliveries or deliveries[0]["content"] != STARTED_MESSAGE:
+        problems.append("not started first")
+    if not deliveries or not (deliveries[-1]["content"] or "").startswith(FINISHED_MESSAGES):
+        problems.append("not finished last")
+    filenames = [filename for delivery in deliveries for filename in delivery["filenames"]]
+    # Images of a fixed seed job are all the same
+    if "seed" not in job["parameters"] and len(set(filenames)) != len(filenames):
+        problems.append("duplicated images")
+    if job["finished"] and len(filenames) != job["n_images"]:
+        problems.append(f"{len(filenames)} images out of {job['n_images']}")
+    return problems
+
+async def submit(session:aiohttp.ClientSession, url:str, delay:float, parameters:dict) -> dict:
+    await asyncio.sleep(delay)
+    submitted_at = time.time()
+    async with session.post(f"{url}/jobs", json = parameters) as response:
+        description = await response.json()
+        accepted_at = time.time()
+        if response.status != 201:
+            return {"refused": description.get("error", response.status), "parameters": parameters}
+    return {
+        "job_id": description["job_id"],
+        "parameters": parameters,
+        "n_images": description["n_images"],
+        "estimated_finish": description["estimated_finish"],
+        "submitted_at": submitted_at,
+        "submit_latency": accepted_at - submitted_at,
+    }
+
+async def wait_for_job(session:aiohttp.ClientSession, url:str, job:dict, poll_interval:float, timeout:float) -> dict:
+    deadline = time.time() + timeout
+    while True:
+        async with session.get(f"{url}/jobs/{job['job_id']}") as response:
+            state = await response.json()
+        if state["done"] or time.time() > deadline:
+            break
+        await asyncio.sleep(poll_interval)
+
+    job["deliveries"] = state["deliveries"]
+    job["finished"] = state["done"] and any(
+        (delivery["content"] or "").startswith(FINISHED_MESSAGES[0]) for delivery in state["deliveries"])
+    images_at = [delivery["at"] for delivery in state["deliveries"] if is_image(delivery)]
+    job["first_image"] = (images_at[0] - job["submitted_at"]) if images_at else None
+    job["completion"] = (state["deliveries"][-1]["at"] - job["submitted_at"]) if state["deliveries"] else None
+    job["problems"] = check_ordering(job) if state["done"] else ["timed out"]
+    return job
+
+def summary(values:list[float]) -> str:
+    if not values:
+        return "-"
+    return f"p50 {percentile(values, 50):.2f} s, p95 {percentile(values, 95):.2f} s, p99 {percentile(values, 99):.2f} s, max {max(values):.2f} s"
+
+def report(jobs:list[dict], refused:list[dict], started_at:float, server_stats:dict) -> dict:
+    delivered_images = [
+        delivery for job in jobs for delivery in job["deliveries"] if is_image(delivery)]
+    n_images = sum(len(delivery["filenames"]) for delivery in delivered_images)
+    last_delivery = max((delivery["at"] for delivery in delivered_images), default=started_at)
+    elapsed = last_delivery - started_at
+    wrongly_ordered = [job for job in jobs if job["problems"]]
+
+    print(f"{len(jobs)} jobs accepted, {len(refused)} refused")
+    print(f"Submission  : {summary([job['submit_latency'] for job in jobs])}")
+    print(f"First image : {summary([job['first_image'] for job in jobs if job['first_image'] != None])}")
+    print(f"Completion  : {summary([job['completion'] for job in jobs if job['completion'] != None])}")
+    for n_images_asked in sorted({job["parameters"]["n_images"] for job in jobs}):
+        sized = [job for job in jobs if job["parameters"]["n_images"] == n_images_asked]
+        print(f"  {n_images_asked:>3} images : {len(sized)} jobs, completion {summary([job['completion'] for job in sized if job['completion'] != None])}")
+    estimate_errors = [
+        job["completion"] - job["estimated_finish"] for job in jobs
+        if job["completion"] != None and job["estimated_finish"]]
+    if estimate_errors:
+        print(f"Completion minus estimate : p50 {percentile(estimate_errors, 50):+.2f} s, p95 {percentile(estimate_errors, 95):+.2f} s")
+    print(f"Throughput  : {n_images} images in {elapsed:.1f} s, {n_images / elapsed if elapsed > 0 else 0:.2f} images/s")
+    print(f"Ordering    : {len(jobs) - len(wrongly_ordered)}/{len(jobs)} jobs delivered in order")
+    for job in wrongly_ordered[:10]:
+        print(f"  Job {job['job_id']} : {', '.join(job['problems'])}")
+    print(f"Uploads     : {server_stats['uploads']['messages_sent']} messages, longest wait {server_stats['uploads']['longest_wait']:.2f} s")
+
+    return {
+        "accepted": len(jobs),
+        "refused": len(refused),
+        "images": n_images,
+        "elapsed": elapsed,
+        "images_per_second": n_images / elapsed if elapsed > 0 else 0,
+        "first_image_p50": percentile([job["first_image"] for job in jobs if job["first_image"] != None], 50),
+        "first_image_p95": percentile([job["first_image"] for job in jobs if job["first_image"] != None], 95),
+        "completion_p50": percentile([job["completion"] for job in jobs if job["completion"] != None], 50),
+        "completion_p95": percentile([job["completion"] for job in jobs if job["completion"] != None], 95),
+        "wrongly_ordered": len(wrongly_ordered),
+        "server": server_stats,
+        "jobs": jobs,
+    }
+
+async def run(arguments) -> dict:
+    rng = random.Random(arguments.seed)
+    times = arrival_times(arguments.pattern, arguments.rate, arguments.duration, arguments.burst_size, rng)
+    print(f"Submitting {len(times)} jobs to {arguments.url}, {arguments.pattern} arrivals over {arguments.duration} s")
+
+    async with aiohttp.ClientSession() as session:
+        started_at = time.time()
+        submissions = await asyncio.gather(*[
+            submit(session, arguments.url, at, job_parameters(arguments, rng)) for at in times])
+        jobs = [job for job in submissions if "refused" not in job]
+        refused = [job for job in submissions if "refused" in job]
+        jobs = await asyncio.gather(*[
+            wait_for_job(session, arguments.url, job, arguments.poll_interval, arguments.timeout) for job in jobs])
+        async with session.get(f"{arguments.url}/stats") as response:
+            server_stats = await response.json()
+    return report(list(jobs), refused, started_at, server_stats)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Load test of the bot, through its local submission API")
+    parser.add_argument("--url", default = "http://127.0.0.1:8642")
+    parser.add_argument("--pattern", choices = PATTERNS, default = "poisson")
+    parser.add_argument("--rate", type = float, default = 1, help = "Jobs per second, on average")
+    parser.add_argument("--duration", type = float, default = 20, help = "Seconds during which jobs are submitted")
+    parser.add_argument("--burst-size", type = int, default = 8, help = "Jobs per burst, with the burst pattern")
+    parser.add_argument("--sizes", type = parse_sizes, default = "1:4,4:2,16:1", help = "Images per job, and their weights")
+    parser.add_argument("--inferences", type = int, default = 20)
+    parser.add_argument("--users", type = int, default = 5)
+    parser.add_argument("--tag-heavy", type = float, default = 0.3, help = "Share of the prompts full of special tags")
+    parser.add_argument("--fixed-seeds", type = float, default = 0.2, help = "Share of the jobs with a fixed seed")
+    parser.add_argument("--seed", type = int, default = 1234, help = "Seed of the workload")
+    parser.add_argument("--poll-interval", type = float, default = 0.5)
+    parser.add_argument("--timeout", type = float, default = 600, help = "Seconds waited for each job")
+    parser.add_argument("--output", help = "Save the results, and every delivery, as JSON")
+    arguments = parser.parse_args()
+
+    results = asyncio.run(run(arguments))
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=1)
+    sys.exit(1 if results["wrongly_ordered"] else 0)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Compares the speed and the peak memory of the memory policies.
+#
+# Each policy is benchmarked by "sdworker.py benchmark", in its own
+# process, so that the peak memory of a policy is not hidden by the
+# previous ones. On CPU, the peak memory is the process peak resident
+# memory, which includes the model itself.
+#
+# Usage :
+#   python benchmarks/memory_policies_benchmark.py [--real] [--width 128] [--height 128] [--batch-size 2]
+# By default, the tiny random model runs on CPU. --real uses the model
+# and the device configured in the .env file, and also compares the
+# offload policies when the device is not the CPU.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPOSITORY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+from myylibs.memorypolicy import MEMORY_POLICIES, usable_policies
+
+def benchmark_policy(policy:str, arguments, output_filepath:str) -> dict:
+    command = [
+        sys.executable, "sdworker.py", "benchmark",
+        "--memory-policy", policy,
+        "--only", "generate_batch",
+        "--images", str(arguments.images),
+        "--batch-size", str(arguments.batch_size),
+        "--width", str(arguments.width),
+        "--height", str(arguments.height),
+        "--output", output_filepath]
+    if arguments.real:
+        command.append("--real")
+    # The output is only shown on failure
+    completed = subprocess.run(command, cwd = REPOSITORY_DIRECTORY, capture_output = True, text = True)
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:])
+        print(completed.stderr[-2000:])
+        raise RuntimeError(f"The {policy} benchmark failed")
+    with open(output_filepath, "r", encoding="utf-8") as results_file:
+        return json.load(results_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Speed and peak memory of each memory policy")
+    parser.add_argument("--real", action = "store_true", help = "Use the configured model and device, instead of a tiny random model on CPU")
+    parser.add_argument("--images", type = int, default = 2)
+    parser.add_argument("--batch-size", type = int, default = 2)
+    parser.add_argument("--width", type = int, default = 128, help = "Ignored with --real. Set IMAGES_WIDTH instead.")
+    parser.add_argument("--height", type = int, default = 128, help = "Ignored with --real. Set IMAGES_HEIGHT instead.")
+    parser.add_argument("--device", default = "cpu", help = "Device of the --real benchmarks, to list the usable policies")
+    arguments = parser.parse_args()
+
+    policies = usable_policies(arguments.device if arguments.real else "cpu")
+    print(f"{'Policy':<20} {'Batch p50':>10} {'Images/s':>9} {'Peak memory':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for policy in policies:
+            results = benchmark_policy(policy, arguments, os.path.join(directory, f"{policy}.json"))
+            batch = results["benchmarks"]["generate_batch"]
+            print(
+                f"{policy:<20} {batch['p50'] * 1e3:>8.0f}ms {batch['items_per_second']:>9.2f} "
+                f"{batch['peak_memory_bytes'] / (1024 * 1024):>9.0f}MiB",
+                flush = True)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Compares reading the metadata of generated PNG files with PIL
+# (Image.open(...).text, the previous _png_metadata implementation)
+# and with the streaming text chunks reader.
+#
+# Usage : python benchmarks/png_metadata_benchmark.py [output_directory]
+
+import io
+import os
+import sys
+import tempfile
+import timeit
+
+import numpy
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from myylibs.imageencoders import ImageEncoder
+from myylibs.pngchunks import read_png_text_chunks
+
+SIZES = [512, 1024, 2048, 4096]
+
+METADATA = {
+    "AI_Prompt": "Degu enjoys its morning coffee by Some Artist, highly detailed",
+    "AI_Torch_Seed": "1234567890",
+    "AI_StableDiffusion_Guidance_Scale": "7.5",
+    "AI_StableDiffusion_Inferences": "60",
+    "AI_StableDiffusion_Model_Name": "CompVis/stable-diffusion-v1-4",
+    "AI_Metadata_Type": "Voyage",
+    "AI_Prompt_Negative": "lowres, bad anatomy, bad hands",
+}
+
+def pil_metadata(source) -> dict:
+    # The previous implementation
+    image = Image.open(source)
+    ret = image.text.copy()
+    image.close()
+    return ret
+
+def write_image(directory:str, size:int) -> str:
+    # Noise compresses badly, like detailed generated images
+    pixels = numpy.random.default_rng(size).integers(0, 256, (size, size, 3), dtype=numpy.uint8)
+    filepath = os.path.join(directory, f"benchmark_{size}.png")
+    ImageEncoder("png", 1).encode(Image.fromarray(pixels), METADATA, filepath)
+    return filepath
+
+def run(directory:str, repeat:int = 5):
+    print(f"{'Image':<10} {'Size (MiB)':>10} {'Source':>7} {'PIL (ms)':>10} {'Streaming (ms)':>15} {'Speedup':>8}")
+    for size in SIZES:
+        filepath = write_image(directory, size)
+        with open(filepath, "rb") as png_file:
+            content = png_file.read()
+        assert read_png_text_chunks(filepath) == pil_metadata(filepath)
+
+        sources = {
+            "file": (lambda: filepath, lambda: filepath),
+            "bytes": (lambda: io.BytesIO(content), lambda: content),
+        }
+        for source_name, (pil_source, streaming_source) in sources.items():
+            number = 5 if size >= 2048 else 20
+            previous = min(timeit.repeat(lambda: pil_metadata(pil_source()), number=number, repeat=repeat)) / number
+            current = min(timeit.repeat(lambda: read_png_text_chunks(streaming_source()), number=number, repeat=repeat)) / number
+            print(
+                f"{f'{size}x{size}':<10} {len(content) / (1024 * 1024):>10.1f} {source_name:>7} "
+                f"{previous * 1e3:>10.3f} {current * 1e3:>15.3f} {previous / current:>7.1f}x")
+        os.remove(filepath)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            run(directory)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Compares the speed and the peak memory of the precisions (fp32, fp16,
+# bf16).
+#
+# Each precision is benchmarked by "sdworker.py benchmark", in its own
+# process, like benchmarks/memory_policies_benchmark.py. Precisions the
+# device doesn't support are skipped.
+#
+# Usage :
+#   python benchmarks/precision_benchmark.py [--real] [--device cuda] [--width 128] [--height 128]
+# By default, the tiny random model runs on CPU. --real uses the model
+# and the device configured in the .env file.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPOSITORY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+from myylibs.precision import PRECISIONS, resolve_precision
+
+def supported_precisions(torch_device:str) -> list[str]:
+    supported = []
+    for name in PRECISIONS:
+        try:
+            resolve_precision(name, torch_device)
+            supported.append(name)
+        except ValueError as e:
+            print(f"Skipping {name} : {e}")
+    return supported
+
+def benchmark_precision(name:str, arguments, output_filepath:str) -> dict:
+    command = [
+        sys.executable, "sdworker.py", "benchmark",
+        "--precision", name,
+        "--only", "generate_batch",
+        "--images", str(arguments.images),
+        "--batch-size", str(arguments.batch_size),
+        "--width", str(arguments.width),
+        "--height", str(arguments.height),
+        "--output", output_filepath]
+    if arguments.real:
+        command.append("--real")
+    # The output is only shown on failure
+    completed = subprocess.run(command, cwd = REPOSITORY_DIRECTORY, capture_output = True, text = True)
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:])
+        print(completed.stderr[-2000:])
+        raise RuntimeError(f"The {name} benchmark failed")
+    with open(output_filepath, "r", encoding="utf-8") as results_file:
+        return json.load(results_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Speed and peak memory of each precision")
+    parser.add_argument("--real", action = "store_true", help = "Use the configured model and device, instead of a tiny random model on CPU")
+    parser.add_argument("--images", type = int, default = 4)
+    parser.add_argument("--batch-size", type = int, default = 2)
+    parser.add_argument("--width", type = int, default = 128, help = "Ignored with --real. Set IMAGES_WIDTH instead.")
+    parser.add_argument("--height", type = int, default = 128, help = "Ignored with --real. Set IMAGES_HEIGHT instead.")
+    parser.add_argument("--device", default = "cpu", help = "Device of the --real benchmarks, to list the supported precisions")
+    arguments = parser.parse_args()
+
+    precisions = supported_precisions(arguments.device if arguments.real else "cpu")
+    print(f"{'Precision':<16} {'Batch p50':>10} {'Images/s':>9} {'Peak memory':>12} {'Speedup':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        fp32_p50 = None
+        for name in precisions:
+            results = benchmark_precision(name, arguments, os.path.join(directory, f"{name}.json"))
+            batch = results["benchmarks"]["generate_batch"]
+            if name == "fp32":
+                fp32_p50 = batch["p50"]
+            speedup = f"{fp32_p50 / batch['p50']:.2f}x" if fp32_p50 else "-"
+            print(
+                f"{results['metadata']['precision']:<16} {batch['p50'] * 1e3:>8.0f}ms {batch['items_per_second']:>9.2f} "
+                f"{batch['peak_memory_bytes'] / (1024 * 1024):>9.0f}MiB {speedup:>8}",
+                flush = True)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Compares the single scan special tags expansion with the previous
+# tag after tag implementation, using the sample replacers file.
+#
+# Usage : python benchmarks/replacers_benchmark.py [replacers.json]
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sdworker import DeguDiffusionWorker, SpecialTag, SpecialTagsReplacer, REPLACER_SAMPLE_FILEPATH, random_words_from_tag
+
+def replace_special_tags_previous(prompt:str, tags:dict[str, SpecialTag]) -> str:
+    # The implementation used before the single scan replacer
+    for tag_name in tags:
+        tag:SpecialTag = tags[tag_name]
+        if tag == None:
+            continue
+
+        if tag_name not in prompt:
+            continue
+
+        occurences = 0
+        max_occurences = tag.max_occurences
+
+        while tag_name in prompt:
+            if occurences >= max_occurences:
+                prompt = prompt.replace(tag_name, "")
+                break
+
+            names_list = random_words_from_tag(tag)
+
+            prompt = prompt.replace(tag_name, tag.join_word.join(names_list), 1)
+            occurences += 1
+
+    return prompt
+
+def load_sample_replacers(filepath:str) -> dict[str, SpecialTag]:
+    # Only load_replacers is needed, not the whole pipeline
+    worker = DeguDiffusionWorker.__new__(DeguDiffusionWorker)
+    worker.logger = logging.getLogger("replacers_benchmark")
+    return worker.load_replacers(replacers_filepath = filepath)
+
+def benchmark_prompts(tags:dict[str, SpecialTag]) -> dict[str, str]:
+    tag_names = list(tags)
+    text = "A Degu enjoying its morning coffee, highly detailed, "
+    return {
+        "no tags": text * 4,
+        "one tag": text + tag_names[0],
+        "50 tags once": text + ", ".join(tag_names[:50]),
+        "50 tags 4 times": text + ", ".join(tag_names[:50] * 4),
+        "long prompt, few tags": (text * 20) + tag_names[0] + (text * 20) + tag_names[-1],
+    }
+
+def synthetic_replacers(sample:dict[str, SpecialTag], n_tags:int) -> dict[str, SpecialTag]:
+    # Many tags reusing the sample words, to show how both implementations scale
+    sample_tags = list(sample.values())
+    return {
+        f"{{synthetic_tag_{index}}}": sample_tags[index % len(sample_tags)]
+        for index in range(n_tags)}
+
+def run(filepath:str, repeat:int = 5):
+    tags = load_sample_replacers(filepath)
+    if not tags:
+        print(f"No replacers could be loaded from {filepath}")
+        return
+
+    compare(f"{len(tags)} tags loaded from {filepath}", tags, repeat)
+    compare("500 synthetic tags", synthetic_replacers(tags, 500), repeat)
+
+def compare(title:str, tags:dict[str, SpecialTag], repeat:int):
+    replacer = SpecialTagsReplacer(tags)
+    print(f"{title} (single pass : {replacer.single_pass})")
+    print(f"{'Prompt':<24} {'Previous (us)':>14} {'Single scan (us)':>17} {'Speedup':>8}")
+
+    for name, prompt in benchmark_prompts(tags).items():
+        number = 2000
+        previous = min(timeit.repeat(lambda: replace_special_tags_previous(prompt, tags), number=number, repeat=repeat)) / number
+        current = min(timeit.repeat(lambda: replacer.replace(prompt), number=number, repeat=repeat)) / number
+        print(f"{name:<24} {previous * 1e6:>14.2f} {current * 1e6:>17.2f} {previous / current:>7.2f}x")
+    print()
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    run(sys.argv[1] if len(sys.argv) > 1 else REPLACER_SAMPLE_FILEPATH)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Compares the scheduling policies of the JobQueue on a synthetic
+# workload : one user submits a huge job, then other users submit small
+# jobs while the huge one is running.
+# The images are "generated" by a fake worker, sleeping for each
+# denoising step, so the results only depend on the scheduling.
+#
+# Usage : python benchmarks/scheduling_benchmark.py [step_duration_ms] [batch_size]
+
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from myylibs.jobsmanager import Job, JobQueue, SCHEDULING_POLICIES, percentile
+
+BATCH_COMPATIBLE_KWARGS = ("width", "height", "n_inferences", "guidance_scale")
+
+class FakeWorker:
+    def __init__(self, step_duration:float):
+        self.step_duration:float = step_duration
+
+    def generate_image(self, **kwargs) -> dict:
+        return self.generate_batch(1, **kwargs)[0]
+
+    def generate_batch(self, n_images:int, per_image:list = None, abort_check = None, n_inferences:int = 1, width:int = 512, height:int = 512, **kwargs) -> list[dict]:
+        # Batches are cheaper per image, but not free
+        batch_factor = n_images ** 0.8
+        time.sleep(self.step_duration * n_inferences * batch_factor * width * height / (512 * 512))
+        return [{"seed": index} for index in range(n_images)]
+
+def workload(seed:int = 1234) -> list[tuple[float, Job]]:
+    """(Submission delay in seconds, job) sorted by delay"""
+    rng = random.Random(seed)
+    jobs = [(0, Job("huge", iterations=32, kwargs={"prompt": "huge", "n_inferences": 60, "guidance_scale": 7.5, "width": 512, "height": 512}, user_id=1))]
+    delay = 0.05
+    for index in range(20):
+        user_id = 2 + index % 5
+        jobs.append((delay, Job(f"small {index}", iterations=2, kwargs={"prompt": f"small {index}", "n_inferences": 20, "guidance_scale": 7.5, "width": 512, "height": 512}, user_id=user_id)))
+        delay += rng.expovariate(1 / 0.1)
+    return jobs
+
+async def run_policy(policy_name:str, step_duration:float, batch_size:int) -> dict:
+    queue = JobQueue(
+        lambda index: FakeWorker(step_duration),
+        lambda worker: worker.generate_image,
+        lambda worker: worker.generate_batch,
+        BATCH_COMPATIBLE_KWARGS,
+        batch_size,
+        scheduling_policy = SCHEDULING_POLICIES[policy_name]())
+    done_at = {}
+    for status in queue.report_handlers:
+        queue.report_handlers[status] = lambda job, report: None
+    queue.report_handlers["Finished"] = lambda job, report: done_at.setdefault(job, time.monotonic())
+
+    main_task = asyncio.ensure_future(queue.main_task())
+    while any(worker_status.state == "Starting" for worker_status in queue.workers_status):
+        await asyncio.sleep(0.01)
+
+    jobs = workload()
+    started_at = time.monotonic()
+    for delay, job in jobs:
+        await asyncio.sleep(max(0, started_at + delay - time.monotonic()))
+        queue.add_job(job)
+    while queue.jobs_by_id:
+        await asyncio.sleep(0.01)
+
+    queue._bailing_out()
+    main_task.cancel()
+
+    small_jobs = [job for _, job in jobs if job.user_id != 1]
+    huge_job = jobs[0][1]
+    small_first_images = [job.first_result_at - job.queued_at for job in small_jobs]
+    return {
+        "all": queue.wait_stats(),
+        "small_first_image_p50": percentile(small_first_images, 50),
+        "small_first_image_p95": percentile(small_first_images, 95),
+        "huge_completion": done_at[huge_job] - huge_job.queued_at,
+        "huge_first_image": huge_job.first_result_at - huge_job.queued_at,
+        "total": time.monotonic() - started_at,
+    }
+
+def run(step_duration:float, batch_size:int):
+    print(f"Step : {step_duration * 1e3:.1f} ms, batches of {batch_size} images max, 1 job of 32 images, 20 jobs of 2 images")
+    print(
+        f"{'Policy':<12} {'First image p50':>16} {'p95':>8} {'Small first p50':>16} {'p95':>8} "
+        f"{'Done p50':>9} {'p95':>8} {'Huge done':>10} {'Total':>8}")
+    for policy_name in SCHEDULING_POLICIES:
+        results = asyncio.run(run_policy(policy_name, step_duration, batch_size))
+        waits = results["all"]
+        print(
+            f"{policy_name:<12} {waits['first_image_p50']:>15.2f}s {waits['first_image_p95']:>7.2f}s "
+            f"{results['small_first_image_p50']:>15.2f}s {results['small_first_image_p95']:>7.2f}s "
+            f"{waits['completion_p50']:>8.2f}s {waits['completion_p95']:>7.2f}s "
+            f"{results['huge_completion']:>9.2f}s {results['total']:>7.2f}s")
+
+if __name__ == "__main__":
+    step_duration_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    run(step_duration_ms / 1000, batch_size)
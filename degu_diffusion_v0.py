@@ -1,25 +1,40 @@
 #!/usr/bin/env python3
 
 import asyncio
-from cProfile import run
 import logging
 import os
 import re
+import resource
+import sys
+import time
 import traceback
+import typing
 
 # Libs
 
 import discord # discord.py
 import dotenv # python-dotenv
 
-from myylibs.jobsmanager import JobQueue, Job, StatusReport # (provided in myylibs/)
+from myylibs.jobsmanager import JobQueue, Job, StatusReport, SchedulingPolicy, WeightedFairPolicy, SCHEDULING_POLICIES # (provided in myylibs/)
+from myylibs.contactsheet import ContactSheet # (provided in myylibs/)
+from myylibs.generationtimings import GenerationTimings, timings_key # (provided in myylibs/)
 from myylibs.helpers import Helpers # (provided in myylibs/)
+from myylibs.imageencoders import ImageEncoder, read_image_metadata # (provided in myylibs/)
+from myylibs.imagesindex import ImagesIndex # (provided in myylibs/)
+from myylibs.memorypolicy import MEMORY_POLICIES, AUTO_MEMORY_POLICY # (provided in myylibs/)
+from myylibs.metrics import Metrics # (provided in myylibs/)
+from myylibs.precision import PRECISIONS, AUTO_PRECISION # (provided in myylibs/)
+from myylibs.acceleration import ACCELERATIONS # (provided in myylibs/)
+from myylibs.processworker import ProcessWorker # (provided in myylibs/)
+from myylibs.stubworker import StubWorker # (provided in myylibs/)
+from myylibs.submitapi import SubmitAPI, SubmissionRefused, RecordingReference # (provided in myylibs/)
+from myylibs.uploadqueue import UploadQueue # (provided in myylibs/)
 
 from PIL import Image # pillow
 # Don't remove, else you might PNG Metadata support
 from PIL.PngImagePlugin import PngInfo # pillow
 
-from sdworker import DeguDiffusionWorker # (provided in sdworker.py)
+from sdworker import DeguDiffusionWorker, AUTO_BATCH_MAX_SIZE # (provided in sdworker.py)
 
 # The code is hideous, with ton of global methods all over
 # the place, because I have no idea how to set this up
@@ -34,6 +49,14 @@ intents.guild_messages = True
 discord.utils.setup_logging(level=logging.INFO)
 
 CONFIG_DENIED_EXPRESSIONS_FILEPATH = "config/denied_expressions.txt"
+# Bigger attachments are not downloaded to look for metadata.
+# Interactions must be answered within 3 seconds.
+MAX_INSPECTED_ATTACHMENT_SIZE = 8 * 1024 * 1024
+
+# Durations reported by the workers and the queue, exported as metrics
+STAGE_TIMINGS = ("queue_wait", "tags", "text_encoding", "denoise", "denoise_loop", "denoise_step", "vae_decode", "encoding_wait", "encoding", "job")
+# Measured for a whole batch. Divided by the batch size.
+BATCH_STAGE_TIMINGS = ("text_encoding", "denoise", "denoise_loop", "vae_decode")
 
 class MyClient(discord.Client):
     def __init__(self, *, intents: discord.Intents):
@@ -47,6 +70,7 @@ class MyClient(discord.Client):
         # maintain its own tree instead.
         self.tree = discord.app_commands.CommandTree(self)
         self.sd_queue = None
+        self.uploads:UploadQueue = None
         self.denied_expressions = self.load_denied_words(CONFIG_DENIED_EXPRESSIONS_FILEPATH)
 
     def load_denied_words(self, config_filepath:str) -> list:
@@ -87,27 +111,100 @@ class MyClient(discord.Client):
     def followup_on(
         response,
         message:str = None,
-        file:discord.File = None,
+        attachment:tuple = None,
         ephemeral:bool = False):
-        
+        """Queue a message to response.
+        attachment is a (filepath or BytesIO, filename) tuple."""
+
+        # Messages are sent in order, by the uploads queue.
+        # Consecutive images are grouped in the same message.
+        client.uploads.enqueue(
+            response,
+            content     = message,
+            attachments = [attachment] if attachment else [],
+            ephemeral   = ephemeral)
+
+    @staticmethod
+    async def send_followup(response, content:str, attachments:list[tuple], ephemeral:bool):
         # For some reason, if you provide an empty content, Discord.py
         # will add '...' to the message, which I really don't like.
         #
         # If you don't set the content at all, though, the problem goes
         # away, so we're on for selecting the arguments we pass... yay...
         kwargs = {}
-        if message:
-            kwargs["content"] = message
-        if file:
-            kwargs["file"] = file
-
-        if type(response) == discord.Thread:
-            # Discord.py Thread.send doesn't support ephemeral...
-            asyncio.ensure_future(response.send(**kwargs))
-        else:
-            if ephemeral:
-                kwargs["ephemeral"] = ephemeral
-            asyncio.ensure_future(response.send(**kwargs))
+        if content:
+            kwargs["content"] = content
+        if attachments:
+            # discord.File objects can't be sent twice. Create new ones
+            # on every attempt.
+            files = []
+            for source, filename in attachments:
+                if hasattr(source, "seek"):
+                    source.seek(0)
+                files.append(discord.File(source, filename = filename))
+            kwargs["files"] = files
+
+        # Discord.py Thread.send doesn't support ephemeral...
+        if ephemeral and type(response) != discord.Thread:
+            kwargs["ephemeral"] = ephemeral
+        await response.send(**kwargs)
+
+class CancelJobView(discord.ui.View):
+    """Cancel button, shown under the job description"""
+
+    def __init__(self, job:Job):
+        # Jobs can stay in the queue for a long time
+        super().__init__(timeout = None)
+        self.job = job
+
+    @discord.ui.button(label = "Cancel", style = discord.ButtonStyle.secondary)
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.job.user_id:
+            await interaction.response.send_message("Only the author of this job can cancel it", ephemeral = True)
+            return
+
+        if not interaction.client.sd_queue.cancel_job(self.job.job_id):
+            await interaction.response.send_message("This job is already done", ephemeral = True)
+            return
+
+        button.disabled = True
+        await interaction.response.edit_message(view = self)
+
+def create_generation_job(
+    prompt:str,
+    n_images_text:str,
+    inferences_text:str,
+    guidance_scale_text:str,
+    seed_text:str,
+    user_id:int) -> Job:
+    """Job generating images from the form fields, clamped to the
+    configured limits"""
+    n_images = Helpers.to_int_clamped(n_images_text, 8, 1, MAX_IMAGES_PER_JOB)
+    n_inferences = Helpers.to_int_clamped(inferences_text, 60, 1, MAX_INFERENCES_PER_IMAGE)
+    guidance_scale = Helpers.to_float_clamped(guidance_scale_text, 7.5, 0, MAX_GUIDANCE_SCALE_PER_IMAGE)
+
+    seed_value = None
+    if seed_text:
+        try:
+            seed_value = int(seed_text)
+        except ValueError:
+            pass
+    if seed_value == -1 and SEED_MINUS_ONE_IS_RANDOM:
+        seed_value = None
+
+    return Job(
+        external_reference = None,
+        iterations = n_images,
+        kwargs = {
+            "prompt":         prompt,
+            "n_inferences":   n_inferences,
+            "guidance_scale": guidance_scale,
+            "deterministic":  seed_value if seed_value else True,
+            "width":          IMAGES_WIDTH,
+            "height":         IMAGES_HEIGHT
+        },
+        user_id = user_id
+    )
 
 # Remember, you're limited to 5 fields in a Discord form
 # Well, Discord.py will yell at you if you go over 5 fields.
@@ -186,27 +283,41 @@ class Generate(discord.ui.Modal, title='Generate'):
             await interaction.response.send_message(f"Denied ! ({prompt})")
             return
 
-        n_images = Helpers.to_int_clamped(self.n_images.value, 8, 1, MAX_IMAGES_PER_JOB)
-        n_inferences = Helpers.to_int_clamped(self.inferences.value, 60, 1, MAX_INFERENCES_PER_IMAGE)
-        guidance_scale = Helpers.to_float_clamped(self.guidance_scale.value, 7.5, 0, MAX_GUIDANCE_SCALE_PER_IMAGE)
-
-        seed_value = None
-        if self.seed.value:
-            try:
-                seed_value = int(self.seed.value)
-            except ValueError:
-                pass
-        if seed_value == -1 and SEED_MINUS_ONE_IS_RANDOM:
-            seed_value = None
+        job = create_generation_job(
+            prompt,
+            self.n_images.value,
+            self.inferences.value,
+            self.guidance_scale.value,
+            self.seed.value,
+            interaction.user.id)
+        n_images = job.iterations
+        n_inferences = job.kwargs["n_inferences"]
+        guidance_scale = job.kwargs["guidance_scale"]
+        seed_value = job.kwargs["deterministic"] if job.kwargs["deterministic"] is not True else None
+
+        queue:MyQueue = interaction.client.sd_queue
+        admissible_images = queue.admissible_images(job, MAX_QUEUED_IMAGE_STEPS, MAX_QUEUED_IMAGE_STEPS_PER_USER)
+        if admissible_images <= 0:
+            await interaction.response.send_message(
+                "The queue is full ! Try again in a few minutes, or ask for less images or inferences.",
+                ephemeral = True)
+            return
 
         message  = 'Putting your job into the queue\n'
+        if admissible_images < n_images:
+            message += f"The queue is busy. Your job was reduced to {admissible_images} images.\n"
+            n_images = admissible_images
+            job.iterations = n_images
+
         message += (
             f"Number of images : {n_images}\n"
             f"Prompt : '{prompt}'\n"+
             f"Inferences : {n_inferences}\n"+
             f"Guidance Scale : {guidance_scale}\n")
         if seed_value:
-            message += f'Seed : {seed_value}'
+            message += f'Seed : {seed_value}\n'
+        message += f'Job : {job.job_id}\n'
+        message += queue.describe_estimate(job)
 
         await interaction.response.send_message(message)
 
@@ -219,20 +330,10 @@ class Generate(discord.ui.Modal, title='Generate'):
         else:
             reference = interaction.followup
 
-        job = Job(
-            external_reference=reference,
-            iterations = n_images,
-            kwargs = {
-                "prompt":         prompt,
-                "n_inferences":   n_inferences,
-                "guidance_scale": guidance_scale,
-                "deterministic":  seed_value if seed_value else True,
-                "width":          IMAGES_WIDTH,
-                "height":         IMAGES_HEIGHT
-            }
-        )
-
-        interaction.client.sd_queue.add_job(job)
+        job.external_reference = reference
+        queue.add_job(job)
+        # Only once the queue knows the job, so that it can be canceled
+        await message.edit(view = CancelJobView(job))
 
     async def on_error(self, interaction: discord.Interaction, error: Exception) -> None:
         if interaction.response:
@@ -263,45 +364,71 @@ async def degudiffusion(interaction: discord.Interaction):
             ephemeral=True)
 
 def _png_metadata(png_filepath:str) -> dict:
+    # Also works with the other formats written by the image encoders
     ret = {}
     if not os.path.exists(png_filepath):
         print("[_png_metadata] Invalid filepath %s" % (png_filepath))
         return ret
     
-    image = Image.open(png_filepath)
-    ret = image.text.copy()
-    image.close()
-    return ret
+    return read_image_metadata(png_filepath)
+
+def _archived_image_filepath(filename:str) -> str:
+    # The image sent can use a different format than the one saved
+    stem, _ = os.path.splitext(filename)
+    candidates = [filename] + [stem + extension for _, extension, *_ in ImageEncoder.FORMATS.values()]
+    for candidate in candidates:
+        filepath = os.path.join(OUTPUT_DIRECTORY, candidate)
+        if os.path.exists(filepath):
+            return filepath
+    return ""
+
+def _metadata_response(metadata:dict) -> str:
+    response_content = "Metadata:\n"
+    for key in metadata:
+        response_content += ("**%s**: `%s`\n" % (key, metadata[key] if metadata[key] else " "))
+    return response_content
 
 @client.tree.context_menu(name='Check Degu PNG Metadata')
 async def identify_png(interaction: discord.Interaction, message: discord.Message):
 
+    # Reading the attachments can take longer than Discord waits for a response
+    await interaction.response.defer(ephemeral = True, thinking = True)
+
+    too_large = False
     for attachment in message.attachments:
         filename = attachment.filename
-        filepath = os.path.join(OUTPUT_DIRECTORY, filename)
+        if IMAGES_INDEX:
+            metadata = IMAGES_INDEX.lookup(filename)
+            if metadata:
+                await interaction.followup.send(content = _metadata_response(metadata), ephemeral = True)
+                return
 
-        if not os.path.exists(filepath):
-            await interaction.response.send_message("I don't remember generating this one...", ephemeral = True)
-            return
-        else:
-            try:
+        # Not indexed. Generated before the index, maybe.
+        filepath = _archived_image_filepath(filename)
+
+        if (not filepath) and attachment.size > MAX_INSPECTED_ATTACHMENT_SIZE:
+            too_large = True
+            continue
+
+        try:
+            if filepath:
                 metadata = _png_metadata(filepath)
-                if not metadata:
-                    continue
-                
-                response_content = "Metadata:\n"
-                for key in metadata:
-                    response_content += ("**%s**: `%s`\n" % (key, metadata[key] if metadata[key] else " "))
-                
-                await interaction.response.send_message(content = response_content, ephemeral=True)
-                return
-            except Exception as e:
-                traceback.print_exception(e)
-                await interaction.response.send_message('Something went wrong...', ephemeral = True)
-                return
+            else:
+                # Not on the server anymore. Check the image sent instead.
+                metadata = read_image_metadata(await attachment.read())
+        except Exception as e:
+            # Not an image, or not readable. Check the next attachments.
+            traceback.print_exception(e)
+            continue
+        if metadata:
+            await interaction.followup.send(content = _metadata_response(metadata), ephemeral = True)
+            return
+
+    if too_large:
+        await interaction.followup.send("I don't remember generating this one...", ephemeral = True)
+    else:
+        await interaction.followup.send("Hmm... could not get anything from this message.", ephemeral = True)
 
-    await interaction.response.send_message("Hmm... could not get anything from this message.", ephemeral = True)
-    
 
 @client.tree.context_menu(name='Repeat Diffusion')
 async def repeat_diffusion(interaction: discord.Interaction, message: discord.Message):
@@ -348,6 +475,98 @@ async def repeat_diffusion(interaction: discord.Interaction, message: discord.Me
             "Tell the admin to check its form limits settings",
             ephemeral = True)
 
+@client.tree.command()
+@discord.app_commands.describe(job_id = "The job to cancel. All your jobs when not set.")
+async def degucancel(interaction: discord.Interaction, job_id: int = None):
+    """Cancel your queued and running jobs"""
+    queue = client.sd_queue
+    if not queue:
+        await interaction.response.send_message("The queue isn't running", ephemeral = True)
+        return
+
+    if job_id == None:
+        n_canceled = queue.cancel_user_jobs(interaction.user.id)
+        await interaction.response.send_message(f"{n_canceled} jobs canceled", ephemeral = True)
+        return
+
+    job = queue.get_job(job_id)
+    if job == None or job.user_id != interaction.user.id:
+        await interaction.response.send_message(f"You have no job {job_id} running", ephemeral = True)
+        return
+
+    # The job can finish in the meantime
+    if not queue.cancel_job(job_id):
+        await interaction.response.send_message(f"Job {job_id} already finished", ephemeral = True)
+        return
+    await interaction.response.send_message(f"Job {job_id} canceled", ephemeral = True)
+
+def is_admin(interaction: discord.Interaction) -> bool:
+    if ADMIN_USER_IDS:
+        return interaction.user.id in ADMIN_USER_IDS
+    permissions = getattr(interaction.user, "guild_permissions", None)
+    return permissions != None and permissions.administrator
+
+@client.tree.command()
+@discord.app_commands.default_permissions(administrator = True)
+@discord.app_commands.describe(
+    n_images = "Number of images to profile",
+    profiler = "torch : operators and CUDA kernels. cprofile : Python functions.")
+async def deguprofile(interaction: discord.Interaction, n_images: discord.app_commands.Range[int, 1, 64] = 4, profiler: typing.Literal["torch", "cprofile"] = "torch"):
+    """Profile the generation of the next images (admins only)"""
+    if not is_admin(interaction):
+        await interaction.response.send_message("Only the admins can profile the workers", ephemeral = True)
+        return
+
+    queue = client.sd_queue
+    if not queue:
+        await interaction.response.send_message("The queue isn't running", ephemeral = True)
+        return
+
+    queue.call_on_workers(lambda worker: worker.start_profiling(n_images, profiler, PROFILES_DIRECTORY))
+    await interaction.response.send_message(
+        f"Profiling the next {n_images} images with {profiler}, on each worker process. "
+        f"The traces and summaries will be written to {PROFILES_DIRECTORY}",
+        ephemeral = True)
+
+@client.tree.command()
+async def degustatus(interaction: discord.Interaction):
+    """Health of the image generation workers"""
+    if not client.sd_queue:
+        await interaction.response.send_message("The queue isn't running", ephemeral = True)
+        return
+
+    # Process workers answer through their Pipe. Don't block the event loop meanwhile.
+    loop = asyncio.get_running_loop()
+    response_content = "Workers :\n"
+    for worker_status in client.sd_queue.workers_status:
+        device = worker_status.worker.torch_device if worker_status.worker else "?"
+        response_content += f"`{device}` {worker_status}\n"
+        if worker_status.worker:
+            cache_stats = await loop.run_in_executor(None, worker_status.worker.cache_stats)
+            for cache_name, stats in cache_stats.items():
+                response_content += f"  {cache_name} cache : {stats['hits']} hits, {stats['misses']} misses, {stats['bytes'] // 1024} KiB\n"
+    if client.uploads:
+        stats = client.uploads.stats()
+        response_content += (
+            f"Uploads : {stats['pending']} pending, {stats['messages_sent']} messages, "
+            f"{stats['attachments_sent']} images, {stats['retries']} retries, "
+            f"{stats['rate_limited']} rate limited, {stats['failures']} failed\n")
+
+    queue = client.sd_queue
+    stages = queue.metrics.summary("stage_seconds")
+    if stages:
+        response_content += "Stages (average per image) : " + ", ".join(
+            f"{dict(labels)['stage']} {average * 1000:.0f} ms" for labels, (_, average) in stages.items()) + "\n"
+    waits = queue.wait_stats()
+    response_content += (
+        f"Scheduling : {queue.scheduling_policy.name}. Last {waits['jobs']} jobs, "
+        f"first image after {waits['first_image_p50']:.1f} s (p50) / {waits['first_image_p95']:.1f} s (p95), "
+        f"done after {waits['completion_p50']:.1f} s (p50) / {waits['completion_p95']:.1f} s (p95)\n")
+    for job in queue.user_jobs(interaction.user.id):
+        response_content += f"Your job {job.job_id} : {job.completed}/{job.iterations} images. "
+        response_content += queue.describe_estimate(job).replace("\n", ". ").rstrip(". ") + "\n"
+    await interaction.response.send_message(response_content, ephemeral = True)
+
 @client.event
 async def on_ready():
     print(client.guilds)
@@ -358,10 +577,119 @@ async def on_ready():
             print(f'Channel {channel.name}')
 
 class MyQueue(JobQueue):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Contact sheets being filled, for the jobs sent as grids
+        self.contact_sheets:dict[Job, ContactSheet] = {}
+        self.contact_sheets_images:dict[Job, int] = {}
+        # Generation time of the previous images, for the estimates
+        self.timings = GenerationTimings(filepath = GENERATION_TIMINGS_FILEPATH)
+        self.metrics = Metrics()
+        self.metrics.add_collector(self.collect_metrics)
+
+    def handle_report(self, job:Job, report:StatusReport):
+        self.record_metrics(report)
+        super().handle_report(job, report)
+
+    def record_metrics(self, report:StatusReport):
+        self.metrics.increment("reports_total", 1, "Reports received from the workers", status = report.status)
+        batch_size = max(1, report.timings.get("denoised_images", 1))
+        for stage, seconds in report.timings.items():
+            if stage not in STAGE_TIMINGS:
+                continue
+            if stage in BATCH_STAGE_TIMINGS:
+                seconds /= batch_size
+            self.metrics.observe("stage_seconds", seconds, "Duration of the generation stages, per image", stage = stage)
+
+        if isinstance(report.result, dict) and report.result.get("peak_memory"):
+            self.metrics.set_max("worker_peak_memory_bytes", report.result["peak_memory"], "Highest memory usage of the workers devices")
+        if isinstance(report.result, dict) and report.result.get("memory_policy"):
+            self.metrics.increment("memory_policy_images", 1, "Images generated with each memory policy", policy = report.result["memory_policy"])
+
+    def collect_metrics(self, metrics:Metrics):
+        # Called from the event loop, when the metrics are read
+        metrics.set("jobs_queued", len(self.jobs_by_id), "Jobs not done yet")
+        metrics.set("images_queued", sum(max(0, job.remaining_to_schedule()) for job in self.jobs_by_id.values()), "Images not generated yet")
+        metrics.set("image_steps_queued", self.queued_cost(), "Work waiting in the queue, in 512x512 denoising steps")
+        for worker_status in self.workers_status:
+            metrics.set("worker_busy", 1 if worker_status.state == "Busy" else 0, "1 while the worker is generating images", worker = worker_status.index)
+            metrics.set("worker_images", worker_status.images_done, "Images generated by the worker", worker = worker_status.index)
+            metrics.set("worker_failures", worker_status.failures, "Batches failed on the worker", worker = worker_status.index)
+        # Kilobytes on Linux
+        metrics.set("bot_peak_memory_bytes", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, "Highest resident memory of the bot process")
+        if client.uploads:
+            stats = client.uploads.stats()
+            metrics.set("uploads_pending", stats["pending"], "Messages waiting to be sent to Discord")
+            metrics.set("uploads_messages", stats["messages_sent"], "Messages sent to Discord")
+            metrics.set("uploads_attachments", stats["attachments_sent"], "Images sent to Discord")
+            metrics.set("uploads_retries", stats["retries"], "Messages sent again after a failure")
+            metrics.set("uploads_failures", stats["failures"], "Messages never sent")
+            metrics.set("uploads_send_seconds", stats["send_seconds"], "Time spent sending messages to Discord")
+            metrics.set("uploads_slowest_send_seconds", stats["slowest_send"], "Slowest message sent to Discord")
+
+    def timings_key(self, job:Job) -> tuple:
+        return timings_key(
+            job.kwargs["n_inferences"],
+            job.kwargs["width"],
+            job.kwargs["height"],
+            STABLEDIFFUSION_MODEL_NAME)
+
+    def image_seconds(self, job:Job) -> float:
+        return self.timings.seconds_per_image(self.timings_key(job))
+
+    def describe_estimate(self, job:Job) -> str:
+        """Queue position and estimated start and end of a job, using
+        Discord relative timestamps"""
+        estimate = self.estimate_job(job, self.image_seconds)
+        now = time.time()
+        description = ""
+        if estimate["position"]:
+            description += f"Position in the queue : {estimate['position']}\n"
+            description += f"Estimated start : <t:{int(now + estimate['start'])}:R>\n"
+        if estimate["finish"]:
+            description += f"Estimated end : <t:{int(now + estimate['finish'])}:R>\n"
+        return description
+
+    def uses_contact_sheets(self, job:Job) -> bool:
+        return GRID_DELIVERY and job.iterations > MAX_IMAGES_BEFORE_THREAD
+
+    def add_to_contact_sheet(self, job:Job, result:dict):
+        if job not in self.contact_sheets:
+            self.contact_sheets[job] = ContactSheet(GRID_COLUMNS, GRID_ROWS, GRID_THUMBNAIL_SIZE)
+        contact_sheet = self.contact_sheets[job]
+        # Numbered from the first image of the job
+        image_number = self.contact_sheets_images.get(job, 0) + 1
+        self.contact_sheets_images[job] = image_number
+
+        with Image.open(result["thumbnail"]) as thumbnail:
+            contact_sheet.add(thumbnail, f"{image_number}. {result['seed']}")
+
+        if contact_sheet.is_full():
+            self.send_contact_sheet(job)
+
+    def send_contact_sheet(self, job:Job, last:bool = False):
+        contact_sheet = self.contact_sheets.pop(job, None)
+        if last:
+            self.contact_sheets_images.pop(job, None)
+        if contact_sheet == None or contact_sheet.is_empty():
+            return
+
+        message_content = None
+        if not COMPACT_RESPONSES:
+            message_content = "Seeds :\n" + "\n".join(contact_sheet.labels)
+        first_seed = contact_sheet.labels[0].split(" ")[-1]
+        MyClient.followup_on(
+            job.external_reference,
+            message    = message_content,
+            attachment = (contact_sheet.render(), f"{int(time.time())}_GRID_{first_seed}.jpg"))
+
     def report_job_started(self, job:Job, report:StatusReport):
         MyClient.followup_on(job.external_reference, message = "Your job has started !", ephemeral = True)
 
     def report_job_done(self, job:Job, report:StatusReport):
+        # Writing the file would block the event loop
+        self.loop.run_in_executor(None, self.timings.save)
+        self.send_contact_sheet(job, last = True)
         MyClient.followup_on(job.external_reference, message = "Job finished ! Thanks for using Degu Diffusion !")
 
     def report_job_progress(self, job:Job, report:StatusReport):
@@ -374,21 +702,30 @@ class MyQueue(JobQueue):
             MyClient.followup_on(job.external_reference, message = "The image generator is not reporting results correctly. Yell at a dev !", ephemeral = True)
             return
 
+        timings = result.get("timings", {})
+        if timings.get("denoised_images"):
+            self.timings.record(self.timings_key(job), timings["denoise"] / timings["denoised_images"])
+
         if result["nsfw"]:
             MyClient.followup_on(job.external_reference, message = "You're too young for this one ! Skipping !", ephemeral = True)
             return
 
+        if self.uses_contact_sheets(job) and "thumbnail" in result:
+            self.add_to_contact_sheet(job, result)
+            return
 
         kwargs = {
             "response": job.external_reference
         }
         if result["content_as"] == "file":
-            kwargs["file"] = discord.File(result["filepath"])
+            kwargs["attachment"] = (result["filepath"], os.path.basename(result["filepath"]))
         else:
-            kwargs["file"] = discord.File(result["image_data"], filename = result["filepath"])
+            kwargs["attachment"] = (result["image_data"], result["filename"])
 
         if not COMPACT_RESPONSES:
             message_content = f"Seed : {result['seed']}\n"
+            if result.get("cache_hit"):
+                message_content += "Already generated, sent from the cache\n"
             if result["actual_prompt"]:
                 message_content += f"Actual prompt : {result['actual_prompt']}"
             kwargs["message"] = message_content
@@ -396,28 +733,150 @@ class MyQueue(JobQueue):
         MyClient.followup_on(**kwargs)
         
     def report_job_failed(self, job:Job, report:StatusReport):
+        self.send_contact_sheet(job, last = True)
         MyClient.followup_on(job.external_reference, "Ow... The whole thing broke... Try again later, maybe !")
     
     def report_job_canceled(self, job:Job, report:StatusReport):
+        self.send_contact_sheet(job, last = True)
         MyClient.followup_on(job.external_reference, "Job canceled")
 
-def generate_worker():
-    return DeguDiffusionWorker(
+def generate_worker(worker_index:int = 0):
+    if WORKERS_MODE == "stub":
+        return StubWorker(STUB_STEP_SECONDS)
+
+    # Workers are spread over the configured devices
+    torch_device = TORCH_DEVICES[worker_index % len(TORCH_DEVICES)]
+    worker_kwargs = dict(
         model_name    = STABLEDIFFUSION_MODEL_NAME,
         sd_token      = HUGGINGFACES_TOKEN,
         output_folder = OUTPUT_DIRECTORY,
         save_to_disk  = SAVE_IMAGES_TO_DISK,
-        mode          = os.environ.get('STABLEDIFFUSION_MODE', 'fp32'),
+        mode          = STABLEDIFFUSION_MODE,
         local_only    = STABLEDIFFUSION_LOCAL_ONLY,
-        torch_device  = TORCH_DEVICE,
-        sd_cache_dir  = STABLEDIFFUSION_CACHE_DIR)
+        torch_device  = torch_device,
+        sd_cache_dir  = STABLEDIFFUSION_CACHE_DIR,
+        batch_size    = IMAGES_BATCH_SIZE,
+        embeddings_cache_mb = EMBEDDINGS_CACHE_MB,
+        converted_models_dir = CONVERTED_MODELS_DIR,
+        encoding_threads = ENCODING_THREADS,
+        max_pending_encodes = MAX_PENDING_ENCODES,
+        archive_format = ARCHIVE_FORMAT,
+        delivery_format = DELIVERY_FORMAT,
+        images_index_filepath = IMAGES_INDEX_FILEPATH,
+        results_cache_mb = RESULTS_CACHE_MB,
+        thumbnail_size = GRID_THUMBNAIL_SIZE if GRID_DELIVERY else 0,
+        memory_policy  = MEMORY_POLICY,
+        memory_budget_mb = MEMORY_BUDGET_MB,
+        images_width   = IMAGES_WIDTH,
+        images_height  = IMAGES_HEIGHT,
+        acceleration   = ACCELERATION,
+        compile_cache_dir = COMPILE_CACHE_DIR,
+        warmup_sizes   = [(IMAGES_WIDTH, IMAGES_HEIGHT)])
+
+    if WORKERS_MODE == "process":
+        return ProcessWorker(DeguDiffusionWorker, worker_kwargs)
+    return DeguDiffusionWorker(**worker_kwargs)
 
 def get_worker_method(worker:DeguDiffusionWorker):
     return worker.generate_image
 
+def get_worker_batch_method(worker:DeguDiffusionWorker):
+    return worker.generate_batch
+
+def parse_user_weights(weights_description:str) -> dict:
+    """Parse "user_id:weight,user_id:weight" descriptions"""
+    weights = {}
+    for user_weight in weights_description.split(","):
+        user_id, _, weight = user_weight.strip().partition(":")
+        if not user_id:
+            continue
+        try:
+            weights[int(user_id)] = float(weight)
+        except ValueError:
+            print(f"Ignoring invalid user weight {user_weight}")
+    return weights
+
+def create_scheduling_policy() -> SchedulingPolicy:
+    if SCHEDULING_POLICY == WeightedFairPolicy.name:
+        return WeightedFairPolicy(SCHEDULING_USER_WEIGHTS)
+    return SCHEDULING_POLICIES[SCHEDULING_POLICY]()
+
+def submit_api_job(parameters:dict, reference:RecordingReference) -> dict:
+    """Queue a job submitted to the local API, like the Generate form would"""
+    prompt = str(parameters.get("prompt", DEFAULT_PROMPT))
+    if client.string_contains_denied_expressions(prompt):
+        raise SubmissionRefused(f"Denied ! ({prompt})", status = 403)
+
+    job = create_generation_job(
+        prompt,
+        str(parameters.get("n_images", DEFAULT_IMAGES_PER_JOB)),
+        str(parameters.get("n_inferences", DEFAULT_INFERENCES_STEPS)),
+        str(parameters.get("guidance_scale", DEFAULT_GUIDANCE_SCALE)),
+        str(parameters.get("seed", DEFAULT_SEED)),
+        Helpers.to_int(str(parameters.get("user_id", 0)), 0))
+
+    queue:MyQueue = client.sd_queue
+    admissible_images = queue.admissible_images(job, MAX_QUEUED_IMAGE_STEPS, MAX_QUEUED_IMAGE_STEPS_PER_USER)
+    if admissible_images <= 0:
+        raise SubmissionRefused("The queue is full", status = 429)
+    job.iterations = min(job.iterations, admissible_images)
+
+    estimate = queue.estimate_job(job, queue.image_seconds)
+    job.external_reference = reference
+    queue.add_job(job)
+    return {
+        "job_id": job.job_id,
+        "n_images": job.iterations,
+        "n_inferences": job.kwargs["n_inferences"],
+        "position": estimate["position"],
+        "estimated_start": estimate["start"],
+        "estimated_finish": estimate["finish"]
+    }
+
+def api_job_done(job_id:int, reference:RecordingReference) -> bool:
+    return client.sd_queue.get_job(job_id) == None and client.uploads.is_idle(reference)
+
+def api_stats() -> dict:
+    queue:MyQueue = client.sd_queue
+    return {
+        "jobs_queued": len(queue.jobs_by_id),
+        "image_steps_queued": queue.queued_cost(),
+        "images_done": sum(worker_status.images_done for worker_status in queue.workers_status),
+        "waits": queue.wait_stats(),
+        "uploads": client.uploads.stats()
+    }
+
 async def main_task(client:MyClient):
-    queue = MyQueue(generate_worker, get_worker_method)
+    # Images from different jobs sharing these settings can be
+    # generated in the same batch
+    batch_compatible_kwargs = ("width", "height", "n_inferences", "guidance_scale") if CROSS_JOB_BATCHING else None
+    queue = MyQueue(
+        generate_worker,
+        get_worker_method,
+        get_worker_batch_method,
+        batch_compatible_kwargs = batch_compatible_kwargs,
+        max_batch_images        = IMAGES_BATCH_SIZE if IMAGES_BATCH_SIZE > 0 else AUTO_BATCH_MAX_SIZE,
+        n_workers               = WORKERS_COUNT,
+        scheduling_policy       = create_scheduling_policy())
     client.sd_queue = queue
+    client.uploads = UploadQueue(
+        MyClient.send_followup,
+        max_message_bytes = DISCORD_MAX_UPLOAD_MB * 1024 * 1024,
+        max_concurrency   = UPLOADS_MAX_CONCURRENCY,
+        max_attempts      = UPLOADS_MAX_ATTEMPTS,
+        coalesce_delay    = UPLOADS_COALESCE_DELAY)
+
+    if METRICS_PORT:
+        await queue.metrics.serve(METRICS_HOST, METRICS_PORT)
+        print(f"Serving the metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    if SUBMIT_API_PORT:
+        await SubmitAPI(submit_api_job, api_job_done, api_stats).serve(SUBMIT_API_HOST, SUBMIT_API_PORT)
+        print(f"Accepting jobs on http://{SUBMIT_API_HOST}:{SUBMIT_API_PORT}/jobs")
+
+    if SERVING_API_ONLY:
+        await queue.main_task()
+        return
 
     await asyncio.gather(
         client.start(os.environ['DISCORD_TOKEN']),
@@ -428,9 +887,15 @@ if __name__ == "__main__":
     import pathlib
 
     dotenv.load_dotenv()
+    # python degu_diffusion_v0.py rebuild-index
+    # Adds the images of IMAGES_OUTPUT_DIRECTORY missing from the index, then quits.
+    REBUILDING_INDEX = sys.argv[1:] == ["rebuild-index"]
+    # python degu_diffusion_v0.py serve-api
+    # Accepts jobs from the local submission API only, without connecting to Discord.
+    SERVING_API_ONLY = sys.argv[1:] == ["serve-api"]
     required_environment_variables = [
         "DISCORD_TOKEN"
-    ]
+    ] if not (REBUILDING_INDEX or SERVING_API_ONLY) else []
 
     # Check if all vars are present
     missing_vars = []
@@ -445,8 +910,16 @@ if __name__ == "__main__":
     HUGGINGFACES_TOKEN              = os.environ.get('HUGGINGFACES_TOKEN', '')
     STABLEDIFFUSION_LOCAL_ONLY      = False if os.environ.get('STABLEDIFFUSION_LOCAL_ONLY', 'False').lower() != 'true' else True
     STABLEDIFFUSION_MODEL_NAME      = os.environ.get('STABLEDIFFUSION_MODEL_NAME', 'CompVis/stable-diffusion-v1-4')
+    # "fp32", "fp16", "bf16" or "auto" (the fastest one supported by each device)
+    STABLEDIFFUSION_MODE            = os.environ.get('STABLEDIFFUSION_MODE', 'auto').lower()
+    if STABLEDIFFUSION_MODE != AUTO_PRECISION and STABLEDIFFUSION_MODE not in PRECISIONS:
+        print(f"Unknown STABLEDIFFUSION_MODE {STABLEDIFFUSION_MODE}. Known modes : {AUTO_PRECISION}, {', '.join(PRECISIONS)}")
+        sys.exit(1)
+
+    # The stub workers generate placeholder images, without any model
+    USING_STUB_WORKERS              = os.environ.get('WORKERS_MODE', 'thread').lower() == "stub"
 
-    if (not HUGGINGFACES_TOKEN) and (not STABLEDIFFUSION_LOCAL_ONLY):
+    if (not HUGGINGFACES_TOKEN) and (not STABLEDIFFUSION_LOCAL_ONLY) and (not REBUILDING_INDEX) and (not USING_STUB_WORKERS):
         print(
             "At least, either :\n"+
             "* Set the HUGGINGFACES_TOKEN environment variable.\n"+
@@ -458,6 +931,12 @@ if __name__ == "__main__":
     SAVE_IMAGES_TO_DISK             = True if os.environ.get('SAVE_IMAGES_TO_DISK', 'True').lower() != 'false' else False
     OUTPUT_DIRECTORY                = os.environ.get('IMAGES_OUTPUT_DIRECTORY', 'generated') if SAVE_IMAGES_TO_DISK else ""
     STABLEDIFFUSION_CACHE_DIR       = os.environ.get('STABLEDIFFUSION_CACHE_DIR', '')
+    # Where single file checkpoints (./model.safetensors) are saved once converted.
+    # Set to an empty string to convert them on every start.
+    CONVERTED_MODELS_DIR            = os.environ.get('CONVERTED_MODELS_DIR', os.path.join(STABLEDIFFUSION_CACHE_DIR or 'stablediffusion_cache', 'converted'))
+    # Where TorchInductor keeps the compiled kernels, with ACCELERATION=compile.
+    # Set to an empty string to use its temporary directory.
+    COMPILE_CACHE_DIR               = os.environ.get('COMPILE_CACHE_DIR', os.path.join(STABLEDIFFUSION_CACHE_DIR or 'stablediffusion_cache', 'compiled'))
 
     if SAVE_IMAGES_TO_DISK:
         print(f"Images output directory set to : {OUTPUT_DIRECTORY}")
@@ -475,6 +954,92 @@ if __name__ == "__main__":
             pathlib.Path(dirpath).mkdir(parents = True)
 
     TORCH_DEVICE                    = os.environ.get('TORCH_DEVICE', 'cuda')
+    # Comma separated list of devices. Takes precedence over TORCH_DEVICE.
+    TORCH_DEVICES                   = [device.strip() for device in os.environ.get('TORCH_DEVICES', TORCH_DEVICE).split(',') if device.strip()]
+    if not TORCH_DEVICES:
+        TORCH_DEVICES = [TORCH_DEVICE]
+    # One worker per device, by default
+    WORKERS_COUNT                   = Helpers.env_var_to_int_clamped('WORKERS_COUNT', len(TORCH_DEVICES), 1, 64)
+    # "thread", "process" or "stub" (placeholder images, for load tests)
+    WORKERS_MODE                    = os.environ.get('WORKERS_MODE', 'thread').lower()
+    # Duration of a 512x512 denoising step of the stub workers
+    STUB_STEP_SECONDS               = Helpers.env_var_to_float_clamped('STUB_STEP_SECONDS', 0.01, 0, 10)
+    # 0 disables the cache
+    EMBEDDINGS_CACHE_MB             = Helpers.env_var_to_int('EMBEDDINGS_CACHE_MB', 64)
+    # Memory used to keep the last images generated from a known seed. 0 disables the cache.
+    RESULTS_CACHE_MB                = Helpers.env_var_to_int('RESULTS_CACHE_MB', 128)
+    # "full", "vae-slicing", "vae-tiling", "attention-slicing", "model-offload",
+    # "sequential-offload", or "auto" (the fastest one fitting in MEMORY_BUDGET_MB)
+    MEMORY_POLICY                   = os.environ.get('MEMORY_POLICY', 'full').lower()
+    if MEMORY_POLICY != AUTO_MEMORY_POLICY and MEMORY_POLICY not in MEMORY_POLICIES:
+        print(f"Unknown MEMORY_POLICY {MEMORY_POLICY}. Known policies : {AUTO_MEMORY_POLICY}, {', '.join(MEMORY_POLICIES)}")
+        sys.exit(1)
+    # Memory usable by each worker, in auto mode. 0 means 90% of the device memory.
+    MEMORY_BUDGET_MB                = Helpers.env_var_to_int_clamped('MEMORY_BUDGET_MB', 0, 0, 10000000)
+    # "none", "channels-last" or "compile" (channels-last and torch.compile,
+    # warmed up at IMAGES_WIDTH x IMAGES_HEIGHT before accepting jobs)
+    ACCELERATION                    = os.environ.get('ACCELERATION', 'none').lower()
+    if ACCELERATION not in ACCELERATIONS:
+        print(f"Unknown ACCELERATION {ACCELERATION}. Known accelerations : {', '.join(ACCELERATIONS)}")
+        sys.exit(1)
+    # Threads encoding and saving the images while the next ones are generated.
+    # 0 encodes them in the worker thread, right after their generation.
+    ENCODING_THREADS                = Helpers.env_var_to_int_clamped('ENCODING_THREADS', 2, 0, 32)
+    # Generated images waiting to be encoded, before the generation waits.
+    MAX_PENDING_ENCODES             = Helpers.env_var_to_int_clamped('MAX_PENDING_ENCODES', 8, 1, 256)
+    # Format of the saved images, and of the images sent to Discord.
+    # An empty DELIVERY_FORMAT sends the saved images as is.
+    ARCHIVE_FORMAT                  = os.environ.get('ARCHIVE_FORMAT', 'png')
+    DELIVERY_FORMAT                 = os.environ.get('DELIVERY_FORMAT', '')
+    for image_format in [ARCHIVE_FORMAT, DELIVERY_FORMAT]:
+        if image_format:
+            ImageEncoder.from_spec(image_format)
+    # SQLite database indexing the saved images metadata.
+    # Keep it on a local disk. Set it to an empty value to disable the index.
+    IMAGES_INDEX_FILEPATH           = os.environ.get('IMAGES_INDEX_FILEPATH', 'images_index.sqlite3') if SAVE_IMAGES_TO_DISK else ""
+    IMAGES_INDEX                    = ImagesIndex(IMAGES_INDEX_FILEPATH) if IMAGES_INDEX_FILEPATH else None
+
+    if REBUILDING_INDEX:
+        if not IMAGES_INDEX:
+            print("The images index is disabled. Set IMAGES_INDEX_FILEPATH and SAVE_IMAGES_TO_DISK.")
+            sys.exit(1)
+        print(f"Indexing the images of {OUTPUT_DIRECTORY} into {IMAGES_INDEX_FILEPATH}...")
+        added, failed = IMAGES_INDEX.rebuild(OUTPUT_DIRECTORY)
+        print(f"{added} images added, {failed} unreadable. {IMAGES_INDEX.count()} images indexed.")
+        sys.exit(0)
+
+    # 0 means "automatic", based on the available memory
+    IMAGES_BATCH_SIZE               = Helpers.env_var_to_int('IMAGES_BATCH_SIZE', 1)
+    CROSS_JOB_BATCHING              = True if os.environ.get('CROSS_JOB_BATCHING', 'True').lower() != 'false' else False
+    # Which job gets the next image : "fifo", "round-robin" (one image per job, in turn)
+    # or "fair" (weighted fair sharing between users)
+    SCHEDULING_POLICY               = os.environ.get('SCHEDULING_POLICY', 'fair').lower()
+    if SCHEDULING_POLICY not in SCHEDULING_POLICIES:
+        print(f"Unknown SCHEDULING_POLICY {SCHEDULING_POLICY}. Known policies : {', '.join(SCHEDULING_POLICIES)}")
+        sys.exit(1)
+    # "user_id:weight,user_id:weight". Users not listed have a weight of 1.
+    SCHEDULING_USER_WEIGHTS         = parse_user_weights(os.environ.get('SCHEDULING_USER_WEIGHTS', ''))
+    # Work waiting in the queue, in 512x512 denoising steps, before new jobs
+    # are reduced or refused. 0 means no limit.
+    MAX_QUEUED_IMAGE_STEPS          = Helpers.env_var_to_int_clamped('MAX_QUEUED_IMAGE_STEPS', 0, 0, 100000000)
+    MAX_QUEUED_IMAGE_STEPS_PER_USER = Helpers.env_var_to_int_clamped('MAX_QUEUED_IMAGE_STEPS_PER_USER', 0, 0, 100000000)
+    # Where the generation time of the previous images is kept.
+    # An empty value keeps them in memory only.
+    GENERATION_TIMINGS_FILEPATH     = os.environ.get('GENERATION_TIMINGS_FILEPATH', 'generation_timings.json')
+    # Comma separated Discord user identifiers allowed to use the admin commands.
+    # When empty, the server administrators are allowed.
+    ADMIN_USER_IDS                  = [int(user_id) for user_id in os.environ.get('ADMIN_USER_IDS', '').replace(' ', '').split(',') if user_id.isdigit()]
+    # Where /deguprofile writes the traces
+    PROFILES_DIRECTORY              = os.environ.get('PROFILES_DIRECTORY', 'profiles')
+    # Prometheus metrics endpoint. 0 disables it.
+    METRICS_PORT                    = Helpers.env_var_to_int_clamped('METRICS_PORT', 0, 0, 65535)
+    METRICS_HOST                    = os.environ.get('METRICS_HOST', '127.0.0.1')
+    # Local job submission API, for load tests. 0 disables it.
+    SUBMIT_API_PORT                 = Helpers.env_var_to_int_clamped('SUBMIT_API_PORT', 8642 if SERVING_API_ONLY else 0, 0, 65535)
+    SUBMIT_API_HOST                 = os.environ.get('SUBMIT_API_HOST', '127.0.0.1')
+    if SERVING_API_ONLY and not SUBMIT_API_PORT:
+        print("serve-api needs a SUBMIT_API_PORT")
+        sys.exit(1)
 
     # This tries to get the MAX_IMAGES_PER_JOB environment variable
     # If it exists, it retrieves it and try to parse it. On failure, it fallback to the number 64.
@@ -485,6 +1050,20 @@ if __name__ == "__main__":
     IMAGES_WIDTH                    = Helpers.env_var_to_int('IMAGES_WIDTH', 512)
     IMAGES_HEIGHT                   = Helpers.env_var_to_int('IMAGES_HEIGHT', 512)
     MAX_IMAGES_BEFORE_THREAD        = Helpers.env_var_to_int('MAX_IMAGES_BEFORE_THREAD', 2)
+    # Messages sent to Discord at the same time, all destinations included
+    UPLOADS_MAX_CONCURRENCY         = Helpers.env_var_to_int_clamped('UPLOADS_MAX_CONCURRENCY', 4, 1, 50)
+    # Attempts to send a message, before giving up
+    UPLOADS_MAX_ATTEMPTS            = Helpers.env_var_to_int_clamped('UPLOADS_MAX_ATTEMPTS', 4, 1, 20)
+    # Seconds waited for the next images, so that they're sent in the same message
+    UPLOADS_COALESCE_DELAY          = Helpers.env_var_to_float_clamped('UPLOADS_COALESCE_DELAY', 0.5, 0, 10)
+    # Maximum size of the images sent in one message
+    DISCORD_MAX_UPLOAD_MB           = Helpers.env_var_to_int_clamped('DISCORD_MAX_UPLOAD_MB', 10, 1, 500)
+    # Send the images of jobs needing a thread as grids of thumbnails.
+    # The full size images are still saved.
+    GRID_DELIVERY                   = True if os.environ.get('GRID_DELIVERY', 'False').lower() == 'true' else False
+    GRID_COLUMNS                    = Helpers.env_var_to_int_clamped('GRID_COLUMNS', 4, 1, 10)
+    GRID_ROWS                       = Helpers.env_var_to_int_clamped('GRID_ROWS', 4, 1, 10)
+    GRID_THUMBNAIL_SIZE             = Helpers.env_var_to_int_clamped('GRID_THUMBNAIL_SIZE', 256, 32, 1024)
     COMPACT_RESPONSES               = False if os.environ.get('COMPACT_RESPONSES', 'False').lower() != "true" else True
 
     # Default setup
@@ -0,0 +1,48 @@
+import os
+
+import torch
+
+# Accelerations of the UNet and of the VAE decoder, opt-in.
+#
+# * none          : Eager PyTorch.
+# * channels-last : The convolutions weights and activations are stored
+#                   in the channels last (NHWC) memory format, which the
+#                   oneDNN (CPU) and cuDNN (tensor cores) convolutions
+#                   prefer.
+# * compile       : channels-last, and both modules compiled with
+#                   torch.compile. Compiling takes a while, so the
+#                   worker generates warm-up images at the configured
+#                   resolutions before accepting jobs.
+#
+# Compiled kernels are cached by TorchInductor, in the compile cache
+# directory, so that following starts skip most of the compilation.
+
+ACCELERATIONS = ("none", "channels-last", "compile")
+
+def use_compile_cache(directory:str):
+    """Keep TorchInductor compiled artifacts in directory, instead of
+    a temporary directory. Nothing changes when directory is empty."""
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok = True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(directory)
+    # Only loaded when compiling. Slow to import, and missing from some builds.
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+
+def accelerate_pipeline(pipe, acceleration:str):
+    """Apply acceleration to the UNet and the VAE decoder of pipe, in place"""
+    if acceleration not in ACCELERATIONS:
+        raise ValueError(f"Unknown acceleration {acceleration}. Known accelerations : {', '.join(ACCELERATIONS)}")
+    if acceleration == "none":
+        return
+
+    modules = [getattr(pipe, "unet", None), getattr(getattr(pipe, "vae", None), "decoder", None)]
+    modules = [module for module in modules if isinstance(module, torch.nn.Module)]
+    for module in modules:
+        module.to(memory_format = torch.channels_last)
+    if acceleration == "compile":
+        # In place, so that the pipeline still sees the original modules
+        # and their configuration.
+        for module in modules:
+            module.compile()
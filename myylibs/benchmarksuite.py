@@ -0,0 +1,259 @@
+import asyncio
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import tempfile
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+import numpy
+from PIL import Image
+import torch
+
+from myylibs.jobsmanager import Job, JobQueue, percentile
+
+# Benchmarks of the image generation path, run by "sdworker.py benchmark".
+#
+# Each benchmark measures the latency of an operation, repeated, and
+# reports its percentiles, its throughput and the peak memory usage.
+# The results are saved as JSON, so that two runs can be compared with
+# "sdworker.py compare baseline.json current.json".
+
+BENCHMARK_PROMPT = "Degu enjoys its morning coffee by {random_artists}, {random_tags}"
+
+# Relative slowdown considered as a regression, by default
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+def peak_memory(torch_device:str) -> int:
+    """Highest memory usage since the last reset, in bytes.
+    Highest resident memory of the process, on CPU."""
+    if torch_device.startswith("cuda"):
+        return torch.cuda.max_memory_allocated(torch_device)
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak_memory(torch_device:str):
+    # The process peak resident memory can't be reset
+    if torch_device.startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats(torch_device)
+
+def latency_summary(latencies:list[float], items_per_call:int = 1) -> dict:
+    total = sum(latencies)
+    return {
+        "calls": len(latencies),
+        "items_per_call": items_per_call,
+        "mean": statistics.fmean(latencies) if latencies else 0,
+        "min": min(latencies, default=0),
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies, default=0),
+        "items_per_second": (len(latencies) * items_per_call / total) if total > 0 else 0,
+    }
+
+def measure(operation:Callable, calls:int, warmup:int = 1, items_per_call:int = 1) -> dict:
+    for _ in range(warmup):
+        operation()
+    latencies = []
+    for _ in range(calls):
+        began_at = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - began_at)
+    return latency_summary(latencies, items_per_call)
+
+def _resolved(results:list) -> list:
+    # Include the background encoding in the measures
+    return [result.result() if isinstance(result, Future) else result for result in results]
+
+class BenchmarkSuite:
+
+    def __init__(
+        self,
+        worker,
+        n_images:int = 8,
+        batch_size:int = 4,
+        n_inferences:int = 10,
+        width:int = 64,
+        height:int = 64,
+        tags_calls:int = 2000):
+        self.worker = worker
+        self.torch_device:str = str(worker.torch_device)
+        self.n_images:int = max(1, n_images)
+        self.batch_size:int = max(1, batch_size)
+        self.n_inferences:int = n_inferences
+        self.width:int = width
+        self.height:int = height
+        self.tags_calls:int = tags_calls
+        self.generation_kwargs:dict = {
+            "prompt": BENCHMARK_PROMPT,
+            "n_inferences": n_inferences,
+            "guidance_scale": 7.5,
+            # Random seeds, so that the results cache never answers
+            "deterministic": True,
+            "width": width,
+            "height": height,
+        }
+
+    def metadata(self) -> dict:
+        return {
+            "model_name": str(self.worker.model_name),
+            "torch_device": self.torch_device,
+            "dtype": str(getattr(self.worker, "dtype", "")),
+            "precision": str(getattr(self.worker, "precision", "")),
+            "memory_policy": str(getattr(self.worker, "memory_policy_setting", "")),
+            "acceleration": str(getattr(self.worker, "acceleration", "")),
+            "warmup_seconds": getattr(self.worker, "warmup_seconds", 0),
+            "n_images": self.n_images,
+            "batch_size": self.batch_size,
+            "n_inferences": self.n_inferences,
+            "width": self.width,
+            "height": self.height,
+            "special_tags": len(self.worker.replacers or {}),
+            "torch_version": torch.__version__,
+            "python_version": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+
+    def _run(self, name:str, benchmark:Callable) -> dict:
+        print(f"Running {name}...", flush=True)
+        reset_peak_memory(self.torch_device)
+        result = benchmark()
+        result["peak_memory_bytes"] = peak_memory(self.torch_device)
+        print(
+            f"  p50 {result['p50'] * 1e3:.2f} ms, p90 {result['p90'] * 1e3:.2f} ms, "
+            f"{result['items_per_second']:.2f} items/s, peak memory {result['peak_memory_bytes'] / (1024 * 1024):.0f} MiB",
+            flush=True)
+        return result
+
+    def run(self, only:list[str] = None) -> dict:
+        """only, when set, names the benchmarks to run"""
+        benchmarks = {
+            "replace_special_tags": self.bench_special_tags,
+            "generate_image": self.bench_generate_image,
+            "generate_batch": self.bench_generate_batch,
+            "encode_save": self.bench_encode_save,
+            "job_queue": self.bench_job_queue,
+        }
+        return {
+            "metadata": self.metadata(),
+            "benchmarks": {
+                name: self._run(name, benchmark)
+                for name, benchmark in benchmarks.items()
+                if not only or name in only},
+        }
+
+    def bench_special_tags(self) -> dict:
+        return measure(
+            lambda: self.worker.replace_special_tags(BENCHMARK_PROMPT, self.worker.replacers),
+            calls = self.tags_calls,
+            warmup = 10)
+
+    def bench_generate_image(self) -> dict:
+        return measure(
+            lambda: self.worker.generate_image(**self.generation_kwargs),
+            calls = self.n_images)
+
+    def bench_generate_batch(self) -> dict:
+        n_batches = max(1, self.n_images // self.batch_size)
+        return measure(
+            lambda: _resolved(self.worker.generate_batch(self.batch_size, **self.generation_kwargs)),
+            calls = n_batches,
+            items_per_call = self.batch_size)
+
+    def bench_encode_save(self) -> dict:
+        # Noise compresses badly, like detailed generated images
+        pixels = numpy.random.default_rng(1234).integers(0, 256, (self.height, self.width, 3), dtype=numpy.uint8)
+        image = Image.fromarray(pixels)
+        metadata = self.worker._image_metadata(BENCHMARK_PROMPT, 1234, 7.5, self.n_inferences, 1234)
+        encoder = self.worker.archive_encoder
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, f"benchmark{encoder.extension}")
+            def encode_and_save():
+                encoder.encode(image, metadata, filepath)
+                encoder.encode(image, metadata, io.BytesIO())
+            return measure(encode_and_save, calls = max(20, self.n_images))
+
+    def bench_job_queue(self) -> dict:
+        """Jobs going through the JobQueue, to a stub client recording
+        when each image is delivered. The latencies are the jobs
+        completion times."""
+        n_jobs = max(2, self.n_images // 2)
+        delivered:dict[Job, list[float]] = {}
+
+        queue = JobQueue(
+            lambda index: self.worker,
+            lambda worker: worker.generate_image,
+            lambda worker: worker.generate_batch,
+            ("width", "height", "n_inferences", "guidance_scale"),
+            self.batch_size)
+        for status in queue.report_handlers:
+            queue.report_handlers[status] = lambda job, report: None
+        queue.report_handlers["Progress"] = lambda job, report: delivered.setdefault(job, []).append(time.monotonic())
+        queue.report_handlers["Failed"] = lambda job, report: print(f"  Job {job.job_id} failed : {report.result}")
+
+        async def run_jobs() -> tuple[list[float], float]:
+            main_task = asyncio.ensure_future(queue.main_task())
+            while any(worker_status.state == "Starting" for worker_status in queue.workers_status):
+                await asyncio.sleep(0.01)
+
+            jobs = [
+                Job(None, iterations = 2, kwargs = dict(self.generation_kwargs), user_id = index % 3)
+                for index in range(n_jobs)]
+            started_at = time.monotonic()
+            queue.add_jobs(jobs)
+            while queue.jobs_by_id:
+                await asyncio.sleep(0.005)
+            total = time.monotonic() - started_at
+
+            queue._bailing_out()
+            main_task.cancel()
+            completions = [max(delivered.get(job, [started_at])) - started_at for job in jobs]
+            return completions, total
+
+        completions, total = asyncio.run(run_jobs())
+        result = latency_summary(completions, items_per_call = 2)
+        # The jobs run concurrently. Use the wall clock time.
+        result["items_per_second"] = sum(len(times) for times in delivered.values()) / total if total > 0 else 0
+        return result
+
+def save_results(results:dict, filepath:str):
+    with open(filepath, "w", encoding="utf-8") as results_file:
+        json.dump(results, results_file, indent=1)
+
+def load_results(filepath:str) -> dict:
+    with open(filepath, "r", encoding="utf-8") as results_file:
+        return json.load(results_file)
+
+def compare_results(baseline:dict, current:dict, threshold:float = DEFAULT_REGRESSION_THRESHOLD) -> list[str]:
+    """Print the differences between two runs.
+    Returns the benchmarks that regressed by more than threshold."""
+    regressions = []
+    for key in ("model_name", "torch_device", "dtype", "precision", "memory_policy", "acceleration", "width", "height", "n_inferences", "batch_size", "special_tags"):
+        before, after = baseline["metadata"].get(key), current["metadata"].get(key)
+        if before != after:
+            print(f"Warning : {key} differs ({before} -> {after}). The results may not be comparable.")
+
+    print(f"{'Benchmark':<22} {'p50 before':>11} {'p50 after':>11} {'Change':>8} {'Items/s before':>15} {'Items/s after':>14} {'Change':>8}")
+    for name, after in current["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before == None:
+            print(f"{name:<22} (new)")
+            continue
+
+        latency_change = (after["p50"] / before["p50"] - 1) if before["p50"] else 0
+        throughput_change = (after["items_per_second"] / before["items_per_second"] - 1) if before["items_per_second"] else 0
+        regressed = latency_change > threshold or throughput_change < -threshold
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:<22} {before['p50'] * 1e3:>9.2f}ms {after['p50'] * 1e3:>9.2f}ms {latency_change:>+7.1%} "
+            f"{before['items_per_second']:>15.2f} {after['items_per_second']:>14.2f} {throughput_change:>+7.1%}"
+            + ("  REGRESSION" if regressed else ""))
+    return regressions
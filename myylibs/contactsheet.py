@@ -0,0 +1,71 @@
+import io
+
+from PIL import Image, ImageDraw
+
+# Grids of thumbnails, labelled, built one image at a time.
+# Used to send the results of big jobs in a few messages,
+# instead of one message per image.
+
+LABEL_HEIGHT = 14
+LABEL_BACKGROUND = (0, 0, 0)
+LABEL_COLOR = (255, 255, 255)
+SHEET_BACKGROUND = (32, 32, 32)
+
+class ContactSheet:
+    """A columns x rows grid of thumbnails.
+    Each thumbnail is pasted as soon as it is added."""
+
+    def __init__(self, columns:int = 4, rows:int = 4, cell_size:int = 256):
+        self.columns:int = max(1, columns)
+        self.rows:int = max(1, rows)
+        self.cell_size:int = max(16, cell_size)
+        self.labels:list[str] = []
+        self.sheet:Image.Image = None
+
+    def capacity(self) -> int:
+        return self.columns * self.rows
+
+    def is_full(self) -> bool:
+        return len(self.labels) >= self.capacity()
+
+    def is_empty(self) -> bool:
+        return not self.labels
+
+    def add(self, image:Image.Image, label:str = ""):
+        if self.is_full():
+            raise ValueError("The contact sheet is full")
+
+        if self.sheet == None:
+            self.sheet = Image.new("RGB", (self.columns * self.cell_size, self.rows * self.cell_size), SHEET_BACKGROUND)
+
+        index = len(self.labels)
+        left = (index % self.columns) * self.cell_size
+        top = (index // self.columns) * self.cell_size
+
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail((self.cell_size, self.cell_size))
+        # Centered in its cell
+        self.sheet.paste(thumbnail, (
+            left + (self.cell_size - thumbnail.width) // 2,
+            top + (self.cell_size - thumbnail.height) // 2))
+
+        if label:
+            draw = ImageDraw.Draw(self.sheet)
+            label_top = top + self.cell_size - LABEL_HEIGHT
+            draw.rectangle((left, label_top, left + self.cell_size - 1, top + self.cell_size - 1), fill=LABEL_BACKGROUND)
+            # Cut labels too long for the cell
+            text = label
+            while len(text) > 1 and draw.textlength(text) > self.cell_size - 6:
+                text = text[:-1]
+            draw.text((left + 3, label_top + 2), text, fill=LABEL_COLOR)
+
+        self.labels.append(label)
+
+    def render(self, image_format:str = "JPEG", quality:int = 90) -> io.BytesIO:
+        """The sheet, cropped to the rows used, encoded in a buffer"""
+        used_rows = (len(self.labels) + self.columns - 1) // self.columns
+        sheet = self.sheet.crop((0, 0, self.sheet.width, used_rows * self.cell_size))
+        data = io.BytesIO()
+        sheet.save(data, format=image_format, quality=quality)
+        data.seek(0)
+        return data
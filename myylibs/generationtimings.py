@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+
+# Seconds needed to generate one image, learnt from the previous
+# generations, for each (inferences, width, height, model) combination.
+# Used to estimate when queued jobs will start and finish.
+#
+# Unknown combinations are estimated from the known ones, assuming
+# the time grows with the number of steps and of pixels. Before any
+# generation, default_step_seconds (for one 512x512 step) is used.
+
+REFERENCE_PIXELS = 512 * 512
+
+def timings_key(n_inferences:int, width:int, height:int, model_name:str) -> tuple:
+    return (int(n_inferences), int(width), int(height), str(model_name))
+
+def _steps(key:tuple) -> float:
+    """Work of one image, in 512x512 steps"""
+    n_inferences, width, height, _ = key
+    return max(1, n_inferences) * width * height / REFERENCE_PIXELS
+
+class GenerationTimings:
+
+    def __init__(self, default_step_seconds:float = 0.1, smoothing:float = 0.2, filepath:str = ""):
+        """smoothing is the weight of the last measure in the moving
+        averages. filepath, when set, is where the timings are loaded
+        from and saved to."""
+        self.default_step_seconds:float = default_step_seconds
+        self.smoothing:float = min(1, max(0.01, smoothing))
+        self.filepath:str = filepath
+        # key : (Average seconds per image, measures)
+        self.image_seconds:dict[tuple, tuple[float, int]] = {}
+        self.lock = threading.Lock()
+        # Saves can run from several threads. One writer at a time.
+        self.save_lock = threading.Lock()
+        if filepath:
+            self.load()
+
+    def record(self, key:tuple, seconds_per_image:float):
+        if seconds_per_image <= 0:
+            return
+        with self.lock:
+            average, measures = self.image_seconds.get(key, (seconds_per_image, 0))
+            average += self.smoothing * (seconds_per_image - average)
+            self.image_seconds[key] = (average, measures + 1)
+
+    def seconds_per_step(self) -> float:
+        """Average time of a 512x512 step, over every known combination"""
+        with self.lock:
+            known = list(self.image_seconds.items())
+        if not known:
+            return self.default_step_seconds
+        total_steps = sum(_steps(key) * measures for key, (_, measures) in known)
+        total_seconds = sum(average * measures for _, (average, measures) in known)
+        return total_seconds / total_steps
+
+    def seconds_per_image(self, key:tuple) -> float:
+        with self.lock:
+            known = self.image_seconds.get(key)
+        if known != None:
+            return known[0]
+        return self.seconds_per_step() * _steps(key)
+
+    def load(self):
+        try:
+            with open(self.filepath, "r", encoding="utf-8") as timings_file:
+                saved = json.load(timings_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Could not load the generation timings from {self.filepath} : {e}")
+            return
+
+        with self.lock:
+            for entry in saved:
+                try:
+                    key = timings_key(entry["n_inferences"], entry["width"], entry["height"], entry["model_name"])
+                    self.image_seconds[key] = (float(entry["seconds"]), int(entry["measures"]))
+                except (KeyError, TypeError, ValueError):
+                    continue
+
+    def save(self):
+        if not self.filepath:
+            return
+        with self.lock:
+            saved = [
+                {
+                    "n_inferences": n_inferences,
+                    "width": width,
+                    "height": height,
+                    "model_name": model_name,
+                    "seconds": average,
+                    "measures": measures
+                }
+                for (n_inferences, width, height, model_name), (average, measures) in self.image_seconds.items()]
+
+        # Never leave a half written file behind
+        temporary_filepath = f"{self.filepath}.tmp"
+        with self.save_lock:
+            try:
+                with open(temporary_filepath, "w", encoding="utf-8") as timings_file:
+                    json.dump(saved, timings_file, indent=1)
+                os.replace(temporary_filepath, self.filepath)
+            except OSError as e:
+                print(f"Could not save the generation timings to {self.filepath} : {e}")
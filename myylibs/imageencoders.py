@@ -0,0 +1,117 @@
+import io
+import json
+import os
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from myylibs.pngchunks import PNGChunkError, read_png_text_chunks
+
+# Encoders used to write the generated images.
+# Formats are described with short strings, like "png", "png:9",
+# "webp-lossless", "webp:90" or "jpeg:92". The optional number is
+# the compression level (PNG) or the quality (JPEG, WebP).
+#
+# PNG files carry the AI_* metadata as text chunks.
+# JPEG and WebP files carry them as JSON, in the EXIF ImageDescription
+# tag, since they have no text chunks.
+
+# EXIF ImageDescription
+EXIF_METADATA_TAG = 0x010E
+
+# Metadata values that can contain any character
+PNG_INTERNATIONAL_KEYS = ("AI_Prompt", "AI_Prompt_Negative")
+
+class ImageEncoder:
+    """Encodes PIL images, with their metadata, in a given format"""
+
+    FORMATS = {
+        # name : (PIL format, extension, level option, default level, min level, max level)
+        "png":           ("PNG",  ".png",  "compress_level", 6,  0, 9),
+        "webp-lossless": ("WEBP", ".webp", "quality",        80, 0, 100),
+        "webp":          ("WEBP", ".webp", "quality",        90, 1, 100),
+        "jpeg":          ("JPEG", ".jpg",  "quality",        92, 1, 95),
+    }
+
+    def __init__(self, name:str = "png", level:int = None):
+        if name == "jpg":
+            name = "jpeg"
+        if name not in ImageEncoder.FORMATS:
+            raise ValueError(f"Unknown image format {name}. Known formats : {', '.join(ImageEncoder.FORMATS)}")
+
+        pil_format, extension, level_option, default_level, min_level, max_level = ImageEncoder.FORMATS[name]
+        if level == None:
+            level = default_level
+        if not (min_level <= level <= max_level):
+            raise ValueError(f"The {name} level must be between {min_level} and {max_level}. Got {level}")
+
+        self.name:str = name
+        self.level:int = level
+        self.pil_format:str = pil_format
+        self.extension:str = extension
+        self.save_options:dict = {level_option: level}
+        if name == "webp-lossless":
+            self.save_options["lossless"] = True
+
+    @staticmethod
+    def from_spec(spec:str) -> "ImageEncoder":
+        """Parse a format description, like "png:9" or "jpeg:92" """
+        name, _, level = spec.strip().lower().partition(":")
+        if not level:
+            return ImageEncoder(name)
+        try:
+            return ImageEncoder(name, int(level))
+        except ValueError as e:
+            raise ValueError(f"Invalid image format {spec} : {e}")
+
+    def __str__(self) -> str:
+        return f"{self.name}:{self.level}"
+
+    def encode(self, image:Image.Image, metadata:dict, output):
+        """Write the image to output, which can be a filepath
+        or a file object."""
+        options = dict(self.save_options)
+        if self.pil_format == "PNG":
+            png_info = PngInfo()
+            for key, value in metadata.items():
+                if key in PNG_INTERNATIONAL_KEYS:
+                    png_info.add_itxt(key, value, lang="utf8", tkey=key)
+                else:
+                    png_info.add_text(key, value)
+            options["pnginfo"] = png_info
+        else:
+            exif = Image.Exif()
+            # EXIF strings are ASCII only
+            exif[EXIF_METADATA_TAG] = json.dumps(metadata, ensure_ascii=True)
+            options["exif"] = exif.tobytes()
+
+        if self.pil_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        image.save(output, format=self.pil_format, **options)
+
+def read_image_metadata(source) -> dict:
+    """AI_* metadata of an image written by an ImageEncoder.
+    source can be a filepath, bytes or a binary file object."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+
+    # PNG text chunks are read without decoding the image
+    start = None if isinstance(source, (str, os.PathLike)) else source.tell()
+    try:
+        return read_png_text_chunks(source)
+    except PNGChunkError:
+        if start != None:
+            source.seek(start)
+
+    with Image.open(source) as image:
+        description = image.getexif().get(EXIF_METADATA_TAG)
+        if not description:
+            return {}
+        try:
+            metadata = json.loads(description)
+        except ValueError:
+            return {}
+        if not isinstance(metadata, dict):
+            return {}
+        return {str(key): str(value) for key, value in metadata.items()}
@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from myylibs.imageencoders import ImageEncoder, read_image_metadata
+
+# Index of the generated images metadata, in a local SQLite database.
+# Images are identified by their filename without extension, so that
+# an image sent in another format than the saved one can be found.
+#
+# The database uses the WAL journal, so that the bot can read it while
+# the workers (threads or processes) write into it.
+# Keep it on a local disk : WAL doesn't work on network file systems.
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name           TEXT PRIMARY KEY,
+    filepath       TEXT NOT NULL,
+    seed           TEXT,
+    prompt         TEXT,
+    guidance_scale REAL,
+    n_inferences   INTEGER,
+    model_name     TEXT,
+    created_at     REAL,
+    metadata       TEXT NOT NULL
+)
+"""
+
+# Number of images inserted between two commits, when rebuilding
+REBUILD_COMMIT_EVERY = 500
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class ImagesIndex:
+    """Metadata of the generated images, searchable by filename.
+    Can be shared between threads."""
+
+    def __init__(self, db_filepath:str):
+        self.db_filepath:str = db_filepath
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_filepath, check_same_thread=False, timeout=30)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Safe with WAL. Only the last commits can be lost on power loss.
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(INDEX_SCHEMA)
+            self.connection.commit()
+
+    @staticmethod
+    def image_name(filename:str) -> str:
+        return os.path.splitext(os.path.basename(filename))[0]
+
+    def _insert(self, filepath:str, metadata:dict, created_at:float):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                ImagesIndex.image_name(str(filepath)),
+                str(filepath),
+                metadata.get("AI_Torch_Seed"),
+                metadata.get("AI_Prompt"),
+                _to_float(metadata.get("AI_StableDiffusion_Guidance_Scale")),
+                _to_int(metadata.get("AI_StableDiffusion_Inferences")),
+                metadata.get("AI_StableDiffusion_Model_Name"),
+                created_at,
+                json.dumps(metadata)
+            ))
+
+    def add(self, filepath:str, metadata:dict):
+        with self.lock:
+            self._insert(filepath, metadata, time.time())
+            self.connection.commit()
+
+    def lookup(self, filename:str) -> dict:
+        """Metadata of the image, or None when it isn't indexed"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT metadata FROM images WHERE name = ?",
+                (ImagesIndex.image_name(filename),)).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
+
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def rebuild(self, images_directory:str) -> tuple[int, int]:
+        """Add the images of images_directory missing from the index.
+        Returns the number of images added, and the number of files
+        that could not be read."""
+        extensions = {extension for _, extension, *_ in ImageEncoder.FORMATS.values()}
+        with self.lock:
+            known_names = {row[0] for row in self.connection.execute("SELECT name FROM images")}
+
+        added = 0
+        failed = 0
+        with os.scandir(images_directory) as entries:
+            for entry in entries:
+                name, extension = os.path.splitext(entry.name)
+                if extension.lower() not in extensions or name in known_names or not entry.is_file():
+                    continue
+
+                try:
+                    metadata = read_image_metadata(entry.path)
+                    created_at = entry.stat().st_mtime
+                except Exception as e:
+                    print(f"[ImagesIndex] Could not read {entry.path} : {e}")
+                    failed += 1
+                    continue
+
+                with self.lock:
+                    self._insert(entry.path, metadata, created_at)
+                    added += 1
+                    if added % REBUILD_COMMIT_EVERY == 0:
+                        self.connection.commit()
+                known_names.add(name)
+
+        with self.lock:
+            self.connection.commit()
+        return added, failed
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
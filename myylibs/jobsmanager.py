@@ -1,4 +1,9 @@
 import asyncio
+from collections import deque
+from concurrent.futures import Future
+import copy
+import itertools
+import math
 from typing import Callable
 import background
 import random
@@ -7,10 +12,139 @@ import traceback
 import threading
 import time
 
+# Job kwargs that can differ between the images of a micro batch.
+# The other ones are shared by the whole batch.
+PER_IMAGE_KWARGS = ("prompt", "deterministic")
+
 class StatusReport:
-    def __init__(self, status:str, result):
+    def __init__(self, status:str, result, timings:dict = None):
         self.status = status
         self.result = result
+        # Durations of the work reported, in seconds, by stage name
+        self.timings:dict = {} if timings == None else timings
+
+class WorkerStatus:
+    """Health and utilization of one worker of the pool.
+    Updated by the worker thread, read from anywhere."""
+
+    def __init__(self, index:int):
+        self.index:int = index
+        self.state:str = "Starting"
+        self.worker = None
+        self.images_done:int = 0
+        self.batches_done:int = 0
+        self.failures:int = 0
+        self.busy_seconds:float = 0
+        self.started_at:float = time.monotonic()
+        # Functions to call with the worker, from its thread, between two batches
+        self.pending_calls:deque[Callable] = deque()
+        self.last_error:str = ""
+
+    def utilization(self) -> float:
+        uptime = time.monotonic() - self.started_at
+        if uptime <= 0:
+            return 0
+        return min(1, self.busy_seconds / uptime)
+
+    def __str__(self) -> str:
+        return (
+            f"Worker {self.index} : {self.state}, "
+            f"{self.images_done} images, "
+            f"{self.utilization() * 100:.1f}% busy"
+            + (f", last error : {self.last_error}" if self.last_error else ""))
+
+def percentile(values:list[float], percent:float) -> float:
+    """Nearest rank percentile. 0 when values is empty."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def job_cost(job, n_images:int = 1) -> float:
+    """Work needed to generate n_images of a job, in 512x512 image-steps"""
+    kwargs = job.kwargs
+    pixels = kwargs.get("width", 512) * kwargs.get("height", 512)
+    return n_images * kwargs.get("n_inferences", 1) * pixels / (512 * 512)
+
+class SchedulingPolicy:
+    """Decides which job gets the next image generated.
+    This one serves the jobs in their arrival order (FIFO).
+
+    order() must not change the policy state. charge() is called every
+    time an image of a job is scheduled. Both are called with the
+    queue lock held.
+    Policies are copied to estimate the jobs waiting times. Their state
+    must be copyable with copy.deepcopy."""
+
+    name = "fifo"
+
+    def order(self, jobs:list) -> list:
+        return list(jobs)
+
+    def charge(self, job, n_images:int = 1):
+        pass
+
+    def forget(self, job):
+        pass
+
+class RoundRobinPolicy(SchedulingPolicy):
+    """One image per job, in turn"""
+
+    name = "round-robin"
+
+    def __init__(self):
+        self.turn:int = 0
+        self.last_turns:dict[int, int] = {}
+
+    def order(self, jobs:list) -> list:
+        # Jobs never served come first, in their arrival order
+        return sorted(jobs, key=lambda job: self.last_turns.get(job.job_id, -1))
+
+    def charge(self, job, n_images:int = 1):
+        self.turn += 1
+        self.last_turns[job.job_id] = self.turn
+
+    def forget(self, job):
+        self.last_turns.pop(job.job_id, None)
+
+class WeightedFairPolicy(SchedulingPolicy):
+    """Weighted fair queuing between users (start-time fair queuing).
+
+    Each user accumulates a virtual time : the cost of the images
+    generated for them, divided by their weight. The user with the
+    lowest virtual time gets the next image. Users coming back after
+    a while start at the current virtual time, so they can't claim
+    the time they were away.
+    A user's jobs are served in their arrival order."""
+
+    name = "fair"
+
+    def __init__(self, user_weights:dict = None, default_weight:float = 1.0):
+        self.user_weights:dict = dict(user_weights or {})
+        self.default_weight:float = default_weight
+        self.virtual_times:dict = {}
+        self.system_time:float = 0
+
+    def weight(self, user_id) -> float:
+        return max(0.01, self.user_weights.get(user_id, self.default_weight))
+
+    def _start_time(self, user_id) -> float:
+        return max(self.virtual_times.get(user_id, 0), self.system_time)
+
+    def order(self, jobs:list) -> list:
+        return sorted(jobs, key=lambda job: self._start_time(job.user_id))
+
+    def charge(self, job, n_images:int = 1):
+        start_time = self._start_time(job.user_id)
+        self.system_time = start_time
+        self.virtual_times[job.user_id] = start_time + job_cost(job, n_images) / self.weight(job.user_id)
+
+SCHEDULING_POLICIES = {
+    SchedulingPolicy.name:   SchedulingPolicy,
+    RoundRobinPolicy.name:   RoundRobinPolicy,
+    WeightedFairPolicy.name: WeightedFairPolicy,
+}
 
 class A:
 
@@ -20,6 +154,9 @@ class A:
 
 class Job:
 
+    # Jobs identifiers, unique for the whole process
+    _ids = itertools.count(1)
+
     @staticmethod
     def _dummy_method(*args, **kwargs):
         print("You didn't setup the method, you dummy !")
@@ -30,8 +167,12 @@ class Job:
         log:list[StatusReport]=None,
         args:list=None,
         kwargs:dict=None,
-        iterations:int=1):
+        iterations:int=1,
+        user_id=None):
         
+        self.job_id:int = next(Job._ids)
+        # Who asked for this job. Used to cancel all the jobs of a user.
+        self.user_id = user_id
         self.external_reference = external_reference
         self.read_until:int = 0
         # FIXME : Generate afterwards, from the worker thread
@@ -41,6 +182,43 @@ class Job:
         self.args:list = [] if args == None else args
         self.kwargs:dict = {} if kwargs == None else kwargs
         self.iterations:int = iterations
+        # Scheduling state, updated by the worker thread
+        self.scheduled:int = 0
+        self.completed:int = 0
+        self.started:bool = False
+        self.finished:bool = False
+        # Results generated but not reported yet, in order
+        self.pending_results:deque = deque()
+        # Called, from the worker thread, every time a report is added
+        self.on_report:Callable = None
+        # Timings, from the event loop point of view
+        self.queued_at:float = None
+        self.first_result_at:float = None
+
+    def add_report(self, status:str, result, timings:dict = None):
+        self.log.append(StatusReport(status, result, timings))
+        if self.on_report:
+            self.on_report()
+
+    def add_result_report(self, result):
+        """Progress report, carrying the result stage timings, if any"""
+        timings = result.get("timings") if isinstance(result, dict) else None
+        self.add_report("Progress", result, timings)
+
+    def add_starting_report(self):
+        timings = None
+        if self.queued_at != None:
+            timings = {"queue_wait": time.monotonic() - self.queued_at}
+        self.add_report("Starting", None, timings)
+
+    def remaining_to_schedule(self) -> int:
+        return self.iterations - self.scheduled
+
+    def batch_key(self, compatible_kwargs:tuple) -> tuple:
+        """Images from jobs sharing the same key can be generated together"""
+        if compatible_kwargs == None:
+            return (id(self),)
+        return tuple(self.kwargs.get(name) for name in compatible_kwargs)
 
     def read_next(self) -> StatusReport:
         result = None
@@ -54,22 +232,34 @@ class Job:
         return self.read_until < len(self.log)
 
     def execute(self, method, state) -> list:
-        self.log.append(StatusReport("Starting", None))
+        """Run the job iterations, one image at a time.
+        Batches are generated by JobQueue._execute_micro_batch instead."""
+        self.started = True
+        self.add_starting_report()
         if self.iterations < 0:
             self.iterations = 0
 
         try:
             for _ in range(0, self.iterations):
+                # Canceled
+                if self.finished:
+                    return self.log
+
                 result = method(*self.args, **self.kwargs)
-                self.log.append(StatusReport("Progress", result))
+                if isinstance(result, Future):
+                    result = result.result()
+                self.add_result_report(result)
                 # FIXME Find a better way than leaking internals from upper layers
                 if not state["queue_running"]:
-                    self.log.append(StatusReport("Canceled", ""))
+                    self.add_report("Canceled", "")
                     return
         except Exception as e:
-            self.log.append(StatusReport("Failed", str(e)))
+            if self.finished:
+                return self.log
+            self.add_report("Failed", str(e))
             print(e)
-        self.log.append(StatusReport("Finished", None))
+        if not self.finished:
+            self.add_report("Finished", None)
         return self.log
 
 
@@ -92,10 +282,63 @@ class JobQueue:
 
     def is_done_report(self, report:StatusReport) -> bool:
         status = report.status
-        return status == "Finished" or status == "Failed"
+        return status == "Finished" or status == "Failed" or status == "Canceled"
+
+    def _job_done(self, job:Job, report:StatusReport):
+        if job in self.running_jobs:
+            self.running_jobs.remove(job)
+        self._unregister_job(job)
+        with self.jobs_available:
+            self.scheduling_policy.forget(job)
+
+        if report.status == "Finished" and job.queued_at != None:
+            now = time.monotonic()
+            self.completion_waits.append(now - job.queued_at)
+            if job.first_result_at != None:
+                self.first_result_waits.append(job.first_result_at - job.queued_at)
+
+    def _register_job(self, job:Job):
+        self.jobs_by_id[job.job_id] = job
+        self.jobs_by_user.setdefault(job.user_id, {})[job.job_id] = job
+
+    def _unregister_job(self, job:Job):
+        self.jobs_by_id.pop(job.job_id, None)
+        user_jobs = self.jobs_by_user.get(job.user_id)
+        if user_jobs != None:
+            user_jobs.pop(job.job_id, None)
+            if not user_jobs:
+                del self.jobs_by_user[job.user_id]
+
+    def get_job(self, job_id:int) -> Job:
+        return self.jobs_by_id.get(job_id)
+
+    def user_jobs(self, user_id) -> list[Job]:
+        return list(self.jobs_by_user.get(user_id, {}).values())
+
+    def cancel_job(self, job_id:int) -> bool:
+        """Cancel a queued or running job. A running job stops at the
+        next denoising step, when the worker supports it.
+        Must be called from the event loop thread."""
+        job = self.get_job(job_id)
+        if job == None:
+            return False
+
+        if job in self.to_do:
+            # Never handed to the workers
+            self.to_do.remove(job)
+            self.handle_report(job, StatusReport("Canceled", ""))
+            self._unregister_job(job)
+            return True
+
+        with self.jobs_available:
+            if job.finished:
+                return False
+            JobQueue._finish_job(job, self.in_progress, "Canceled", "")
+        return True
 
-    def _current_job_done(self):
-        self.current_job = None
+    def cancel_user_jobs(self, user_id) -> int:
+        """Cancel every job of a user. Returns the number of jobs canceled."""
+        return sum(self.cancel_job(job.job_id) for job in self.user_jobs(user_id))
 
     def handle_report(self, job:Job, report:StatusReport):
         if job == None or report == None:
@@ -112,6 +355,9 @@ class JobQueue:
             print("Can't handle status report of type %s" % (status))
             return
 
+        if status == "Progress" and job.first_result_at == None:
+            job.first_result_at = time.monotonic()
+
         try:
             self.report_handlers[status](job, report)
         except Exception as e:
@@ -119,32 +365,290 @@ class JobQueue:
             print(traceback.print_exception(e))
 
         if self.is_done_report(report):
-            self._current_job_done()
+            self._job_done(job, report)
+
+    @staticmethod
+    def _next_micro_batch(jobs:list[Job], compatible_kwargs:tuple, max_images:int, policy:SchedulingPolicy = None) -> list[Job]:
+        """Select the next images to generate together.
+
+        The batch is filled one image at a time, each image going to the
+        first job in the policy order. The first image determines the
+        batch key. Only images from compatible jobs fill the rest of
+        the batch.
+        Returns one job per image, each job images being contiguous.
+        """
+        if policy == None:
+            policy = SchedulingPolicy()
+
+        candidates:list[Job] = []
+        for job in list(jobs):
+            if job.iterations <= 0:
+                job.started = True
+                job.add_starting_report()
+                JobQueue._finish_job(job, jobs, "Finished", None)
+                continue
+
+            if job.remaining_to_schedule() > 0:
+                candidates.append(job)
+
+        scheduled:dict[Job, int] = {}
+        key = None
+        while candidates and sum(scheduled.values()) < max_images:
+            job = policy.order(candidates)[0]
+            if key == None:
+                key = job.batch_key(compatible_kwargs)
+                candidates = [candidate for candidate in candidates if candidate.batch_key(compatible_kwargs) == key]
+
+            job.scheduled += 1
+            scheduled[job] = scheduled.get(job, 0) + 1
+            policy.charge(job)
+            if job.remaining_to_schedule() <= 0:
+                candidates.remove(job)
+
+        units:list[Job] = []
+        for job, n_images in scheduled.items():
+            units.extend([job] * n_images)
+        return units
+
+    @staticmethod
+    def _finish_job(job:Job, jobs:list[Job], status:str, result):
+        job.finished = True
+        timings = None
+        if status == "Finished" and job.queued_at != None:
+            timings = {"job": time.monotonic() - job.queued_at}
+        job.add_report(status, result, timings)
+        if job in jobs:
+            jobs.remove(job)
+
+    @staticmethod
+    def _execute_micro_batch(
+        units:list[Job],
+        jobs:list[Job],
+        lock:threading.Condition,
+        batch_method:Callable,
+        compatible_kwargs:tuple,
+        state:dict = None) -> int:
+
+        batch_jobs:list[Job] = list(dict.fromkeys(units))
+        with lock:
+            for job in batch_jobs:
+                if not job.started:
+                    job.started = True
+                    job.add_starting_report()
+
+        first_job = units[0]
+        shared_kwargs = {}
+        if compatible_kwargs != None:
+            shared_kwargs = {name: first_job.kwargs[name] for name in compatible_kwargs if name in first_job.kwargs}
+        else:
+            # Without cross-job batching, the batch holds one job only
+            shared_kwargs = {name: value for name, value in first_job.kwargs.items() if name not in PER_IMAGE_KWARGS}
+        per_image = [
+            {name: value for name, value in job.kwargs.items() if name not in shared_kwargs}
+            for job in units]
+
+        # Nobody wants these images anymore
+        def abort_check() -> bool:
+            if state != None and not state["queue_running"]:
+                return True
+            return all(job.finished for job in batch_jobs)
+
+        try:
+            results = batch_method(len(units), *first_job.args, per_image=per_image, abort_check=abort_check, **shared_kwargs)
+            if not results:
+                raise RuntimeError("The batch method returned no results")
+        except Exception as e:
+            if abort_check():
+                # Canceled during the generation
+                return 0
+            traceback.print_exception(e)
+            with lock:
+                for job in batch_jobs:
+                    if not job.finished:
+                        JobQueue._finish_job(job, jobs, "Failed", str(e))
+            raise
+
+        with lock:
+            for job, result in zip(units, results):
+                if job.finished:
+                    continue
+                job.pending_results.append(result)
+                if isinstance(result, Future):
+                    result.add_done_callback(
+                        lambda _, job=job: JobQueue._report_pending_results(job, jobs, lock))
+
+            # The worker can generate less images than requested.
+            # Give back the remaining ones to their jobs.
+            for job in units[len(results):]:
+                job.scheduled -= 1
+
+            for job in batch_jobs:
+                JobQueue._report_pending_results(job, jobs, lock)
+
+            # Images given back can be picked by other workers
+            if len(results) < len(units):
+                lock.notify_all()
+
+        return len(results)
+
+    @staticmethod
+    def _report_pending_results(job:Job, jobs:list[Job], lock:threading.Condition):
+        """Report the results that are ready, keeping the job order.
+
+        Results can be Futures, when the worker finishes them
+        in the background (image encoding, for example)."""
+        with lock:
+            while job.pending_results and not job.finished:
+                result = job.pending_results[0]
+                if isinstance(result, Future):
+                    if not result.done():
+                        return
+                    try:
+                        result = result.result()
+                    except Exception as e:
+                        traceback.print_exception(e)
+                        job.pending_results.clear()
+                        JobQueue._finish_job(job, jobs, "Failed", str(e))
+                        return
+                job.pending_results.popleft()
+                job.add_result_report(result)
+                job.completed += 1
+
+            if (not job.finished) and job.completed >= job.iterations:
+                JobQueue._finish_job(job, jobs, "Finished", None)
+
+    @staticmethod
+    def _cancel_started_jobs(jobs:list[Job]):
+        for job in list(jobs):
+            if job.started and not job.finished:
+                JobQueue._finish_job(job, jobs, "Canceled", "")
+
+    @staticmethod
+    def _has_work(jobs:list[Job]) -> bool:
+        for job in jobs:
+            if (not job.started) or job.remaining_to_schedule() > 0:
+                return True
+        return False
 
     @background.task
-    def poll_jobs(jobs: list[Job], state:list[bool], worker_factory:Callable, worker_method:Callable):
+    def poll_jobs(
+        jobs: list[Job],
+        state:list[bool],
+        jobs_available:threading.Condition,
+        worker_status:WorkerStatus,
+        worker_factory:Callable,
+        worker_method:Callable,
+        worker_batch_method:Callable = None,
+        batch_compatible_kwargs:tuple = None,
+        max_batch_images:int = 8,
+        policy:SchedulingPolicy = None):
 
         try:
-            worker = worker_factory()
+            worker = worker_factory(worker_status.index)
             work_method = worker_method(worker)
+            batch_method = worker_batch_method(worker) if worker_batch_method else None
         except Exception as e:
             traceback.print_exception(e)
+            worker_status.state = "Failed"
+            worker_status.last_error = str(e)
             return
 
+        worker_status.worker = worker
+        worker_status.state = "Idle"
+        worker_status.started_at = time.monotonic()
+
         while state["queue_running"]:
-            if len(jobs) > 0:
-                print("Got a job !")
-                current_job:Job = jobs.pop(0)
-                current_job.execute(work_method, state)
-                print("Job done")
-            else:
-                time.sleep(1)
-
-    def __init__(self, worker_factory:Callable, worker_method:Callable):
-        self.current_job:Job = None
+            while worker_status.pending_calls:
+                try:
+                    worker_status.pending_calls.popleft()(worker)
+                except Exception as e:
+                    traceback.print_exception(e)
+
+            units = None
+            current_job:Job = None
+            with jobs_available:
+                if batch_method:
+                    units = JobQueue._next_micro_batch(jobs, batch_compatible_kwargs, max_batch_images, policy)
+                elif len(jobs) > 0:
+                    # Whole jobs, in the policy order
+                    current_job = policy.order(jobs)[0]
+                    jobs.remove(current_job)
+                    policy.charge(current_job, current_job.iterations)
+
+                if (not units) and (current_job == None):
+                    jobs_available.wait_for(lambda: (not state["queue_running"]) or JobQueue._has_work(jobs) or worker_status.pending_calls)
+                    continue
+
+            worker_status.state = "Busy"
+            busy_since = time.monotonic()
+            try:
+                if units:
+                    worker_status.images_done += JobQueue._execute_micro_batch(
+                        units, jobs, jobs_available, batch_method, batch_compatible_kwargs, state)
+                    worker_status.batches_done += 1
+                else:
+                    print("Got a job !")
+                    current_job.execute(work_method, state)
+                    worker_status.images_done += current_job.iterations
+                    print("Job done")
+            except Exception as e:
+                worker_status.failures += 1
+                worker_status.last_error = str(e)
+            worker_status.busy_seconds += time.monotonic() - busy_since
+            worker_status.state = "Idle"
+
+            # FIXME Find a better way than leaking internals from upper layers
+            if not state["queue_running"]:
+                with jobs_available:
+                    JobQueue._cancel_started_jobs(jobs)
+
+        worker_status.state = "Stopped"
+
+    def __init__(
+        self,
+        worker_factory:Callable,
+        worker_method:Callable,
+        worker_batch_method:Callable = None,
+        batch_compatible_kwargs:tuple = None,
+        max_batch_images:int = 8,
+        n_workers:int = 1,
+        scheduling_policy:SchedulingPolicy = None,
+        wait_samples:int = 1000):
+        """worker_factory is called with the index of the worker to create.
+        Each of the n_workers workers runs in its own thread, and pulls
+        jobs from the same queue.
+
+        worker_batch_method, when provided, is used to generate the
+        images by batches. Images from different jobs are batched together
+        when their batch_compatible_kwargs values are identical.
+        When batch_compatible_kwargs is None, only images from the same job
+        are batched together.
+        worker_batch_method receives an abort_check callable, returning
+        True when every job of the batch got canceled. It can stop the
+        generation early, by raising an exception.
+
+        scheduling_policy decides which job gets the next image.
+        Jobs are served in their arrival order by default.
+        The waiting times of the last wait_samples jobs are kept,
+        for wait_stats()."""
+
+        self.running_jobs:list[Job] = []
         self.to_do:list[Job] = []
         self.in_progress:list[Job] = []
         self.running_state = {"queue_running": True}
+        # Jobs not done yet, by identifier, and by user
+        self.jobs_by_id:dict[int, Job] = {}
+        self.jobs_by_user:dict[object, dict[int, Job]] = {}
+        self.scheduling_policy:SchedulingPolicy = scheduling_policy or SchedulingPolicy()
+        # Seconds between adding a job and its first image, or its end
+        self.first_result_waits:deque[float] = deque(maxlen=max(1, wait_samples))
+        self.completion_waits:deque[float] = deque(maxlen=max(1, wait_samples))
+        # Wakes up the worker threads when new jobs are available.
+        # Also protects the scheduling state of the jobs.
+        self.jobs_available = threading.Condition()
+        # Wakes up main_task when new jobs or new reports are available
+        self.wake_up = asyncio.Event()
+        self.loop:asyncio.AbstractEventLoop = None
         self.report_handlers = {
             "Starting": self.report_job_started,
             "Progress": self.report_job_progress,
@@ -152,63 +656,179 @@ class JobQueue:
             "Failed": self.report_job_failed,
             "Canceled": self.report_job_canceled
         }
-        JobQueue.poll_jobs(self.in_progress, self.running_state, worker_factory, worker_method)
 
-    
+        n_workers = max(1, n_workers)
+        self.workers_status:list[WorkerStatus] = [WorkerStatus(index) for index in range(n_workers)]
+        # Every worker needs its own thread
+        background.n = max(background.n, n_workers)
+        for worker_status in self.workers_status:
+            JobQueue.poll_jobs(
+                self.in_progress,
+                self.running_state,
+                self.jobs_available,
+                worker_status,
+                worker_factory,
+                worker_method,
+                worker_batch_method,
+                batch_compatible_kwargs,
+                max(1, max_batch_images),
+                self.scheduling_policy)
+
+    def call_on_workers(self, function:Callable):
+        """Call function(worker) on every worker, from the worker thread,
+        once its current batch is done"""
+        with self.jobs_available:
+            for worker_status in self.workers_status:
+                worker_status.pending_calls.append(function)
+            self.jobs_available.notify_all()
 
     def add_jobs(self, jobs:list[Job]):
+        for job in jobs:
+            job.queued_at = time.monotonic()
+            self._register_job(job)
         self.to_do.extend(jobs)
+        self.wake_up.set()
     
     def add_job(self, job:Job):
+        job.queued_at = time.monotonic()
+        self._register_job(job)
         self.to_do.append(job)
+        self.wake_up.set()
+
+    def queued_cost(self, user_id = None) -> float:
+        """Work of the images not scheduled yet, in 512x512 steps.
+        Only counts the jobs of user_id, when provided.
+        Must be called from the event loop thread."""
+        jobs = self.user_jobs(user_id) if user_id != None else list(self.jobs_by_id.values())
+        with self.jobs_available:
+            return sum(job_cost(job, max(0, job.remaining_to_schedule())) for job in jobs if not job.finished)
+
+    def admissible_images(self, job:Job, max_cost:float = 0, max_user_cost:float = 0) -> int:
+        """Number of images of job that can be queued without exceeding
+        max_cost (every job) and max_user_cost (the jobs of the job user).
+        Limits are in 512x512 steps. 0 means no limit."""
+        image_cost = job_cost(job)
+        admissible = job.iterations
+        if image_cost <= 0:
+            return admissible
+
+        if max_cost > 0:
+            available = max_cost - self.queued_cost()
+            admissible = min(admissible, int(available // image_cost))
+        if max_user_cost > 0:
+            available = max_user_cost - self.queued_cost(job.user_id)
+            admissible = min(admissible, int(available // image_cost))
+        return max(0, admissible)
+
+    def estimate_job(self, job:Job, image_seconds:Callable) -> dict:
+        """Estimate when the images of job, queued or not yet, will be
+        generated. image_seconds(job) returns the time needed to generate
+        one image of a job, on one worker.
+
+        The scheduling policy is replayed on a copy of its state, so the
+        estimates take the interleaving of the jobs into account.
+        Returns the queue position of the job, and the seconds before
+        its first image starts and its last image ends.
+        Must be called from the event loop thread."""
+        with self.jobs_available:
+            policy = copy.deepcopy(self.scheduling_policy)
+            remaining = {
+                waiting: waiting.remaining_to_schedule()
+                for waiting in self.in_progress + self.to_do
+                if waiting.remaining_to_schedule() > 0 and not waiting.finished}
+        if job not in remaining and not job.finished:
+            remaining[job] = job.remaining_to_schedule()
+
+        candidates = list(remaining)
+        if job not in candidates:
+            return {"position": None, "start": 0, "finish": 0}
+        position = policy.order(candidates).index(job) + 1
+
+        # The workers generate images in parallel
+        n_workers = len(self.workers_status)
+        durations = {candidate: image_seconds(candidate) / n_workers for candidate in candidates}
+        elapsed = 0
+        start = None
+        while candidates:
+            next_job = policy.order(candidates)[0]
+            if next_job == job and start == None:
+                start = elapsed
+            elapsed += durations[next_job]
+            policy.charge(next_job)
+            remaining[next_job] -= 1
+            if remaining[next_job] <= 0:
+                candidates.remove(next_job)
+                if next_job == job:
+                    break
+        return {"position": position, "start": start or 0, "finish": elapsed}
+
+    def wait_stats(self) -> dict:
+        """p50 and p95 of the waiting times of the last jobs done, in seconds"""
+        first_results = list(self.first_result_waits)
+        completions = list(self.completion_waits)
+        return {
+            "jobs": len(completions),
+            "first_image_p50": percentile(first_results, 50),
+            "first_image_p95": percentile(first_results, 95),
+            "completion_p50": percentile(completions, 50),
+            "completion_p95": percentile(completions, 95),
+        }
 
-    def _filter_out_jobs_list(self, filter_method:Callable, job_list:list[Job]):
-        to_remove = []
-        try:
-            for job in job_list:
-                to_remove.append(filter_method(job))
-            for i in range(len(to_remove)-1, -1, -1):
-                job_list.pop(i)
-        except:
-            return
+    def _report_added(self):
+        # Called from the worker threads
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.wake_up.set)
 
-    def filter_out_jobs(self, filter_method:Callable):
-        self._filter_out_jobs_list(filter_method, self.to_do)
-        self._filter_out_jobs_list(filter_method, self.in_progress)
+    def filter_out_jobs(self, filter_method:Callable) -> list[Job]:
+        """Cancel the jobs for which filter_method(job) returns True.
+        Returns the jobs canceled."""
+        to_cancel = [job for job in self.jobs_by_id.values() if filter_method(job)]
+        return [job for job in to_cancel if self.cancel_job(job.job_id)]
 
     def _job_to_do(self):
         return self.to_do
 
     def _job_running(self):
-        return self.current_job != None
+        return len(self.running_jobs) > 0
 
-    def _start_next_job_if_possible(self) -> bool:
+    def _start_next_jobs_if_possible(self) -> bool:
         if not self._job_to_do():
             return False
-        
-        if self._job_running():
-            return False
-        
-        self.current_job = self.to_do.pop(0)
-        self.in_progress.append(self.current_job)
+
+        # The worker decides how to schedule the jobs.
+        # We only need to follow their progress.
+        with self.jobs_available:
+            while self.to_do:
+                job = self.to_do.pop(0)
+                job.on_report = self._report_added
+                self.running_jobs.append(job)
+                self.in_progress.append(job)
+            self.jobs_available.notify_all()
         return True
-    
+
+    def _forward_reports(self) -> bool:
+        forwarded = False
+        for job in list(self.running_jobs):
+            while job in self.running_jobs and job.progressed():
+                self.handle_report(job, job.read_next())
+                forwarded = True
+        return forwarded
+
     def _bailing_out(self):
         self.running_state["queue_running"] = False
+        with self.jobs_available:
+            self.jobs_available.notify_all()
 
     async def main_task(self):
+        self.loop = asyncio.get_running_loop()
         while True:
             try:
-                if self._job_running():
-                    if self.current_job.progressed():
-                        current_progress:StatusReport = self.current_job.read_next()
-                        self.handle_report(self.current_job, current_progress)
-                    else:
-                        await asyncio.sleep(1)
-                        continue
-                else:
-                    if not self._start_next_job_if_possible():
-                        await asyncio.sleep(2)
+                # Clear before checking, so that any job or report
+                # added in the meantime wakes us up immediately
+                self.wake_up.clear()
+                self._start_next_jobs_if_possible()
+                self._forward_reports()
+                await self.wake_up.wait()
             except KeyboardInterrupt:
                 self._bailing_out()
                 return
@@ -217,4 +837,3 @@ class JobQueue:
                 self._bailing_out()
                 return
 
-
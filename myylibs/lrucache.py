@@ -0,0 +1,61 @@
+from collections import OrderedDict
+import threading
+from typing import Callable
+
+class SizedLRUCache:
+    """Least Recently Used cache, limited by the total size of its values.
+
+    size_of(value) must return the size of a value, in bytes.
+    Values bigger than the whole cache are never stored.
+    """
+
+    def __init__(self, max_bytes:int, size_of:Callable):
+        self.max_bytes:int = max(0, max_bytes)
+        self.size_of:Callable = size_of
+        self.entries:OrderedDict = OrderedDict()
+        self.current_bytes:int = 0
+        self.hits:int = 0
+        self.misses:int = 0
+        self.evictions:int = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
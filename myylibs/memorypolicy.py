@@ -0,0 +1,145 @@
+import os
+
+import torch
+
+# Memory policies of the Stable Diffusion pipelines, from the fastest to
+# the most frugal. Each policy includes the savings of the previous ones.
+#
+# * full               : Everything on the device, nothing sliced.
+# * vae-slicing        : The VAE decodes the images of a batch one by one.
+# * vae-tiling         : The VAE decodes each image by tiles. Allows big
+#                        resolutions, with faint seams between the tiles.
+# * attention-slicing  : The UNet attention is computed in slices.
+#                        PyTorch 2 fused attention already avoids storing
+#                        the whole attention matrix, and is faster. Only
+#                        useful without it.
+# * model-offload      : The models stay in RAM, and are moved to the
+#                        device one at a time, when used.
+# * sequential-offload : The models layers are moved to the device one
+#                        at a time. Very slow, but needs almost no VRAM.
+#
+# "auto" picks, for each batch, the fastest policy whose estimated peak
+# memory fits in the memory budget.
+#
+# Offloading moves the models to the CPU. On CPU, the offload policies
+# save nothing, and are never used.
+
+MEMORY_POLICIES = ("full", "vae-slicing", "vae-tiling", "attention-slicing", "model-offload", "sequential-offload")
+OFFLOAD_POLICIES = ("model-offload", "sequential-offload")
+AUTO_MEMORY_POLICY = "auto"
+
+# Rough device memory used by the activations of one 512x512 fp32 image,
+# on top of the weights. The estimation is rough, on purpose.
+UNET_BYTES_PER_512_IMAGE = 1024 * 1024 * 1024
+VAE_BYTES_PER_512_IMAGE = 512 * 1024 * 1024
+# Part of the UNet activations left with attention slicing,
+# when the fused attention is not available
+SLICED_ATTENTION_SHARE = 0.5
+# Size of the VAE tiles, in pixels
+VAE_TILE_PIXELS = 512 * 512
+# Part of the weights staying on the device with sequential offload
+SEQUENTIAL_OFFLOAD_WEIGHTS_SHARE = 0.05
+# Part of the memory budget actually used, when estimated from the device
+DEFAULT_BUDGET_SHARE = 0.9
+
+def is_out_of_memory(error:Exception) -> bool:
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    # CPU allocations, and older PyTorch versions
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+def usable_policies(torch_device:str) -> tuple:
+    if str(torch_device).startswith("cpu"):
+        return tuple(policy for policy in MEMORY_POLICIES if policy not in OFFLOAD_POLICIES)
+    return MEMORY_POLICIES
+
+def module_bytes(module) -> int:
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    return sum(tensor.element_size() * tensor.nelement() for tensor in list(module.parameters()) + list(module.buffers()))
+
+def device_memory_budget(torch_device:str) -> int:
+    """Memory usable by a worker on torch_device, in bytes"""
+    if str(torch_device).startswith("cuda"):
+        total = torch.cuda.get_device_properties(torch.device(torch_device)).total_memory
+    else:
+        total = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    return int(total * DEFAULT_BUDGET_SHARE)
+
+class MemoryEstimator:
+    """Estimates the peak memory of a batch, for each policy"""
+
+    def __init__(self, pipe, dtype:torch.dtype = torch.float32):
+        self.weights:dict[str, int] = {
+            name: module_bytes(component)
+            for name, component in pipe.components.items()
+            if isinstance(component, torch.nn.Module)}
+        # Half precision activations are half as big
+        self.activations_scale:float = 1 if dtype == torch.float32 else 0.5
+        # Slicing saves nothing then
+        self.fused_attention:bool = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
+    def estimate(self, policy:str, batch_size:int, width:int, height:int) -> int:
+        level = MEMORY_POLICIES.index(policy)
+        megapixels = width * height / (512 * 512)
+
+        unet_bytes = UNET_BYTES_PER_512_IMAGE * megapixels * batch_size
+        if level >= MEMORY_POLICIES.index("attention-slicing") and not self.fused_attention:
+            unet_bytes *= SLICED_ATTENTION_SHARE
+
+        # The VAE attention grows with the square of the pixels
+        vae_image_bytes = VAE_BYTES_PER_512_IMAGE * megapixels * max(1, megapixels)
+        vae_bytes = vae_image_bytes * batch_size
+        if level >= MEMORY_POLICIES.index("vae-slicing"):
+            vae_bytes = vae_image_bytes
+        if level >= MEMORY_POLICIES.index("vae-tiling"):
+            vae_bytes = VAE_BYTES_PER_512_IMAGE * min(megapixels, VAE_TILE_PIXELS / (512 * 512))
+
+        weights_bytes = sum(self.weights.values())
+        if policy == "model-offload":
+            weights_bytes = max(self.weights.values(), default=0)
+        elif policy == "sequential-offload":
+            weights_bytes = max(self.weights.values(), default=0) * SEQUENTIAL_OFFLOAD_WEIGHTS_SHARE
+
+        # The UNet activations are freed before the VAE decodes the latents
+        return int(weights_bytes + max(unet_bytes, vae_bytes) * self.activations_scale)
+
+    def cheapest_policy(self, policies:tuple, budget:int, batch_size:int, width:int, height:int) -> str:
+        """Fastest policy fitting in budget. The most frugal one when none fits."""
+        for policy in policies:
+            if self.estimate(policy, batch_size, width, height) <= budget:
+                return policy
+        return policies[-1]
+
+def apply_memory_policy(pipe, policy:str, previous_policy:str, torch_device:str):
+    """Switch pipe from previous_policy (None when never applied) to policy"""
+    level = MEMORY_POLICIES.index(policy)
+
+    # Also when a previous switch failed half way
+    offloaded = previous_policy == None or previous_policy in OFFLOAD_POLICIES
+    if offloaded and policy != previous_policy:
+        pipe.remove_all_hooks()
+    if policy == "model-offload" and previous_policy != policy:
+        pipe.enable_model_cpu_offload(device = torch_device)
+    elif policy == "sequential-offload" and previous_policy != policy:
+        pipe.enable_sequential_cpu_offload(device = torch_device)
+    elif policy not in OFFLOAD_POLICIES and offloaded:
+        pipe.to(torch_device)
+
+    if level >= MEMORY_POLICIES.index("attention-slicing"):
+        pipe.enable_attention_slicing()
+    else:
+        pipe.disable_attention_slicing()
+
+    vae = getattr(pipe, "vae", None)
+    if vae == None:
+        return
+    if level >= MEMORY_POLICIES.index("vae-slicing"):
+        vae.enable_slicing()
+    else:
+        vae.disable_slicing()
+    if level >= MEMORY_POLICIES.index("vae-tiling"):
+        vae.enable_tiling()
+    else:
+        vae.disable_tiling()
@@ -0,0 +1,154 @@
+import asyncio
+import math
+import threading
+from typing import Callable
+
+# Counters, gauges and histograms, exposed in the Prometheus text format.
+# See https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Every method can be called from any thread. The HTTP endpoint runs on
+# the asyncio event loop, so it needs no thread of its own.
+
+# Seconds. From a fraction of a denoising step to a whole job.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+MAX_REQUEST_SIZE = 8192
+
+def _labels_text(labels:tuple) -> str:
+    if not labels:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def _value_text(value:float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+class Histogram:
+    def __init__(self, buckets:tuple):
+        self.buckets:tuple = buckets
+        self.counts:list[int] = [0] * len(buckets)
+        self.count:int = 0
+        self.sum:float = 0
+
+    def observe(self, value:float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+class Metrics:
+
+    def __init__(self, prefix:str = "degu"):
+        self.prefix:str = prefix
+        # name : (type, help)
+        self.descriptions:dict[str, tuple[str, str]] = {}
+        # name : {labels : value}
+        self.values:dict[str, dict[tuple, object]] = {}
+        # Called before rendering, to update the gauges that are
+        # cheaper to read when needed than to keep up to date
+        self.collectors:list[Callable] = []
+        self.lock = threading.Lock()
+
+    def _series(self, name:str, metric_type:str, help_text:str) -> dict:
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self.descriptions:
+            self.descriptions[full_name] = (metric_type, help_text)
+            self.values[full_name] = {}
+        return self.values[full_name]
+
+    def increment(self, name:str, value:float = 1, help_text:str = "", **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._series(name, "counter", help_text)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name:str, value:float, help_text:str = "", **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self._series(name, "gauge", help_text)[key] = value
+
+    def set_max(self, name:str, value:float, help_text:str = "", **labels):
+        """Gauge keeping the highest value set. For high-water marks."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._series(name, "gauge", help_text)
+            series[key] = max(series.get(key, value), value)
+
+    def observe(self, name:str, value:float, help_text:str = "", buckets:tuple = DEFAULT_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._series(name, "histogram", help_text)
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def add_collector(self, collector:Callable):
+        self.collectors.append(collector)
+
+    def summary(self, name:str) -> dict:
+        """{labels : (count, average)} of a histogram"""
+        with self.lock:
+            series = self.values.get(f"{self.prefix}_{name}", {})
+            return {
+                labels: (histogram.count, histogram.sum / histogram.count if histogram.count else 0)
+                for labels, histogram in series.items()}
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                print(f"Metrics collector failed : {e}")
+
+        lines = []
+        with self.lock:
+            for name, (metric_type, help_text) in self.descriptions.items():
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in self.values[name].items():
+                    if metric_type != "histogram":
+                        lines.append(f"{name}{_labels_text(labels)} {_value_text(value)}")
+                        continue
+
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels_text(labels + (('le', _value_text(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels_text(labels + (('le', '+Inf'),))} {value.count}")
+                    lines.append(f"{name}_sum{_labels_text(labels)} {_value_text(value.sum)}")
+                    lines.append(f"{name}_count{_labels_text(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle_request(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=10)
+            method, path, _ = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+            if method != "GET":
+                status, body = "405 Method Not Allowed", ""
+            elif path.split("?", 1)[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.render()
+            else:
+                status, body = "404 Not Found", ""
+
+            content = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(content)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + content)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host:str, port:int) -> asyncio.AbstractServer:
+        """Serve the metrics over HTTP, from the running event loop"""
+        return await asyncio.start_server(self._handle_request, host, port, limit=MAX_REQUEST_SIZE)
@@ -0,0 +1,100 @@
+import io
+import os
+import struct
+import zlib
+
+# Reads the text chunks (tEXt, zTXt, iTXt) of a PNG file, without
+# decoding the image. Every other chunk, including the IDAT image data,
+# is skipped by seeking over it, so only a few kilobytes are read,
+# whatever the size of the image.
+#
+# See https://www.w3.org/TR/png/#11textinfo
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TEXT_CHUNK_TYPES = (b"tEXt", b"zTXt", b"iTXt")
+
+# Ignore bigger text chunks, and limit decompressed texts to the same size
+MAX_TEXT_CHUNK_SIZE = 1024 * 1024
+
+class PNGChunkError(ValueError):
+    pass
+
+def _decompress(data:bytes) -> bytes:
+    decompressor = zlib.decompressobj()
+    text = decompressor.decompress(data, MAX_TEXT_CHUNK_SIZE)
+    if decompressor.unconsumed_tail:
+        raise PNGChunkError("Compressed text chunk too big")
+    return text
+
+def _parse_text_chunk(chunk_type:bytes, data:bytes) -> tuple[str, str]:
+    key, _, value = data.partition(b"\0")
+    key = key.decode("latin-1")
+
+    if chunk_type == b"tEXt":
+        return key, value.decode("latin-1")
+
+    if chunk_type == b"zTXt":
+        # Compression method byte, then the compressed text
+        return key, _decompress(value[1:]).decode("latin-1")
+
+    # iTXt : compression flag, compression method, language tag,
+    # translated keyword, then the UTF-8 text
+    compressed = value[:1] == b"\1"
+    _, _, value = value[2:].partition(b"\0")
+    _, _, value = value.partition(b"\0")
+    if compressed:
+        value = _decompress(value)
+    return key, value.decode("utf-8")
+
+def _skip(stream, size:int):
+    if stream.seekable():
+        stream.seek(size, os.SEEK_CUR)
+        return
+    while size > 0:
+        skipped = len(stream.read(min(size, 1024 * 1024)))
+        if skipped == 0:
+            return
+        size -= skipped
+
+def read_png_text_chunks_from_stream(stream) -> dict:
+    """Text chunks of the PNG file read from stream, as a dictionary.
+    Raises PNGChunkError when the stream is not a PNG file."""
+    if stream.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise PNGChunkError("Not a PNG file")
+
+    texts = {}
+    while True:
+        header = stream.read(8)
+        if len(header) < 8:
+            # Truncated file. Return what we got.
+            break
+
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IEND":
+            break
+
+        if chunk_type not in TEXT_CHUNK_TYPES or length > MAX_TEXT_CHUNK_SIZE:
+            # Data and CRC
+            _skip(stream, length + 4)
+            continue
+
+        data = stream.read(length)
+        # CRC
+        _skip(stream, 4)
+        try:
+            key, value = _parse_text_chunk(chunk_type, data)
+        except (UnicodeDecodeError, zlib.error, PNGChunkError):
+            continue
+        # Like PIL, the last chunk with a given key wins
+        texts[key] = value
+    return texts
+
+def read_png_text_chunks(source) -> dict:
+    """Text chunks of a PNG file.
+    source can be a filepath, bytes or a binary stream."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return read_png_text_chunks_from_stream(io.BytesIO(source))
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as png_file:
+            return read_png_text_chunks_from_stream(png_file)
+    return read_png_text_chunks_from_stream(source)
@@ -0,0 +1,98 @@
+import contextlib
+from typing import NamedTuple
+
+import torch
+
+# Numerical precision of the Stable Diffusion pipelines.
+#
+# * fp32 : Full precision. Slow on GPUs, the only fast choice on most CPUs.
+# * fp16 : Half the memory, and much faster, on GPUs. Not on CPUs.
+# * bf16 : fp16 range with less precision. On GPUs, the weights are
+#          converted. On CPUs, the weights stay in fp32 and the
+#          computations run under bf16 autocast, which is fast on CPUs
+#          with native bf16 instructions (AVX512-BF16, AMX).
+# * auto : fp16 on GPUs, bf16 on CPUs supporting it natively, else fp32.
+#
+# Every mode is checked against the device at startup, by running a few
+# operations with it.
+
+PRECISIONS = ("fp32", "fp16", "bf16")
+AUTO_PRECISION = "auto"
+
+DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+class Precision(NamedTuple):
+    name:str
+    # dtype of the weights
+    dtype:torch.dtype
+    # When set, the computations run under torch.autocast with this dtype
+    autocast_dtype:torch.dtype = None
+
+    def __str__(self) -> str:
+        return f"{self.name} autocast" if self.autocast_dtype != None else self.name
+
+    def autocast(self, torch_device:str):
+        if self.autocast_dtype == None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type = torch.device(torch_device).type, dtype = self.autocast_dtype)
+
+def _device_type(torch_device:str) -> str:
+    return torch.device(torch_device).type
+
+def native_cpu_bf16() -> bool:
+    """True when the CPU has bf16 instructions"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def precision_plan(name:str, torch_device:str) -> Precision:
+    """How name runs on torch_device, without checking that it does"""
+    if name == "bf16" and _device_type(torch_device) == "cpu":
+        return Precision(name, torch.float32, torch.bfloat16)
+    return Precision(name, DTYPES[name])
+
+def check_precision(precision:Precision, torch_device:str):
+    """Raises ValueError when torch_device can't run precision"""
+    device_type = _device_type(torch_device)
+    if precision.name == "fp16" and device_type == "cpu":
+        raise ValueError("fp16 is not supported on CPU. Use bf16 or fp32.")
+    if precision.name == "bf16" and device_type == "cuda" and not torch.cuda.is_bf16_supported():
+        raise ValueError(f"{torch_device} doesn't support bf16. Use fp16 or fp32.")
+
+    # The operations a UNet relies on
+    try:
+        with precision.autocast(torch_device):
+            sample = torch.ones((1, 32, 8, 8), dtype = precision.dtype, device = torch_device)
+            weight = torch.ones((32, 32, 3, 3), dtype = precision.dtype, device = torch_device)
+            convolved = torch.nn.functional.conv2d(sample, weight, padding = 1)
+            normalized = torch.nn.functional.group_norm(convolved, 8)
+            tokens = normalized.flatten(2).transpose(1, 2)
+            attended = torch.nn.functional.scaled_dot_product_attention(tokens, tokens, tokens)
+            torch.nn.functional.silu(attended).sum().item()
+    except (RuntimeError, TypeError) as e:
+        raise ValueError(f"{torch_device} can't run {precision} : {e}") from e
+
+def resolve_precision(mode:str, torch_device:str) -> Precision:
+    """Precision used by mode on torch_device. auto picks the fastest
+    precision supported by the device. Raises ValueError when the
+    device doesn't support mode."""
+    mode = mode.lower()
+    if mode == AUTO_PRECISION:
+        device_type = _device_type(torch_device)
+        if device_type in ("cuda", "mps"):
+            mode = "fp16"
+        elif device_type == "cpu" and native_cpu_bf16():
+            mode = "bf16"
+        else:
+            mode = "fp32"
+    if mode not in PRECISIONS:
+        raise ValueError(f"Unknown precision {mode}. Known precisions : {AUTO_PRECISION}, {', '.join(PRECISIONS)}")
+
+    precision = precision_plan(mode, torch_device)
+    check_precision(precision, torch_device)
+    return precision
@@ -0,0 +1,280 @@
+from concurrent.futures import Future
+import io
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
+import queue
+import signal
+import threading
+import traceback
+from typing import Callable
+
+# Runs a worker (DeguDiffusionWorker generally) in its own process,
+# so that the GIL-heavy parts of the generation (PNG encoding,
+# scheduler steps, ...) don't stall the Discord event loop.
+#
+# Method calls go through a Pipe, as small tuples :
+#   ("call", method_name, args, kwargs) -> ("result", value) | ("error", traceback)
+#   ("stop",)
+# Results finished in the background (Futures) can't cross the Pipe.
+# They are replaced by PendingResult references, and their value is
+# sent later, once finished, without waiting for the next call :
+#   ("future", future_id, "result", value) | ("future", future_id, "error", traceback)
+# so that the worker process can generate the next images while the
+# previous ones are encoded. A thread of the bot process receives all
+# the messages, and resolves the matching Futures.
+# abort_check callables can't go through the Pipe. The bot process
+# polls them while waiting for the result, and sets a shared Event
+# that the worker process checks instead.
+# Images buffers (BytesIO) never go through the Pipe. They are copied
+# into shared memory blocks by the worker process, and only the block
+# name and size are sent back. The bot process copies them back into
+# BytesIO objects and frees the blocks.
+
+# Worker attributes copied to the proxy, once the worker is ready
+PROCESS_WORKER_ATTRIBUTES = ("torch_device", "model_name")
+
+# Seconds between two abort_check calls, while waiting for a result
+ABORT_CHECK_INTERVAL = 0.1
+
+class SharedBuffer:
+    """Reference to a shared memory block holding an image buffer"""
+
+    def __init__(self, name:str, size:int):
+        self.name = name
+        self.size = size
+
+    @staticmethod
+    def from_bytes_io(data:io.BytesIO) -> "SharedBuffer":
+        content = data.getbuffer()
+        size = content.nbytes
+        # Zero-sized shared memory blocks are not allowed
+        block = shared_memory.SharedMemory(create=True, size=max(1, size))
+        block.buf[:size] = content
+        content.release()
+        block.close()
+        return SharedBuffer(block.name, size)
+
+    def to_bytes_io(self) -> io.BytesIO:
+        block = shared_memory.SharedMemory(name=self.name)
+        try:
+            data = io.BytesIO(block.buf[:self.size])
+        finally:
+            block.close()
+            block.unlink()
+        return data
+
+class PendingResult:
+    """Reference to a Future of the worker process, not finished yet"""
+
+    def __init__(self, future_id:int):
+        self.future_id = future_id
+
+def _convert_buffers(value, converter, buffer_type):
+    if isinstance(value, buffer_type):
+        return converter(value)
+    if isinstance(value, dict):
+        return {key: _convert_buffers(item, converter, buffer_type) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_convert_buffers(item, converter, buffer_type) for item in value]
+    return value
+
+def _worker_process_main(connection:multiprocessing.connection.Connection, abort_event, worker_class, worker_kwargs:dict):
+    # The bot process decides when to stop us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        worker = worker_class(**worker_kwargs)
+    except Exception as e:
+        connection.send(("error", "".join(traceback.format_exception(e))))
+        return
+
+    attributes = {name: getattr(worker, name, None) for name in PROCESS_WORKER_ATTRIBUTES}
+    connection.send(("ready", attributes))
+
+    # Futures are resolved by the worker threads, while the main thread
+    # may be sending a result
+    send_lock = threading.Lock()
+    def send(message:tuple):
+        with send_lock:
+            connection.send(message)
+
+    def send_future_result(future_id:int, future:Future):
+        try:
+            value = _convert_buffers(future.result(), SharedBuffer.from_bytes_io, io.BytesIO)
+            message = ("future", future_id, "result", value)
+        except Exception as e:
+            message = ("future", future_id, "error", "".join(traceback.format_exception(e)))
+        try:
+            send(message)
+        except (EOFError, OSError):
+            pass
+
+    next_future_id = 0
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+
+        if message[0] == "stop":
+            return
+
+        _, method_name, args, kwargs = message
+        if kwargs.pop("abort_check", None):
+            kwargs["abort_check"] = abort_event.is_set
+        futures:dict[int, Future] = {}
+        def to_pending_result(future:Future) -> PendingResult:
+            nonlocal next_future_id
+            next_future_id += 1
+            futures[next_future_id] = future
+            return PendingResult(next_future_id)
+
+        try:
+            result = getattr(worker, method_name)(*args, **kwargs)
+            result = _convert_buffers(result, to_pending_result, Future)
+            result = _convert_buffers(result, SharedBuffer.from_bytes_io, io.BytesIO)
+            send(("result", result))
+        except Exception as e:
+            send(("error", "".join(traceback.format_exception(e))))
+        # Only once the result is sent, so that the bot process knows
+        # the Futures before their values
+        for future_id, future in futures.items():
+            future.add_done_callback(lambda future, future_id = future_id: send_future_result(future_id, future))
+
+class ProcessWorker:
+    """Proxy to a worker running in a separate process.
+
+    worker_class(**worker_kwargs) is called in the new process,
+    so both must be picklable.
+    """
+
+    def __init__(self, worker_class, worker_kwargs:dict):
+        # CUDA can't be used in forked processes
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.abort_event = context.Event()
+        self.process = context.Process(
+            target = _worker_process_main,
+            args   = (child_connection, self.abort_event, worker_class, worker_kwargs),
+            daemon = True)
+        self.process.start()
+        child_connection.close()
+        self.lock = threading.Lock()
+        self.last_cache_stats:dict = {}
+
+        try:
+            status, value = self.connection.recv()
+        except EOFError:
+            raise RuntimeError("The worker process died while starting")
+
+        if status != "ready":
+            self.process.join()
+            raise RuntimeError(f"The worker process failed to start :\n{value}")
+
+        for name, attribute in value.items():
+            setattr(self, name, attribute)
+
+        # Replies to the calls. Futures values are handled by the receiver.
+        self.replies = queue.Queue()
+        self.pending_futures:dict[int, Future] = {}
+        self.receiver = threading.Thread(target = self._receive_messages, daemon = True)
+        self.receiver.start()
+
+    def _receive_messages(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError) as e:
+                self.replies.put(("lost", str(e) or type(e).__name__))
+                for future in self.pending_futures.values():
+                    future.set_exception(RuntimeError("Lost the connection with the worker process"))
+                self.pending_futures.clear()
+                return
+
+            if message[0] == "future":
+                _, future_id, status, value = message
+                future = self.pending_futures.pop(future_id)
+                if status == "error":
+                    future.set_exception(RuntimeError(f"The worker process failed :\n{value}"))
+                else:
+                    future.set_result(_convert_buffers(value, SharedBuffer.to_bytes_io, SharedBuffer))
+                continue
+
+            status, value = message
+            if status == "result":
+                value = _convert_buffers(value, self._future_of, PendingResult)
+            self.replies.put((status, value))
+
+    def _future_of(self, pending_result:PendingResult) -> Future:
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.pending_futures[pending_result.future_id] = future
+        return future
+
+    def call(self, method_name:str, *args, abort_check:Callable = None, **kwargs):
+        with self.lock:
+            status, value = self._call_locked(method_name, *args, abort_check = abort_check, **kwargs)
+        return self._call_result(status, value)
+
+    def _call_locked(self, method_name:str, *args, abort_check:Callable = None, **kwargs) -> tuple:
+        """Send the call and wait for its (status, value).
+        The caller must hold self.lock."""
+        try:
+            self.abort_event.clear()
+            if abort_check != None:
+                kwargs["abort_check"] = True
+            self.connection.send(("call", method_name, args, kwargs))
+        except (EOFError, OSError) as e:
+            raise RuntimeError(f"Lost the connection with the worker process ({e})")
+        while True:
+            try:
+                status, value = self.replies.get(timeout = ABORT_CHECK_INTERVAL if abort_check != None else None)
+            except queue.Empty:
+                if abort_check():
+                    self.abort_event.set()
+                    abort_check = None
+                continue
+            if status == "lost":
+                # For the following calls too
+                self.replies.put((status, value))
+                raise RuntimeError(f"Lost the connection with the worker process ({value})")
+            return status, value
+
+    @staticmethod
+    def _call_result(status:str, value):
+        if status == "error":
+            raise RuntimeError(f"The worker process failed :\n{value}")
+        return _convert_buffers(value, SharedBuffer.to_bytes_io, SharedBuffer)
+
+    def generate_image(self, *args, **kwargs) -> dict:
+        return self.call("generate_image", *args, **kwargs)
+
+    def generate_batch(self, *args, **kwargs) -> list[dict]:
+        return self.call("generate_batch", *args, **kwargs)
+
+    def start_profiling(self, *args, **kwargs):
+        return self.call("start_profiling", *args, **kwargs)
+
+    def cache_stats(self) -> dict:
+        # Don't wait for the current generation to finish.
+        # Return the last known statistics instead.
+        if not self.lock.acquire(blocking=False):
+            return self.last_cache_stats
+        try:
+            status, value = self._call_locked("cache_stats")
+        finally:
+            self.lock.release()
+        self.last_cache_stats = self._call_result(status, value)
+        return self.last_cache_stats
+
+    def close(self):
+        with self.lock:
+            try:
+                self.connection.send(("stop",))
+            except (EOFError, OSError):
+                pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,120 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+
+import torch
+
+# Profiles the generation of a given number of images.
+#
+# * "torch" uses torch.profiler, and writes a Chrome trace (open it in
+#   chrome://tracing or https://ui.perfetto.dev) and a table of the
+#   most expensive operators.
+# * "cprofile" profiles the Python code, and writes a .prof file
+#   (for snakeviz, or pstats) and the top functions by cumulative time.
+#
+# Only the calls wrapped between resume() and pause() are profiled.
+# The work done by other threads (image encoding, for example) is not.
+
+PROFILERS = ("torch", "cprofile")
+
+# torch.profiler, like cProfile since Python 3.12, is process wide.
+# Only one session, among every worker thread, profiles at a time.
+_running_session_lock = threading.Lock()
+
+class ProfilingSession:
+
+    def __init__(self, n_images:int, profiler:str, output_directory:str, name:str = "worker", top:int = 30):
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profiler}. Known profilers : {', '.join(PROFILERS)}")
+        self.n_images:int = max(1, n_images)
+        self.images_done:int = 0
+        self.profiler_name:str = profiler
+        self.output_directory:str = output_directory
+        self.name:str = name
+        self.top:int = top
+        self.profiler = None
+        self.holds_lock:bool = False
+
+    def resume(self):
+        """Raises RuntimeError when another session is profiling"""
+        if not self.holds_lock:
+            if not _running_session_lock.acquire(blocking=False):
+                raise RuntimeError("Another worker is already profiling")
+            self.holds_lock = True
+
+        if self.profiler_name == "cprofile":
+            if self.profiler == None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return
+
+        # torch.profiler can't be paused. It runs until the last image.
+        if self.profiler == None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities = activities)
+            self.profiler.start()
+
+    def pause(self, images_done:int) -> list[str]:
+        """Returns the files written, once n_images were profiled"""
+        self.images_done += images_done
+        if self.profiler_name == "cprofile":
+            self.profiler.disable()
+        if not self.is_done():
+            return []
+        return self._write_results()
+
+    def is_done(self) -> bool:
+        return self.images_done >= self.n_images
+
+    def close(self):
+        """Stop profiling, without writing the results"""
+        try:
+            if self.profiler_name == "cprofile" and self.profiler != None:
+                self.profiler.disable()
+            elif self.profiler != None:
+                self.profiler.stop()
+        except Exception:
+            pass
+        finally:
+            self.profiler = None
+            self._release_lock()
+
+    def _release_lock(self):
+        if self.holds_lock:
+            self.holds_lock = False
+            _running_session_lock.release()
+
+    def _write_results(self) -> list[str]:
+        try:
+            return self._write_profiler_results()
+        finally:
+            self.profiler = None
+            self._release_lock()
+
+    def _write_profiler_results(self) -> list[str]:
+        os.makedirs(self.output_directory, exist_ok=True)
+        filepath_prefix = os.path.join(self.output_directory, f"{int(time.time())}_{self.name}_{self.profiler_name}")
+        summary_filepath = f"{filepath_prefix}_summary.txt"
+
+        if self.profiler_name == "cprofile":
+            profile_filepath = f"{filepath_prefix}.prof"
+            self.profiler.dump_stats(profile_filepath)
+            summary = io.StringIO()
+            pstats.Stats(self.profiler, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+            summary_text = summary.getvalue()
+        else:
+            self.profiler.stop()
+            profile_filepath = f"{filepath_prefix}_trace.json"
+            self.profiler.export_chrome_trace(profile_filepath)
+            sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+            summary_text = self.profiler.key_averages().table(sort_by=sort_by, row_limit=self.top)
+
+        with open(summary_filepath, "w", encoding="utf-8") as summary_file:
+            summary_file.write(f"{self.images_done} images profiled with {self.profiler_name}\n\n")
+            summary_file.write(summary_text)
+        return [profile_filepath, summary_filepath]
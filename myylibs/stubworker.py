@@ -0,0 +1,83 @@
+import io
+import random
+import time
+from typing import Callable
+
+from PIL import Image
+
+# A worker generating tiny solid color images, after sleeping as long as
+# a denoising would take. Used with WORKERS_MODE=stub to load test the
+# queue, the uploads and the submission API without any GPU or model.
+#
+# Special tags are not replaced. Use the tiny random pipeline
+# (STABLEDIFFUSION_MODEL_NAME=tiny-random) to include them.
+
+STUB_MODEL_NAME = "stub"
+
+class StubGenerationAborted(Exception):
+    pass
+
+class StubWorker:
+
+    def __init__(self, step_seconds:float = 0.01, image_size:int = 16):
+        """step_seconds is the duration of one 512x512 denoising step"""
+        self.step_seconds:float = step_seconds
+        self.image_size:int = image_size
+        self.model_name:str = STUB_MODEL_NAME
+        self.torch_device:str = "stub"
+
+    def cache_stats(self) -> dict:
+        return {}
+
+    def start_profiling(self, *args, **kwargs):
+        print("The stub worker can't be profiled")
+
+    def generate_image(self, **kwargs) -> dict:
+        return self.generate_batch(1, **kwargs)[0]
+
+    def generate_batch(
+        self,
+        max_images:int = 1,
+        prompt:str = "",
+        n_inferences:int = 50,
+        guidance_scale:float = 7.5,
+        deterministic = True,
+        width:int = 512,
+        height:int = 512,
+        per_image:list[dict] = None,
+        abort_check:Callable = None) -> list[dict]:
+
+        if per_image:
+            per_image = per_image[:max_images]
+        else:
+            per_image = [{}] * max_images
+
+        # Batches are cheaper per image, but not free
+        step_seconds = self.step_seconds * len(per_image) ** 0.8 * width * height / (512 * 512)
+        denoise_began_at = time.monotonic()
+        for _ in range(n_inferences):
+            if abort_check != None and abort_check():
+                raise StubGenerationAborted(f"Generation of {len(per_image)} images aborted")
+            time.sleep(step_seconds)
+        denoise_seconds = time.monotonic() - denoise_began_at
+
+        reports = []
+        for image in per_image:
+            image_deterministic = image.get("deterministic", deterministic)
+            seed = image_deterministic if type(image_deterministic) is int else random.randrange(2**32)
+            image_data = io.BytesIO()
+            color = random.Random(seed).randrange(2**24)
+            Image.new("RGB", (self.image_size, self.image_size), color).save(image_data, format="PNG")
+            image_data.seek(0)
+            reports.append({
+                "actual_prompt": "",
+                "seed": seed,
+                "nsfw": False,
+                "filepath": "",
+                "filename": f"{int(time.time())}_SEED_{seed}.png",
+                "content_as": "data",
+                "image_data": image_data,
+                "cache_hit": False,
+                "timings": {"denoise": denoise_seconds, "denoised_images": len(per_image)},
+            })
+        return reports
@@ -0,0 +1,115 @@
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from aiohttp import web # (installed with discord.py)
+
+# Local HTTP front-end submitting jobs to the queue, without Discord.
+# Used to load test the queue, the workers and the uploads.
+#
+# POST /jobs        {"prompt", "n_images", "n_inferences", "guidance_scale", "seed", "user_id"}
+#                   Every field is optional. Returns the job identifier
+#                   and its estimated start and end.
+# GET  /jobs/{id}   The messages delivered for the job, in order.
+# GET  /stats       Queue waits and uploads statistics.
+#
+# The messages of a job are sent to a RecordingReference, through the
+# same uploads queue as the Discord messages, so the deliveries are
+# timed and ordered like they would be on Discord.
+
+# Jobs whose deliveries are kept, before the oldest ones are forgotten
+MAX_RECORDED_JOBS = 10000
+MAX_REQUEST_SIZE = 64 * 1024
+
+class SubmissionRefused(Exception):
+    def __init__(self, message:str, status:int = 400):
+        super().__init__(message)
+        self.status:int = status
+
+class RecordingReference:
+    """Stands for a Discord thread or interaction followup.
+    Records what is sent to it, instead of sending it."""
+
+    def __init__(self):
+        self.deliveries:list[dict] = []
+
+    async def send(self, content:str = None, files:list = None, ephemeral:bool = False, **kwargs):
+        try:
+            self.deliveries.append({
+                "at": time.time(),
+                "content": content,
+                "filenames": [file.filename for file in (files or [])],
+                "ephemeral": ephemeral
+            })
+        finally:
+            # Discord closes them once sent. Each one may own a file descriptor.
+            for file in (files or []):
+                file.close()
+
+class SubmitAPI:
+
+    def __init__(
+        self,
+        submit:Callable[[dict, RecordingReference], dict],
+        is_done:Callable[[int, RecordingReference], bool],
+        stats:Callable[[], dict]):
+        """submit(parameters, reference) queues a job sending its
+        messages to reference, and returns its description, with a
+        "job_id". It raises SubmissionRefused when the job is refused.
+        is_done(job_id, reference) tells if every message of the job
+        was delivered."""
+        self.submit = submit
+        self.is_done = is_done
+        self.stats = stats
+        # job_id : reference
+        self.references:OrderedDict[int, RecordingReference] = OrderedDict()
+
+        self.app = web.Application(client_max_size = MAX_REQUEST_SIZE)
+        self.app.add_routes([
+            web.post("/jobs", self.post_job),
+            web.get("/jobs/{job_id}", self.get_job),
+            web.get("/stats", self.get_stats),
+        ])
+        self.runner:web.AppRunner = None
+
+    async def post_job(self, request:web.Request) -> web.Response:
+        try:
+            parameters = await request.json()
+        except ValueError:
+            return web.json_response({"error": "The body must be a JSON object"}, status = 400)
+        if not isinstance(parameters, dict):
+            return web.json_response({"error": "The body must be a JSON object"}, status = 400)
+
+        reference = RecordingReference()
+        try:
+            description = self.submit(parameters, reference)
+        except SubmissionRefused as e:
+            return web.json_response({"error": str(e)}, status = e.status)
+
+        self.references[description["job_id"]] = reference
+        while len(self.references) > MAX_RECORDED_JOBS:
+            self.references.popitem(last = False)
+        return web.json_response(description, status = 201)
+
+    async def get_job(self, request:web.Request) -> web.Response:
+        try:
+            job_id = int(request.match_info["job_id"])
+        except ValueError:
+            return web.json_response({"error": "Invalid job identifier"}, status = 400)
+        reference = self.references.get(job_id)
+        if reference == None:
+            return web.json_response({"error": f"Unknown job {job_id}"}, status = 404)
+        return web.json_response({
+            "job_id": job_id,
+            "done": self.is_done(job_id, reference),
+            "deliveries": reference.deliveries
+        })
+
+    async def get_stats(self, request:web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def serve(self, host:str, port:int):
+        """Serve the API from the running event loop"""
+        self.runner = web.AppRunner(self.app, access_log = None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
@@ -0,0 +1,111 @@
+import json
+import os
+import tempfile
+
+import torch
+from diffusers import AutoencoderKL, EulerAncestralDiscreteScheduler, StableDiffusionPipeline, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+# A very small, randomly initialized, StableDiffusion pipeline.
+# The generated images are just noise, but the whole generation
+# path runs, on CPU, in a fraction of a second, without downloading
+# anything.
+# Useful to test the bot, the job queue and the workers pool.
+
+TINY_MODEL_NAME = "tiny-random"
+
+def _bytes_to_unicode() -> dict:
+    # Same mapping as the one used by the CLIP byte-level BPE tokenizer
+    byte_values = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    characters = byte_values[:]
+    n = 0
+    for byte_value in range(2**8):
+        if byte_value not in byte_values:
+            byte_values.append(byte_value)
+            characters.append(2**8 + n)
+            n += 1
+    return dict(zip(byte_values, [chr(character) for character in characters]))
+
+def _tiny_tokenizer() -> CLIPTokenizer:
+    # Character-level vocabulary, without any merge.
+    characters = list(_bytes_to_unicode().values())
+    vocabulary = {}
+    for character in characters:
+        vocabulary[character] = len(vocabulary)
+    for character in characters:
+        vocabulary[character + "</w>"] = len(vocabulary)
+    vocabulary["<|startoftext|>"] = len(vocabulary)
+    vocabulary["<|endoftext|>"] = len(vocabulary)
+
+    # The files are only read while building the tokenizer
+    with tempfile.TemporaryDirectory(prefix="degu_tiny_tokenizer_") as tokenizer_dir:
+        vocabulary_filepath = os.path.join(tokenizer_dir, "vocab.json")
+        merges_filepath = os.path.join(tokenizer_dir, "merges.txt")
+        with open(vocabulary_filepath, "w", encoding="utf-8") as vocabulary_file:
+            json.dump(vocabulary, vocabulary_file)
+        with open(merges_filepath, "w", encoding="utf-8") as merges_file:
+            merges_file.write("#version: 0.2\n")
+        return CLIPTokenizer(vocabulary_filepath, merges_filepath, model_max_length=77)
+
+def _randomize_weights(model:torch.nn.Module, generator:torch.Generator):
+    # From generator only, so that building a pipeline never reseeds
+    # the process wide RNG used by the other workers.
+    # Normalization weights keep their default value (ones).
+    with torch.no_grad():
+        for name, parameter in sorted(model.named_parameters()):
+            if parameter.dim() > 1:
+                parameter.normal_(0, 0.02, generator = generator)
+            elif name.endswith("bias"):
+                parameter.zero_()
+
+def build_tiny_pipeline(seed:int = 0) -> StableDiffusionPipeline:
+    generator = torch.Generator().manual_seed(seed)
+
+    tokenizer = _tiny_tokenizer()
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size              = len(tokenizer.get_vocab()),
+        bos_token_id            = tokenizer.bos_token_id,
+        eos_token_id            = tokenizer.eos_token_id,
+        pad_token_id            = tokenizer.pad_token_id,
+        hidden_size             = 32,
+        intermediate_size       = 37,
+        num_attention_heads     = 4,
+        num_hidden_layers       = 2,
+        max_position_embeddings = 77,
+        projection_dim          = 32))
+
+    unet = UNet2DConditionModel(
+        block_out_channels  = (32, 64),
+        layers_per_block    = 1,
+        sample_size         = 32,
+        in_channels         = 4,
+        out_channels        = 4,
+        down_block_types    = ("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types      = ("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim = 32,
+        attention_head_dim  = 8,
+        norm_num_groups     = 32)
+
+    vae = AutoencoderKL(
+        block_out_channels = [32, 64],
+        in_channels        = 3,
+        out_channels       = 3,
+        down_block_types   = ["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types     = ["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels    = 4,
+        norm_num_groups    = 32)
+
+    for model in (text_encoder, unet, vae):
+        _randomize_weights(model, generator)
+
+    scheduler = EulerAncestralDiscreteScheduler(steps_offset=1)
+
+    return StableDiffusionPipeline(
+        vae                     = vae,
+        text_encoder            = text_encoder,
+        tokenizer               = tokenizer,
+        unet                    = unet,
+        scheduler               = scheduler,
+        safety_checker          = None,
+        feature_extractor       = None,
+        requires_safety_checker = False)
@@ -0,0 +1,217 @@
+import asyncio
+from collections import deque
+import os
+import time
+import traceback
+from typing import Awaitable, Callable
+
+import aiohttp # (installed with discord.py)
+
+# Sends messages and attachments to destinations (Discord threads,
+# interactions followups, ...) through a user provided send coroutine :
+#   await send(destination, content, attachments, ephemeral)
+#
+# * Messages to the same destination are sent one after the other,
+#   in the order they were queued.
+# * Consecutive attachments queued for the same destination are
+#   coalesced into a single message, up to max_attachments files.
+# * At most max_concurrency messages are being sent at any time.
+# * Failed sends are retried when retry_delay(exception, attempt)
+#   returns a delay, in seconds.
+#
+# Attachments are (source, filename) tuples. source is a filepath or a
+# BytesIO. They are given as is to send, on every attempt, so that send
+# can build new file objects for each attempt.
+
+# Discord limits
+DISCORD_MAX_ATTACHMENTS = 10
+DISCORD_MAX_CONTENT_LENGTH = 2000
+MAX_RETRY_DELAY = 30
+
+def default_retry_delay(exception:Exception, attempt:int, base_delay:float = 1.0) -> float:
+    """Delay before retrying a failed send, or None when retrying is useless"""
+    retry_after = getattr(exception, "retry_after", None)
+    if retry_after != None:
+        return float(retry_after)
+
+    backoff = min(MAX_RETRY_DELAY, base_delay * (2 ** attempt))
+    # HTTP errors : Rate limits and server errors are transient.
+    # Other 4xx errors will fail the same way next time.
+    status = getattr(exception, "status", None)
+    if isinstance(status, int):
+        return backoff if status == 429 or status >= 500 else None
+
+    # Missing or unreadable attachments won't appear by themselves
+    if isinstance(exception, (FileNotFoundError, PermissionError, IsADirectoryError)):
+        return None
+    if isinstance(exception, (ConnectionError, TimeoutError, asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+        return backoff
+    return None
+
+def attachment_size(attachment:tuple) -> int:
+    source, _ = attachment
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer().nbytes
+    try:
+        return os.path.getsize(source)
+    except (OSError, TypeError):
+        return 0
+
+class PendingMessage:
+    def __init__(self, content:str, attachments:list[tuple], ephemeral:bool):
+        self.content:str = content
+        self.attachments:list[tuple] = attachments
+        self.ephemeral:bool = ephemeral
+        self.queued_at:float = time.monotonic()
+
+class UploadQueue:
+
+    def __init__(
+        self,
+        send:Callable[..., Awaitable],
+        max_attachments:int = DISCORD_MAX_ATTACHMENTS,
+        max_content_length:int = DISCORD_MAX_CONTENT_LENGTH,
+        max_message_bytes:int = 0,
+        max_concurrency:int = 4,
+        max_attempts:int = 4,
+        coalesce_delay:float = 0,
+        retry_delay:Callable = default_retry_delay):
+        """max_message_bytes limits the total size of the attachments
+        coalesced in one message. 0 means no limit.
+        coalesce_delay is the time waited, before sending attachments,
+        for the next ones to arrive."""
+
+        self.send = send
+        self.max_attachments:int = max(1, max_attachments)
+        self.max_content_length:int = max_content_length
+        self.max_message_bytes:int = max_message_bytes
+        self.max_attempts:int = max(1, max_attempts)
+        self.coalesce_delay:float = max(0, coalesce_delay)
+        self.retry_delay:Callable = retry_delay
+        self.sending_slots = asyncio.Semaphore(max(1, max_concurrency))
+        # Keyed by id(destination)
+        self.pending:dict[int, deque] = {}
+        self.senders:dict[int, asyncio.Task] = {}
+        # Statistics
+        self.queued:int = 0
+        self.messages_sent:int = 0
+        self.attachments_sent:int = 0
+        self.retries:int = 0
+        self.rate_limited:int = 0
+        self.failures:int = 0
+        self.longest_wait:float = 0
+        # Successful sends only
+        self.send_seconds:float = 0
+        self.slowest_send:float = 0
+
+    def enqueue(self, destination, content:str = None, attachments:list[tuple] = None, ephemeral:bool = False):
+        """Queue a message. Must be called from the event loop thread."""
+        key = id(destination)
+        if key not in self.pending:
+            self.pending[key] = deque()
+        self.pending[key].append(PendingMessage(content, list(attachments or []), ephemeral))
+        self.queued += 1
+
+        if key not in self.senders:
+            self.senders[key] = asyncio.get_running_loop().create_task(self._send_pending(key, destination))
+
+    def is_idle(self, destination) -> bool:
+        """True when every message queued to destination was sent, or failed"""
+        return id(destination) not in self.senders
+
+    def pending_messages(self) -> int:
+        return sum(len(messages) for messages in self.pending.values())
+
+    async def join(self):
+        """Wait until every queued message is sent, or failed"""
+        while self.senders:
+            await asyncio.gather(*list(self.senders.values()), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "pending": self.pending_messages(),
+            "messages_sent": self.messages_sent,
+            "attachments_sent": self.attachments_sent,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+            "longest_wait": self.longest_wait,
+            "send_seconds": self.send_seconds,
+            "slowest_send": self.slowest_send
+        }
+
+    async def _send_pending(self, key:int, destination):
+        messages = self.pending[key]
+        try:
+            while messages:
+                if self.coalesce_delay and messages[0].attachments and len(messages) < self.max_attachments:
+                    await asyncio.sleep(self.coalesce_delay)
+                merged = self._next_message(messages)
+                await self._send_with_retries(destination, merged)
+        finally:
+            # No await since the last check. Nothing was queued in between.
+            del self.senders[key]
+            if not messages:
+                del self.pending[key]
+
+    def _can_merge(self, merged:PendingMessage, message:PendingMessage, merged_bytes:int) -> bool:
+        if (not message.attachments) or message.ephemeral != merged.ephemeral:
+            return False
+        if len(merged.attachments) + len(message.attachments) > self.max_attachments:
+            return False
+        content_length = len(merged.content or "") + len(message.content or "") + 1
+        if content_length > self.max_content_length:
+            return False
+        if self.max_message_bytes:
+            added_bytes = sum(attachment_size(attachment) for attachment in message.attachments)
+            if merged_bytes + added_bytes > self.max_message_bytes:
+                return False
+        return True
+
+    def _next_message(self, messages:deque) -> PendingMessage:
+        first = messages.popleft()
+        self.longest_wait = max(self.longest_wait, time.monotonic() - first.queued_at)
+        if not first.attachments:
+            return first
+
+        merged = PendingMessage(first.content, list(first.attachments), first.ephemeral)
+        merged_bytes = sum(attachment_size(attachment) for attachment in first.attachments) if self.max_message_bytes else 0
+        while messages and self._can_merge(merged, messages[0], merged_bytes):
+            message = messages.popleft()
+            self.longest_wait = max(self.longest_wait, time.monotonic() - message.queued_at)
+            if message.content:
+                merged.content = f"{merged.content}\n{message.content}" if merged.content else message.content
+            merged.attachments.extend(message.attachments)
+            if self.max_message_bytes:
+                merged_bytes += sum(attachment_size(attachment) for attachment in message.attachments)
+        return merged
+
+    async def _send_with_retries(self, destination, message:PendingMessage):
+        attempt = 0
+        while True:
+            async with self.sending_slots:
+                try:
+                    send_began_at = time.monotonic()
+                    await self.send(destination, message.content, message.attachments, message.ephemeral)
+                    send_duration = time.monotonic() - send_began_at
+                    self.send_seconds += send_duration
+                    self.slowest_send = max(self.slowest_send, send_duration)
+                    self.messages_sent += 1
+                    self.attachments_sent += len(message.attachments)
+                    return
+                except Exception as e:
+                    error = e
+
+            if getattr(error, "status", None) == 429:
+                self.rate_limited += 1
+            delay = self.retry_delay(error, attempt)
+            attempt += 1
+            if delay == None or attempt >= self.max_attempts:
+                self.failures += 1
+                print(f"[UploadQueue] Giving up sending a message after {attempt} attempts")
+                traceback.print_exception(error)
+                return
+
+            self.retries += 1
+            await asyncio.sleep(delay)
@@ -1,45 +1,181 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import Future, ThreadPoolExecutor
+import functools
+import hashlib
 import json
 import io
 import logging
 import os
 import pathlib
 import random
+import re
+import resource
 import shutil
 import sys
-from typing import NamedTuple
+import tempfile
+import threading
+from typing import Callable, NamedTuple
 import time
 import traceback
 
 from diffusers import StableDiffusionPipeline, DiffusionPipeline, EulerAncestralDiscreteScheduler
 from PIL.Image import Image
-from PIL.PngImagePlugin import PngInfo
 import torch
 from safetensors.torch import load_file
 
+from myylibs.acceleration import accelerate_pipeline, use_compile_cache
+from myylibs.imageencoders import ImageEncoder
+from myylibs.imagesindex import ImagesIndex
+from myylibs.lrucache import SizedLRUCache
+from myylibs.memorypolicy import MemoryEstimator, MEMORY_POLICIES, AUTO_MEMORY_POLICY, apply_memory_policy, device_memory_budget, is_out_of_memory, usable_policies
+from myylibs.precision import Precision, resolve_precision
+from myylibs.profiling import ProfilingSession
+from myylibs.tinypipeline import TINY_MODEL_NAME, build_tiny_pipeline
+
 
 
 REPLACERS_FILEPATH="config/replacers.json"
 OLD_REPLACER_FILEPATH="replacers.json"
 REPLACER_SAMPLE_FILEPATH="replacers.json.sample"
 
+NEGATIVE_PROMPT="lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry, artist name"
+# Denoising steps of the warm-up batches
+WARMUP_INFERENCES=2
+
+# Used when the batch size is set to 0 (automatic).
+# Rough amount of device memory used by one 512x512 fp32 image during a batch.
+AUTO_BATCH_BYTES_PER_512_IMAGE=1536 * 1024 * 1024
+AUTO_BATCH_MAX_SIZE=8
+
+class GenerationAborted(Exception):
+    pass
+
 SpecialTag = NamedTuple('SpecialTag', words=list[str], join_word=str, min=int, max=int, max_occurences=int)
 
+# Tags looking like {some_name}, which can be found with a simple index lookup
+BRACE_TAG_PATTERN = re.compile(r"\{[^{}]*\}")
+
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
+def random_words_from_tag(replacer:SpecialTag) -> list[str]:
+    names = replacer.words
+    n_names = random.randint(
+        min(replacer.min, len(names)),
+        min(replacer.max, len(names)))
+    return random.sample(names, n_names)
+
+class SpecialTagsReplacer():
+    """Expands the special tags of a prompt in a single scan.
+
+    Tags are found with one regular expression, and every occurence
+    is expanded while building the new prompt, instead of rebuilding
+    the prompt for each replacement.
+    When every tag looks like {name}, occurences are found with a generic
+    brace pattern and a dictionary lookup, whatever the number of tags.
+    """
+
+    def __init__(self, tags:dict[str, SpecialTag], pick_words = random_words_from_tag):
+        self.tags:dict[str, SpecialTag] = {name: tag for name, tag in tags.items() if tag != None}
+        self.pick_words = pick_words
+        self.pattern:re.Pattern = None
+
+        names = sorted(self.tags, key=len, reverse=True)
+        if names:
+            if all(BRACE_TAG_PATTERN.fullmatch(name) for name in names):
+                self.pattern = BRACE_TAG_PATTERN
+            else:
+                self.pattern = re.compile("|".join(re.escape(name) for name in names))
+
+        # When replacement words contain tags, or tags contain other tags,
+        # the result depends on the replacement order. Keep the
+        # historical tag after tag behaviour in that case.
+        self.single_pass = not self._has_nested_tags(names)
+
+    def _has_nested_tags(self, names:list[str]) -> bool:
+        any_name = re.compile("|".join(re.escape(name) for name in names))
+        for name in names:
+            for other_name in names:
+                if other_name != name and other_name in name:
+                    return True
+            for word in self.tags[name].words:
+                if any_name.search(word):
+                    return True
+        return False
+
+    def replace(self, prompt:str) -> str:
+        if self.pattern == None:
+            return prompt
+
+        if not self.single_pass:
+            return self._replace_tag_after_tag(prompt)
+
+        occurences = {}
+        def expand(match:re.Match) -> str:
+            tag_name = match.group(0)
+            tag = self.tags.get(tag_name)
+            if tag == None:
+                return tag_name
+
+            tag_occurences = occurences.get(tag_name, 0)
+            occurences[tag_name] = tag_occurences + 1
+            if tag_occurences >= tag.max_occurences:
+                return ""
+            return tag.join_word.join(self.pick_words(tag))
+
+        return self.pattern.sub(expand, prompt)
+
+    def _replace_tag_after_tag(self, prompt:str) -> str:
+        for tag_name, tag in self.tags.items():
+            if tag_name not in prompt:
+                continue
+
+            occurences = 0
+            max_occurences = tag.max_occurences
+
+            while tag_name in prompt:
+                if occurences >= max_occurences:
+                    prompt = prompt.replace(tag_name, "")
+                    break
+
+                names_list = self.pick_words(tag)
+
+                prompt = prompt.replace(tag_name, tag.join_word.join(names_list), 1)
+                occurences += 1
+
+        return prompt
+
+class ImageEncodingStage():
+    """Encodes and saves the generated images in background threads,
+    so that the worker can start the next denoising run right away."""
+
+    def __init__(self, n_threads:int = 2, max_pending:int = 8):
+        self.pool = ThreadPoolExecutor(max_workers = max(1, n_threads), thread_name_prefix = "DeguEncoder")
+        # Bounds the number of images waiting to be encoded.
+        # The worker waits when the limit is reached.
+        self.pending_slots = threading.BoundedSemaphore(max(1, max_pending))
+
+    def submit(self, task:Callable) -> Future:
+        self.pending_slots.acquire()
+        future = self.pool.submit(task)
+        future.add_done_callback(lambda _: self.pending_slots.release())
+        return future
+
 class DeguDiffusionWorker():
 
-    def __init__(self, sd_token:str, output_folder:str="", save_to_disk:bool=True, model_name:str="CompVis/stable-diffusion-v1-4", mode:str="fp32", local_only:bool=False, sd_cache_dir:str="", torch_device="cuda", additional_model=""):
+    def __init__(self, sd_token:str, output_folder:str="", save_to_disk:bool=True, model_name:str="CompVis/stable-diffusion-v1-4", mode:str="fp32", local_only:bool=False, sd_cache_dir:str="", torch_device="cuda", additional_model="", batch_size:int=1, embeddings_cache_mb:int=64, converted_models_dir:str="", encoding_threads:int=2, max_pending_encodes:int=8, archive_format:str="png", delivery_format:str="", images_index_filepath:str="", results_cache_mb:int=128, thumbnail_size:int=0, memory_policy:str="full", memory_budget_mb:int=0, images_width:int=512, images_height:int=512, acceleration:str="none", compile_cache_dir:str="", warmup_sizes:list[tuple[int, int]]=None):
 
         # Test
         logger = logging.getLogger('DeguDiffusionWorker')
 
         logger.info('Initializing StableDiffusion')
+        startup_began_at = time.monotonic()
         self.logger = logger
         self.model_name = model_name
         self.torch_device = torch_device
         self.save_to_disk = save_to_disk
+        # 0 means "pick the batch size from the available memory"
+        self.batch_size = max(0, batch_size)
         if save_to_disk:
             if not output_folder:
                 raise ValueError(f"No output directory provided")
@@ -62,38 +198,213 @@ class DeguDiffusionWorker():
         if local_only:
             pipeline_kwargs["local_files_only"] = True
 
-        if mode == "fp16":
+        # fp32, fp16, bf16 or auto. Checked against the device
+        # before loading anything.
+        self.precision:Precision = resolve_precision(mode, self.torch_device)
+        # Models don't always provide fp16 weight files. Only ask for them
+        # explicitly. Otherwise, the default weights are converted.
+        if mode.lower() == "fp16":
             pipeline_kwargs["variant"] = "fp16"
-            pipeline_kwargs["torch_dtype"] = torch.float16
-        pipeline_kwargs["torch_dtype"] = torch.float16
+        pipeline_kwargs["torch_dtype"] = self.precision.dtype
+        self.dtype = self.precision.dtype
+        logger.info(f"Precision : {self.precision}")
 
         #scheduler = DDIMScheduler.from_pretrained(self.model_name, subfolder="scheduler", **pipeline_kwargs)
         #scheduler = DPMSolverMultistepScheduler.from_pretrained(self.model_name, subfolder="scheduler")
         #pipeline_kwargs["scheduler"] = scheduler
-        if not self.model_name.startswith("./"):
+        if self.model_name == TINY_MODEL_NAME:
+            pipe = build_tiny_pipeline().to(dtype = self.dtype)
+        elif not self.model_name.startswith("./"):
             pipe = DiffusionPipeline.from_pretrained(self.model_name, **pipeline_kwargs)
         else:
-            pipe = StableDiffusionPipeline.from_single_file(self.model_name, **pipeline_kwargs)
+            pipe = self.load_single_file(self.model_name, pipeline_kwargs, converted_models_dir)
         pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
-        #pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
+        # channels-last, and torch.compile of the UNet and the VAE decoder.
+        # Compiled on the first images. See warm_up.
+        self.acceleration:str = acceleration
+        if acceleration == "compile":
+            use_compile_cache(compile_cache_dir)
+        accelerate_pipeline(pipe, acceleration)
+        logger.info(f"Acceleration : {acceleration}")
 
         #pipe = StableDiffusionPipeline.from_pretrained(pathlib.Path("./stablediffusion_cache/nai"), **pipeline_kwargs)
 
-        pipe.to(self.torch_device)
-        #pipe.enable_attention_slicing()
+        self.pipe = pipe
+        # Attention slicing, VAE slicing or tiling, or offloading.
+        # In auto mode, the fastest one fitting in the memory budget is
+        # picked for each batch.
+        if memory_policy != AUTO_MEMORY_POLICY and memory_policy not in MEMORY_POLICIES:
+            raise ValueError(f"Unknown memory policy {memory_policy}. Known policies : {AUTO_MEMORY_POLICY}, {', '.join(MEMORY_POLICIES)}")
+        self.usable_memory_policies:tuple = usable_policies(self.torch_device)
+        if memory_policy != AUTO_MEMORY_POLICY and memory_policy not in self.usable_memory_policies:
+            logger.warning(f"The {memory_policy} memory policy saves nothing on {self.torch_device}. Using {self.usable_memory_policies[-1]}")
+            memory_policy = self.usable_memory_policies[-1]
+        self.memory_policy_setting:str = memory_policy
+        self.memory_budget:int = memory_budget_mb * 1024 * 1024 if memory_budget_mb > 0 else device_memory_budget(self.torch_device)
+        self.memory_estimator = MemoryEstimator(pipe, self.dtype)
+        # The policy to use at least, for a (batch size, width, height),
+        # after running out of memory with a faster one
+        self.memory_policy_floors:dict[tuple, str] = {}
+        # Currently applied to the pipeline
+        self.memory_policy:str = None
+        # Picked for the usual images, until the first batch
+        self.use_memory_policy(self.memory_policy_for(self.batch_size_for(images_width, images_height), images_width, images_height))
         logger.debug(str(pipe))
 
         # Worker specific values
         self.output_folder:pathlib.Path = pathlib.Path(output_folder) if output_folder else None
-        self.pipe = pipe
         self.results = {}
+        # Images are saved with the archive encoder, and sent
+        # with the delivery encoder, when one is set.
+        self.archive_encoder:ImageEncoder = ImageEncoder.from_spec(archive_format or "png")
+        self.delivery_encoder:ImageEncoder = ImageEncoder.from_spec(delivery_format) if delivery_format else None
+        # When set, a small copy of every image is added to the reports.
+        # Used to compose contact sheets.
+        self.thumbnail_size:int = max(0, thumbnail_size)
+        # Metadata of the saved images, for quick lookups
+        self.images_index:ImagesIndex = None
+        if save_to_disk and images_index_filepath:
+            self.images_index = ImagesIndex(images_index_filepath)
+        # 0 encoding threads means encoding right after the denoising
+        self.encoding_stage:ImageEncodingStage = None
+        if encoding_threads > 0:
+            self.encoding_stage = ImageEncodingStage(encoding_threads, max_pending_encodes)
         self.replacers:dict = self.load_replacers(
             replacers_filepath     = REPLACERS_FILEPATH,
             sample_filepath        = REPLACER_SAMPLE_FILEPATH,
             old_replacers_filepath = OLD_REPLACER_FILEPATH)
+        self.special_tags_replacer = self.compile_replacers(self.replacers)
+
+        # Text encoder outputs, keyed by (model, expanded prompt).
+        # Only StableDiffusionPipeline accepts precomputed embeddings
+        # the way we provide them.
+        self.embeddings_cache:SizedLRUCache = None
+        if embeddings_cache_mb > 0 and isinstance(pipe, StableDiffusionPipeline):
+            self.embeddings_cache = SizedLRUCache(
+                embeddings_cache_mb * 1024 * 1024,
+                lambda tensor: tensor.element_size() * tensor.nelement())
+
+        # Generated images, keyed by a hash of everything that
+        # determines them. Repeated requests with a fixed seed
+        # are then answered without running the pipeline.
+        self.scheduler_config:str = json.dumps(dict(pipe.scheduler.config), sort_keys=True, default=str)
+        self.results_cache:SizedLRUCache = None
+        if results_cache_mb > 0:
+            self.results_cache = SizedLRUCache(
+                results_cache_mb * 1024 * 1024,
+                lambda image: image.width * image.height * len(image.getbands()))
+
+        # Set by start_profiling, for the next images only
+        self.profiling:ProfilingSession = None
+
+        # Compiling happens on the first batches of each shape.
+        # Better now than on the first user images.
+        self.warmup_seconds:float = 0
+        if acceleration == "compile":
+            self.warm_up(warmup_sizes or [(512, 512)])
                     
         logger.info(f"Using model {model_name}")
-        logger.info("StableDiffusion ready to go")
+        logger.info(f"StableDiffusion ready to go (started in {time.monotonic() - startup_began_at:.1f} seconds)")
+
+    def load_single_file(self, checkpoint_filepath:str, pipeline_kwargs:dict, converted_models_dir:str = "") -> StableDiffusionPipeline:
+        """Load a single file checkpoint.
+
+        Converting a checkpoint to the diffusers layout takes a while.
+        When converted_models_dir is set, the converted pipeline is saved
+        there, as safetensors, on the first load. Following loads use
+        that copy directly, as long as the checkpoint file doesn't change.
+        """
+
+        load_began_at = time.monotonic()
+        if not converted_models_dir:
+            pipe = StableDiffusionPipeline.from_single_file(checkpoint_filepath, **pipeline_kwargs)
+            self.logger.info(f"Converted {checkpoint_filepath} in {time.monotonic() - load_began_at:.1f} seconds")
+            return pipe
+
+        checkpoint_path = pathlib.Path(checkpoint_filepath).resolve()
+        checkpoint_stat = checkpoint_path.stat()
+        dtype = pipeline_kwargs.get("torch_dtype", torch.float32)
+        # The path identifies the checkpoint, the rest identifies its version
+        path_key = hashlib.sha256(str(checkpoint_path).encode("utf-8")).hexdigest()[:8]
+        version_key = hashlib.sha256(
+            f"{checkpoint_stat.st_size}:{checkpoint_stat.st_mtime_ns}:{dtype}".encode("utf-8")).hexdigest()[:16]
+        converted_prefix = f"{checkpoint_path.stem}-{path_key}-"
+        converted_path = pathlib.Path(converted_models_dir) / f"{converted_prefix}{version_key}"
+
+        converted_kwargs = {"torch_dtype": dtype, "use_safetensors": True, "local_files_only": True}
+        converted_is_broken = False
+        if (converted_path / "model_index.json").is_file():
+            try:
+                pipe = StableDiffusionPipeline.from_pretrained(converted_path, **converted_kwargs)
+                self.logger.info(f"Loaded the converted {checkpoint_filepath} from {converted_path} in {time.monotonic() - load_began_at:.1f} seconds")
+                return pipe
+            except Exception as e:
+                traceback.print_exception(e)
+                self.logger.warning(f"Could not load the converted model from {converted_path}. Converting it again.")
+                converted_is_broken = True
+
+        pipe = StableDiffusionPipeline.from_single_file(checkpoint_filepath, **pipeline_kwargs)
+        self.logger.info(f"Converted {checkpoint_filepath} in {time.monotonic() - load_began_at:.1f} seconds")
+
+        try:
+            pathlib.Path(converted_models_dir).mkdir(parents = True, exist_ok = True)
+            # Save to a temporary directory first, so that an interrupted
+            # save is never mistaken for a complete one. Unique to this
+            # worker : the other workers may be converting the same checkpoint.
+            temporary_path = pathlib.Path(tempfile.mkdtemp(prefix=".saving-", dir=converted_models_dir))
+            try:
+                pipe.save_pretrained(temporary_path, safe_serialization=True)
+                if converted_is_broken:
+                    # Moved away in one step, so that nobody sees it half removed
+                    discarded_path = tempfile.mkdtemp(prefix=".discarding-", dir=converted_models_dir)
+                    try:
+                        os.replace(converted_path, discarded_path)
+                    except FileNotFoundError:
+                        # Another worker discarded it already
+                        pass
+                    shutil.rmtree(discarded_path, ignore_errors=True)
+                # Never replaces a non empty directory. When another worker
+                # saved the same conversion meanwhile, its copy is kept.
+                try:
+                    os.replace(temporary_path, converted_path)
+                    self.logger.info(f"Saved the converted model to {converted_path}")
+                except OSError:
+                    if not (converted_path / "model_index.json").is_file():
+                        raise
+                    self.logger.info(f"The converted model was saved to {converted_path} by another worker")
+            finally:
+                shutil.rmtree(temporary_path, ignore_errors=True)
+
+            # Previous conversions of the same checkpoint are outdated
+            for previous_path in pathlib.Path(converted_models_dir).glob(f"{converted_prefix}*"):
+                if previous_path != converted_path:
+                    shutil.rmtree(previous_path, ignore_errors=True)
+        except Exception as e:
+            traceback.print_exception(e)
+            self.logger.warning(f"Could not save the converted model to {converted_models_dir}")
+
+        return pipe
+
+    def prompt_embeddings(self, prompt:str) -> torch.Tensor:
+        key = (self.model_name, prompt)
+        embeddings = self.embeddings_cache.get(key)
+        if embeddings == None:
+            with torch.no_grad():
+                embeddings, _ = self.pipe.encode_prompt(
+                    prompt,
+                    device                      = self.pipe._execution_device,
+                    num_images_per_prompt       = 1,
+                    do_classifier_free_guidance = False)
+            self.embeddings_cache.put(key, embeddings)
+        return embeddings
+
+    def cache_stats(self) -> dict:
+        stats = {}
+        if self.embeddings_cache != None:
+            stats["embeddings"] = self.embeddings_cache.stats()
+        if self.results_cache != None:
+            stats["results"] = self.results_cache.stats()
+        return stats
 
     def generate_image(
         self,
@@ -103,73 +414,549 @@ class DeguDiffusionWorker():
         deterministic = True,
         width:int = 512,
         height:int = 512):
-        
-        report = {}
-        generator = None
+
+        result = self.generate_images(
+            batch_size     = 1,
+            prompt         = prompt,
+            n_inferences   = n_inferences,
+            guidance_scale = guidance_scale,
+            deterministic  = deterministic,
+            width          = width,
+            height         = height)[0]
+
+        if isinstance(result, Future):
+            result = result.result()
+        return result
+
+    def batch_size_for(self, width:int, height:int) -> int:
+        if self.batch_size > 0:
+            return self.batch_size
+
+        # Auto mode : Guess how many images fit in the memory currently
+        # available on the device. The estimation is rough, on purpose.
+        megapixels = max((width * height) / (512 * 512), 0.25)
+        bytes_per_image = AUTO_BATCH_BYTES_PER_512_IMAGE * megapixels
+        if self.dtype != torch.float32:
+            bytes_per_image /= 2
+
+        available_bytes = 0
+        try:
+            if self.torch_device.startswith("cuda"):
+                available_bytes, _ = torch.cuda.mem_get_info(self.torch_device)
+            else:
+                available_bytes = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except Exception as e:
+            self.logger.warning(f"Could not determine the available memory ({e}). Using batches of 1 image")
+            return 1
+
+        return max(1, min(AUTO_BATCH_MAX_SIZE, int(available_bytes // bytes_per_image)))
+
+    def memory_policy_for(self, batch_size:int, width:int, height:int) -> str:
+        policy = self.memory_policy_setting
+        if policy == AUTO_MEMORY_POLICY:
+            policy = self.memory_estimator.cheapest_policy(self.usable_memory_policies, self.memory_budget, batch_size, width, height)
+
+        floor = self.memory_policy_floors.get((batch_size, width, height))
+        if floor != None and MEMORY_POLICIES.index(floor) > MEMORY_POLICIES.index(policy):
+            policy = floor
+        return policy
+
+    def use_memory_policy(self, policy:str):
+        if policy == self.memory_policy:
+            return
+        try:
+            apply_memory_policy(self.pipe, policy, self.memory_policy, self.torch_device)
+        except Exception:
+            # Half applied. Everything is applied again next time.
+            self.memory_policy = None
+            raise
+        self.logger.info(f"Memory policy : {policy} (previously {self.memory_policy})")
+        self.memory_policy = policy
+
+    def warm_up(self, sizes:list[tuple[int, int]]):
+        """Generate throwaway batches at each (width, height) of sizes,
+        so that the compiled modules are ready for them. Batches of one
+        image and of batch_size images, so that the batch size is
+        compiled as dynamic, and partial batches don't compile again."""
+        warmup_began_at = time.monotonic()
+        for width, height in sizes:
+            for batch_size in sorted({1, self.batch_size_for(width, height)}):
+                began_at = time.monotonic()
+                self._denoise_within_memory(
+                    [""] * batch_size,
+                    [None] * batch_size,
+                    width          = width,
+                    height         = height,
+                    n_inferences   = WARMUP_INFERENCES,
+                    guidance_scale = 7.5)
+                self.logger.info(f"Warm-up {width}x{height}, batch of {batch_size} : {time.monotonic() - began_at:.1f} seconds")
+        self.warmup_seconds = time.monotonic() - warmup_began_at
+
+    def _empty_device_cache(self):
+        if str(self.torch_device).startswith("cuda"):
+            torch.cuda.empty_cache()
+
+    def peak_memory(self) -> int:
+        """Highest memory usage, in bytes, of the device since startup.
+        The whole process resident memory on CPU."""
+        try:
+            if self.torch_device.startswith("cuda"):
+                return torch.cuda.max_memory_allocated(self.torch_device)
+        except Exception:
+            return 0
+        # Kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _synchronize(self):
+        # CUDA kernels run asynchronously. Wait for them before reading the time.
+        if self.torch_device.startswith("cuda"):
+            torch.cuda.synchronize(self.torch_device)
+
+    def generate_batch(
+        self,
+        max_images: int,
+        prompt: str = "",
+        n_inferences: int = 50,
+        guidance_scale: float = 7.5,
+        deterministic = True,
+        width:int = 512,
+        height:int = 512,
+        per_image:list[dict] = None,
+        abort_check:Callable = None) -> list[dict]:
+        """Generate up to max_images, using the best batch size for the requested resolution.
+
+        per_image, when provided, holds the 'prompt' and 'deterministic'
+        values of each requested image. Used when batching images from
+        different jobs.
+        abort_check, when provided, is called at every denoising step.
+        When it returns True, the generation stops and GenerationAborted
+        is raised.
+        """
+
+        batch_size = min(max_images, self.batch_size_for(width, height))
+
+        seeds = None
+        prompts = None
+        if per_image:
+            per_image = per_image[:batch_size]
+            seeds = [image.get("deterministic", deterministic) for image in per_image]
+            prompts = [image.get("prompt", prompt) for image in per_image]
+
+        return self.generate_images(
+            batch_size     = batch_size,
+            prompt         = prompt,
+            n_inferences   = n_inferences,
+            guidance_scale = guidance_scale,
+            deterministic  = deterministic,
+            width          = width,
+            height         = height,
+            seeds          = seeds,
+            prompts        = prompts,
+            abort_check    = abort_check)
+
+    def _seed_and_generator(self, deterministic) -> tuple:
         seed = 'Unknown'
+        generator = None
         if deterministic:
             if type(deterministic) is int:
                 seed = deterministic
             else:
                 seed = torch.Generator(self.torch_device).seed()
             generator = torch.Generator(self.torch_device).manual_seed(seed)
+        return seed, generator
+
+    def _image_metadata(self, prompt:str, seed, guidance_scale:float, n_inferences:int, deterministic) -> dict:
+        # Written by the encoders, whatever the image format
+        metadata = {}
+        metadata["AI_Prompt"] = str(prompt)
+        metadata["AI_Torch_Seed"] = str(seed)
+        metadata["AI_StableDiffusion_Guidance_Scale"] = str(guidance_scale)
+        metadata["AI_StableDiffusion_Inferences"] = str(n_inferences)
+        metadata["AI_StableDiffusion_Model_Name"] = str(self.model_name)
+        #metadata["AI_Diffusers_Version"] = str(self.pipe._diffusers_version)
+        metadata["AI_Metadata_Type"] = "Voyage"
+        metadata["AI_Metadata_Voyage_Version"] = "0"
+        metadata["AI_Generator"] = str(self.model_name)
+        metadata["AI_Torch_Generator"] = str(self.torch_device)
+        metadata["AI_Torch_Precision"] = str(self.precision)
+        metadata["AI_Custom_Deterministic"] = str(deterministic)
+        metadata["AI_Prompt_Negative"] = str(NEGATIVE_PROMPT)
+        metadata["AI_StableDiffusion_Pipe"] = str(self.pipe)
+        return metadata
+
+    def _image_filepath(self, seed):
+        extension = self.archive_encoder.extension
+        timestamp = int(time.time())
+        filename = f"{timestamp}_SEED_{seed}{extension}"
+        if not self.output_folder:
+            return filename
+        if not self.save_to_disk:
+            return self.output_folder / filename
+
+        # Batches, and the other workers of the pool, threads or
+        # processes, can generate several images with the same seed
+        # during the same second. Don't overwrite them.
+        # The files are written later, by the encoding stage, so
+        # reserve the names until then, by creating them empty.
+        index = 0
+        while True:
+            suffix = f"_{index}" if index > 0 else ""
+            filepath = self.output_folder / f"{timestamp}_SEED_{seed}{suffix}{extension}"
+            try:
+                with open(filepath, "x"):
+                    return filepath
+            except FileExistsError:
+                index += 1
+
+    def _release_image_filepath(self, filepath):
+        """Remove the empty file reserving filepath, when the image
+        could not be written"""
+        try:
+            if os.path.getsize(filepath) == 0:
+                os.remove(filepath)
+        except OSError:
+            pass
+
+    def start_profiling(self, n_images:int, profiler:str = "torch", output_directory:str = "profiles"):
+        """Profile the generation of the next n_images images.
+        The results are written to output_directory."""
+        device_name = re.sub(r"[^A-Za-z0-9]", "", str(self.torch_device))
+        self.profiling = ProfilingSession(n_images, profiler, output_directory, name = device_name)
+        self.logger.info(f"Profiling the next {n_images} images with {profiler}")
+
+    def generate_images(self, *args, **kwargs) -> list[dict]:
+        if self.profiling == None:
+            return self._generate_images(*args, **kwargs)
+
+        profiling = self.profiling
+        try:
+            profiling.resume()
+        except Exception as e:
+            # Not worth failing the images for
+            self.profiling = None
+            profiling.close()
+            self.logger.warning(f"Could not start profiling : {e}")
+            return self._generate_images(*args, **kwargs)
+
+        results = []
+        try:
+            results = self._generate_images(*args, **kwargs)
+        finally:
+            try:
+                filepaths = profiling.pause(len(results))
+                if profiling.is_done():
+                    self.profiling = None
+                    self.logger.info(f"Profiling done : {', '.join(filepaths)}")
+            except Exception as e:
+                self.profiling = None
+                profiling.close()
+                self.logger.warning(f"Profiling failed : {e}")
+        return results
+
+    def _generate_images(
+        self,
+        batch_size: int = 1,
+        prompt: str = "",
+        n_inferences: int = 50,
+        guidance_scale: float = 7.5,
+        deterministic = True,
+        width:int = 512,
+        height:int = 512,
+        seeds:list = None,
+        prompts:list[str] = None,
+        abort_check:Callable = None) -> list[dict]:
+        """Generate batch_size images with a single pipeline call.
+
+        seeds and prompts, when provided, define the 'deterministic' value
+        and the prompt of each image, overriding deterministic and prompt.
+        One report per image is returned, in the same order.
+        When the encoding stage is enabled, each report is returned as a
+        Future, resolved once the image is encoded and saved.
+        """
+
+        if seeds == None:
+            seeds = [deterministic] * batch_size
+        if prompts == None:
+            prompts = [prompt] * len(seeds)
+        if len(prompts) != len(seeds):
+            raise ValueError(f"Got {len(prompts)} prompts for {len(seeds)} seeds")
+
+        reports = []
+        generators = []
+        actual_prompts = []
+        images = []
+        results_keys = []
+        for image_deterministic, original_prompt in zip(seeds, prompts):
+            seed, generator = self._seed_and_generator(image_deterministic)
+            tags_began_at = time.monotonic()
+            actual_prompt = self.replace_special_tags(original_prompt, self.replacers)
+            tags_seconds = time.monotonic() - tags_began_at
+
+            report = {}
+            report["actual_prompt"] = actual_prompt if original_prompt != actual_prompt else ""
+            report["seed"] = seed
+            report["timings"] = {"tags": tags_seconds}
+            reports.append(report)
+            generators.append(generator)
+            actual_prompts.append(actual_prompt)
+
+            # Only images generated from a known seed can be generated again
+            result_key = None
+            if self.results_cache != None and generator != None:
+                result_key = self._result_key(actual_prompt, seed, n_inferences, guidance_scale, width, height)
+            results_keys.append(result_key)
+            images.append(self.results_cache.get(result_key) if result_key != None else None)
+
+        to_generate = [index for index, image in enumerate(images) if image == None]
+        denoise_seconds = 0
+        stage_timings = {}
+        if to_generate:
+            denoise_began_at = time.monotonic()
+            generated_images, stage_timings = self._denoise_within_memory(
+                actual_prompts = [actual_prompts[index] for index in to_generate],
+                generators     = [generators[index] for index in to_generate],
+                n_inferences   = n_inferences,
+                guidance_scale = guidance_scale,
+                width          = width,
+                height         = height,
+                abort_check    = abort_check)
+            denoise_seconds = time.monotonic() - denoise_began_at
+            self.logger.debug(f"Denoised {len(to_generate)} images in {denoise_seconds:.2f} seconds")
+
+            for index, image in zip(to_generate, generated_images):
+                images[index] = image
+                if results_keys[index] != None:
+                    self.results_cache.put(results_keys[index], image)
+
+        # With an encoding stage, Futures resolving to the reports
+        # are returned, and the encoding happens in the background.
+        peak_memory = self.peak_memory()
+        results = []
+        for index, report in enumerate(reports):
+            nsfw_flag = False # result["nsfw_content_detected"][index]
+            report["nsfw"] = nsfw_flag
+            report["filepath"] = ""
+            report["filename"] = ""
+            # The saved file is sent as is, unless a delivery format is set
+            report["content_as"] = "file" if self.save_to_disk and self.delivery_encoder == None else "data"
+            report["cache_hit"] = index not in to_generate
+            # Durations of the whole batch, and its size
+            report["timings"]["denoise"] = 0 if report["cache_hit"] else denoise_seconds
+            report["timings"]["denoised_images"] = 0 if report["cache_hit"] else len(to_generate)
+            if not report["cache_hit"]:
+                report["timings"].update(stage_timings)
+            report["peak_memory"] = peak_memory
+            report["memory_policy"] = self.memory_policy
+
+            if nsfw_flag:
+                results.append(report)
+                continue
+
+            report["filepath"] = self._image_filepath(report["seed"])
+            delivery_encoder = self.delivery_encoder or self.archive_encoder
+            report["filename"] = pathlib.Path(report["filepath"]).stem + delivery_encoder.extension
+            encode = functools.partial(
+                self._encode_image,
+                report         = report,
+                image          = images[index],
+                prompt         = actual_prompts[index],
+                guidance_scale = guidance_scale,
+                n_inferences   = n_inferences,
+                deterministic  = seeds[index],
+                submitted_at   = time.monotonic())
+
+            if self.encoding_stage != None:
+                results.append(self.encoding_stage.submit(encode))
+            else:
+                results.append(encode())
+
+        return results
+
+    def _result_key(self, actual_prompt:str, seed:int, n_inferences:int, guidance_scale:float, width:int, height:int) -> str:
+        # Everything that changes the generated image
+        parameters = json.dumps([
+            actual_prompt,
+            NEGATIVE_PROMPT,
+            seed,
+            n_inferences,
+            float(guidance_scale),
+            width,
+            height,
+            self.model_name,
+            str(self.precision),
+            self.scheduler_config
+        ])
+        return hashlib.sha256(parameters.encode("utf-8")).hexdigest()
+
+    def _denoise_within_memory(
+        self,
+        actual_prompts:list[str],
+        generators:list,
+        width:int,
+        height:int,
+        **denoise_kwargs) -> tuple[list[Image], dict]:
+        """_denoise, with the memory policy picked for this batch.
+        When the device runs out of memory, the batch is generated again
+        with the next, more frugal, policy. That policy is then used
+        directly for the following batches of the same size."""
 
-        original_prompt = prompt
-        prompt = self.replace_special_tags(prompt, self.replacers)
+        batch_key = (len(actual_prompts), width, height)
+        policies = self.usable_memory_policies
+        policy_index = policies.index(self.memory_policy_for(*batch_key))
+        # The same seeds must give the same images on every attempt
+        generator_states = [generator.get_state() if generator != None else None for generator in generators]
+        while True:
+            policy = policies[policy_index]
+            try:
+                self.use_memory_policy(policy)
+                with self.precision.autocast(self.torch_device):
+                    return self._denoise(actual_prompts, list(generators), width = width, height = height, **denoise_kwargs)
+            except Exception as e:
+                if not is_out_of_memory(e) or policy_index + 1 >= len(policies):
+                    raise
+
+            # Outside of the except block, so that the failed attempt
+            # tensors are not referenced anymore
+            self._empty_device_cache()
+            policy_index += 1
+            self.memory_policy_floors[batch_key] = policies[policy_index]
+            self.logger.warning(
+                f"Out of memory while generating {len(actual_prompts)} {width}x{height} images with the {policy} memory policy. "
+                f"Trying again with {policies[policy_index]}")
+            for generator, state in zip(generators, generator_states):
+                if generator != None:
+                    generator.set_state(state)
 
-        report["actual_prompt"] = prompt if original_prompt != prompt else ""
+    def _denoise(
+        self,
+        actual_prompts:list[str],
+        generators:list,
+        n_inferences:int,
+        guidance_scale:float,
+        width:int,
+        height:int,
+        abort_check:Callable = None) -> tuple[list[Image], dict]:
+        """Returns the images, and the durations of the generation stages :
+        text_encoding, denoise_loop, denoise_step (average) and vae_decode.
+        Without the embeddings cache, the text encoding is done by the
+        pipeline and is part of denoise_loop."""
 
-        negative_prompt = "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry, artist name"
+        timings = {}
+        if all(generator == None for generator in generators):
+            generators = None
+        else:
+            # Generators must be provided for every image of the batch.
+            # Non-deterministic images get a randomly seeded one.
+            for index, generator in enumerate(generators):
+                if generator == None:
+                    generators[index] = torch.Generator(self.torch_device)
+                    generators[index].seed()
 
-        metadata = PngInfo()
-        metadata.add_itxt("AI_Prompt", str(prompt), lang="utf8", tkey="AI_Prompt")
-        metadata.add_text("AI_Torch_Seed", str(seed))
-        metadata.add_text("AI_StableDiffusion_Guidance_Scale", str(guidance_scale))
-        metadata.add_text("AI_StableDiffusion_Inferences", str(n_inferences))
-        metadata.add_text("AI_StableDiffusion_Model_Name", str(self.model_name))
-        #metadata.add_text("AI_Diffusers_Version", str(self.pipe._diffusers_version))
-        metadata.add_text("AI_Metadata_Type", "Voyage")
-        metadata.add_text("AI_Metadata_Voyage_Version", "0")
-        metadata.add_text("AI_Generator", str(self.model_name))
-        metadata.add_text("AI_Torch_Generator", str(self.torch_device))
-        metadata.add_text("AI_Custom_Deterministic", str(deterministic))
-        metadata.add_itxt("AI_Prompt_Negative", str(negative_prompt), lang="utf8", tkey="AI_Prompt_Negative")
-        metadata.add_text("AI_StableDiffusion_Pipe", str(self.pipe))
+        pipe_kwargs = {}
+        if self.embeddings_cache != None:
+            text_encoding_began_at = time.monotonic()
+            negative_embeddings = self.prompt_embeddings(NEGATIVE_PROMPT)
+            pipe_kwargs["prompt_embeds"] = torch.cat([self.prompt_embeddings(actual_prompt) for actual_prompt in actual_prompts])
+            pipe_kwargs["negative_prompt_embeds"] = negative_embeddings.repeat(len(actual_prompts), 1, 1)
+            timings["text_encoding"] = time.monotonic() - text_encoding_began_at
+        elif len(set(actual_prompts)) == 1:
+            pipe_kwargs["prompt"] = actual_prompts[0]
+            pipe_kwargs["negative_prompt"] = NEGATIVE_PROMPT
+            pipe_kwargs["num_images_per_prompt"] = len(actual_prompts)
+        else:
+            pipe_kwargs["prompt"] = actual_prompts
+            pipe_kwargs["negative_prompt"] = [NEGATIVE_PROMPT] * len(actual_prompts)
+
+        aborted = False
+        steps_done = 0
+        last_step_at = None
+        def on_step_end(pipe, step:int, timestep, callback_kwargs:dict) -> dict:
+            nonlocal aborted, steps_done, last_step_at
+            steps_done += 1
+            if steps_done == getattr(pipe, "_num_timesteps", n_inferences):
+                # Only once. Synchronizing after every step would slow down the generation.
+                self._synchronize()
+            last_step_at = time.monotonic()
+            if (abort_check != None) and (not aborted) and abort_check():
+                aborted = True
+                # The pipeline skips the remaining steps
+                pipe._interrupt = True
+            return callback_kwargs
+        pipe_kwargs["callback_on_step_end"] = on_step_end
 
         #with torch.autocast(self.torch_device):
+        pipe_began_at = time.monotonic()
         result = self.pipe(
-            prompt,
-            negative_prompt = negative_prompt,
+            **pipe_kwargs,
             width=width,
             height=height,
             guidance_scale=guidance_scale,
-            generator=generator,
+            generator=generators,
             num_inference_steps=n_inferences)
+        pipe_ended_at = time.monotonic()
 
-        nsfw_flag = False # result["nsfw_content_detected"][0]
-        report["seed"] = seed
-        report["nsfw"] = nsfw_flag
-        report["filepath"] = ""
-        report["content_as"] = "file" if self.save_to_disk else "data"
+        if aborted:
+            raise GenerationAborted(f"Generation of {len(actual_prompts)} images aborted")
 
-        if not nsfw_flag:
-            image:Image = result.images[0]
+        if last_step_at != None:
+            timings["denoise_loop"] = last_step_at - pipe_began_at
+            timings["denoise_step"] = timings["denoise_loop"] / steps_done
+            # VAE decoding, and conversion to PIL images
+            timings["vae_decode"] = pipe_ended_at - last_step_at
+        return result.images, timings
 
-            filename = f"{int(time.time())}_SEED_{seed}.png"
-            if self.output_folder:
-                filepath = self.output_folder / filename
-            else:
-                filepath = filename
-            report["filepath"] = filepath
-            
-            if self.save_to_disk:
-                image.save(filepath, pnginfo=metadata)
-            else:
-                image_data = io.BytesIO()
-                image.save(image_data, format='PNG', pnginfo=metadata)
-                image_data.seek(0)
-                report["image_data"] = image_data
+    def _encode_image(
+        self,
+        report:dict,
+        image:Image,
+        prompt:str,
+        guidance_scale:float,
+        n_inferences:int,
+        deterministic,
+        submitted_at:float) -> dict:
 
+        encode_began_at = time.monotonic()
+        metadata = self._image_metadata(
+            prompt         = prompt,
+            seed           = report["seed"],
+            guidance_scale = guidance_scale,
+            n_inferences   = n_inferences,
+            deterministic  = deterministic)
+
+        filepath = report["filepath"]
+        if self.save_to_disk:
+            try:
+                self.archive_encoder.encode(image, metadata, filepath)
+            except Exception:
+                self._release_image_filepath(filepath)
+                raise
+
+        if self.images_index != None:
+            try:
+                self.images_index.add(filepath, metadata)
+            except Exception as e:
+                # The image is saved anyway. It can be indexed later.
+                self.logger.warning(f"Could not index {filepath} : {e}")
+
+        if self.thumbnail_size:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            thumbnail_data = io.BytesIO()
+            thumbnail.save(thumbnail_data, format="PNG", compress_level=1)
+            thumbnail_data.seek(0)
+            report["thumbnail"] = thumbnail_data
+
+        if report["content_as"] == "data":
+            image_data = io.BytesIO()
+            (self.delivery_encoder or self.archive_encoder).encode(image, metadata, image_data)
+            image_data.seek(0)
+            report["image_data"] = image_data
+
+        report["timings"]["encoding_wait"] = encode_began_at - submitted_at
+        report["timings"]["encoding"] = time.monotonic() - encode_began_at
+        self.logger.debug(
+            f"Encoded {filepath} in {report['timings']['encoding']:.2f} seconds, "
+            f"after waiting {report['timings']['encoding_wait']:.2f} seconds")
         return report
 
     def load_replacers(
@@ -257,48 +1044,94 @@ class DeguDiffusionWorker():
         return replacers
  
 
-    def random_from_tag(self, replacer:SpecialTag) -> list[str]:
-        names = replacer.words
-        n_names = random.randint(
-            min(replacer.min, len(names)),
-            min(replacer.max, len(names)))
-        return random.sample(names, n_names)
-
-    def replace_special_tags(self, prompt, tags:list[SpecialTag]):
-
-        for tag_name in tags:
-            tag:SpecialTag = tags[tag_name]
-            if tag == None:
+    def compile_replacers(self, replacers:dict) -> SpecialTagsReplacer:
+        for tag_name in replacers:
+            if replacers[tag_name] == None:
                 self.logger.debug("Tag %s has no value ???" % (tag_name))
-                continue
-
-            if tag_name not in prompt:
-                continue
+        return SpecialTagsReplacer(replacers, self.random_from_tag)
 
-            occurences = 0
-            max_occurences = tag.max_occurences
-
-            while tag_name in prompt:
-                if occurences >= max_occurences:
-                    prompt = prompt.replace(tag_name, "")
-                    break
-                
-                names_list = self.random_from_tag(tag)
+    def random_from_tag(self, replacer:SpecialTag) -> list[str]:
+        return random_words_from_tag(replacer)
 
-                prompt = prompt.replace(tag_name, tag.join_word.join(names_list), 1)
-                occurences += 1
-        
-        return prompt
+    def replace_special_tags(self, prompt, tags:dict[str, SpecialTag] = None):
+        if tags == None or tags is self.replacers:
+            replacer = self.special_tags_replacer
+        else:
+            replacer = self.compile_replacers(tags)
+        return replacer.replace(prompt)
 
 
 if __name__ == "__main__":
 
 
+    import argparse
     import dotenv
+    from myylibs import benchmarksuite
     from myylibs.helpers import Helpers
     dotenv.load_dotenv()
 
+    # python sdworker.py                     Generates DEFAULT_IMAGES_PER_JOB images
+    # python sdworker.py benchmark [--real]  Benchmarks a tiny random model on CPU, or the configured model
+    # python sdworker.py compare before.json after.json
+    parser = argparse.ArgumentParser(description = "Standalone Stable Diffusion test and benchmarks")
+    subparsers = parser.add_subparsers(dest = "command")
+    benchmark_parser = subparsers.add_parser("benchmark", help = "Measure the generation speed")
+    benchmark_parser.add_argument("--real", action = "store_true", help = "Use the configured model and device, instead of a tiny random model on CPU")
+    benchmark_parser.add_argument("--images", type = int, default = 8, help = "Images generated by each generation benchmark")
+    benchmark_parser.add_argument("--batch-size", type = int, default = 4)
+    benchmark_parser.add_argument("--output", default = "", help = "JSON file receiving the results")
+    benchmark_parser.add_argument("--only", nargs = "+", default = None, help = "Benchmarks to run. All of them by default.")
+    benchmark_parser.add_argument("--precision", default = None, help = "fp32, fp16, bf16 or auto, instead of STABLEDIFFUSION_MODE")
+    benchmark_parser.add_argument("--acceleration", default = None, help = "none, channels-last or compile, instead of ACCELERATION")
+    benchmark_parser.add_argument("--memory-policy", default = None, help = "Memory policy used, instead of MEMORY_POLICY")
+    benchmark_parser.add_argument("--width", type = int, default = 64, help = "Width of the images generated by the tiny model")
+    benchmark_parser.add_argument("--height", type = int, default = 64, help = "Height of the images generated by the tiny model")
+    compare_parser = subparsers.add_parser("compare", help = "Compare two benchmark results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type = float, default = benchmarksuite.DEFAULT_REGRESSION_THRESHOLD, help = "Relative slowdown reported as a regression")
+    arguments = parser.parse_args()
+
+    if arguments.command == "compare":
+        regressions = benchmarksuite.compare_results(
+            benchmarksuite.load_results(arguments.baseline),
+            benchmarksuite.load_results(arguments.current),
+            arguments.threshold)
+        if regressions:
+            print(f"Regressions : {', '.join(regressions)}")
+        sys.exit(1 if regressions else 0)
+
     logger = logging.getLogger('StableDiffusion standalone test')
+    if arguments.command == "benchmark":
+        # Keep the logs about the benchmark itself
+        logging.getLogger().setLevel(logging.INFO)
+
+    if arguments.command == "benchmark" and not arguments.real:
+        with tempfile.TemporaryDirectory() as output_directory:
+            diffuser = DeguDiffusionWorker(
+                sd_token         = "",
+                output_folder    = output_directory,
+                model_name       = TINY_MODEL_NAME,
+                torch_device     = "cpu",
+                batch_size       = arguments.batch_size,
+                results_cache_mb = 0,
+                mode             = arguments.precision or "fp32",
+                memory_policy    = arguments.memory_policy or "full",
+                images_width     = arguments.width,
+                images_height    = arguments.height,
+                acceleration     = arguments.acceleration or "none",
+                compile_cache_dir = os.environ.get('COMPILE_CACHE_DIR', os.path.join('stablediffusion_cache', 'compiled')),
+                warmup_sizes     = [(arguments.width, arguments.height)])
+            results = benchmarksuite.BenchmarkSuite(
+                diffuser,
+                n_images   = arguments.images,
+                batch_size = arguments.batch_size,
+                width      = arguments.width,
+                height     = arguments.height).run(arguments.only)
+        if arguments.output:
+            benchmarksuite.save_results(results, arguments.output)
+            logger.info(f"Results saved to {arguments.output}")
+        sys.exit(0)
     # FIXME Factorize this with degu_diffusion into a specific python file.
     # Basically, make a configuration object...
     IMAGES_OUTPUT_DIRECTORY      = os.environ.get('IMAGES_OUTPUT_DIRECTORY', 'generated')
@@ -329,11 +1162,22 @@ if __name__ == "__main__":
         model_name    = STABLEDIFFUSION_MODEL_NAME,
         sd_token      = os.environ.get('HUGGINGFACES_TOKEN', ''),
         output_folder = IMAGES_OUTPUT_DIRECTORY,
-        mode          = os.environ.get('STABLEDIFFUSION_MODE', 'fp32'),
+        mode          = getattr(arguments, "precision", None) or os.environ.get('STABLEDIFFUSION_MODE', 'auto'),
         sd_cache_dir  = os.environ.get('STABLEDIFFUSION_CACHE_DIR', ''),
         local_only    = STABLEDIFFUSION_LOCAL_ONLY,
         torch_device  = TORCH_DEVICE,
-        additional_model = SAFETENSORS_ADDITIONAL_MODEL)
+        additional_model = SAFETENSORS_ADDITIONAL_MODEL,
+        converted_models_dir = os.environ.get('CONVERTED_MODELS_DIR', os.path.join(STABLEDIFFUSION_CACHE_DIR or 'stablediffusion_cache', 'converted')),
+        batch_size    = arguments.batch_size if arguments.command == "benchmark" else 1,
+        # Identical requests would be answered from the cache
+        results_cache_mb = 0 if arguments.command == "benchmark" else 128,
+        memory_policy    = getattr(arguments, "memory_policy", None) or os.environ.get('MEMORY_POLICY', 'full').lower(),
+        memory_budget_mb = Helpers.env_var_to_int('MEMORY_BUDGET_MB', 0),
+        images_width     = IMAGES_WIDTH,
+        images_height    = IMAGES_HEIGHT,
+        acceleration     = getattr(arguments, "acceleration", None) or os.environ.get('ACCELERATION', 'none').lower(),
+        compile_cache_dir = os.environ.get('COMPILE_CACHE_DIR', os.path.join(STABLEDIFFUSION_CACHE_DIR or 'stablediffusion_cache', 'compiled')),
+        warmup_sizes     = [(IMAGES_WIDTH, IMAGES_HEIGHT)])
     logger.info("Standalone Stable Diffusion test")
 
     DEFAULT_IMAGES_PER_JOB    = Helpers.env_var_to_int('DEFAULT_IMAGES_PER_JOB', 8)
@@ -344,6 +1188,19 @@ if __name__ == "__main__":
     DEFAULT_GUIDANCE_SCALE    = Helpers.env_var_to_float('DEFAULT_GUIDANCE_SCALE', 7.5)
     SEED_MINUS_ONE_IS_RANDOM  = True if os.environ.get('SEED_MINUS_ONE_IS_RANDOM', 'True').lower() != "false" else False
 
+    if arguments.command == "benchmark":
+        results = benchmarksuite.BenchmarkSuite(
+            diffuser,
+            n_images     = arguments.images,
+            batch_size   = arguments.batch_size,
+            n_inferences = DEFAULT_INFERENCES_STEPS,
+            width        = IMAGES_WIDTH,
+            height       = IMAGES_HEIGHT).run(arguments.only)
+        if arguments.output:
+            benchmarksuite.save_results(results, arguments.output)
+            logger.info(f"Results saved to {arguments.output}")
+        sys.exit(0)
+
     seed_value = None
     if DEFAULT_SEED:
         try:
@@ -353,6 +1210,7 @@ if __name__ == "__main__":
     if seed_value == -1 and SEED_MINUS_ONE_IS_RANDOM:
         seed_value = None
 
+    generation_began_at = time.monotonic()
     for _ in range(0, DEFAULT_IMAGES_PER_JOB):
         diffuser.generate_image(
             prompt         = DEFAULT_PROMPT,
@@ -361,4 +1219,8 @@ if __name__ == "__main__":
             deterministic  = seed_value if seed_value else True,
             width          = IMAGES_WIDTH,
             height         = IMAGES_HEIGHT)
+    generation_seconds = time.monotonic() - generation_began_at
+    logger.info(
+        f"Generated {DEFAULT_IMAGES_PER_JOB} images in {generation_seconds:.1f} seconds "
+        f"({DEFAULT_IMAGES_PER_JOB / generation_seconds:.2f} images/s)")
     logger.info(f"Test finished. Check the output in {IMAGES_OUTPUT_DIRECTORY}")
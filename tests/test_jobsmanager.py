@@ -0,0 +1,154 @@
+import threading
+import unittest
+
+from myylibs.jobsmanager import Job, JobQueue, RoundRobinPolicy, SchedulingPolicy, WeightedFairPolicy
+
+def no_worker(index:int):
+    # The tests move the jobs themselves
+    raise RuntimeError("No worker in these tests")
+
+class ExecuteMicroBatchTest(unittest.TestCase):
+
+    def test_job_kwargs_reach_the_worker_without_cross_job_batching(self):
+        job = Job(None, iterations = 2, kwargs = {
+            "prompt": "A degu",
+            "deterministic": 1234,
+            "width": 768,
+            "height": 640,
+            "n_inferences": 12,
+            "guidance_scale": 9.0,
+        })
+        calls = []
+        def batch_method(max_images, per_image = None, abort_check = None, **kwargs):
+            calls.append((max_images, per_image, kwargs))
+            return [{"image": index} for index in range(max_images)]
+
+        done = JobQueue._execute_micro_batch(
+            [job, job], [job], threading.Condition(), batch_method, compatible_kwargs = None)
+
+        self.assertEqual(done, 2)
+        max_images, per_image, kwargs = calls[0]
+        self.assertEqual(max_images, 2)
+        self.assertEqual(kwargs, {"width": 768, "height": 640, "n_inferences": 12, "guidance_scale": 9.0})
+        self.assertEqual(per_image, [{"prompt": "A degu", "deterministic": 1234}] * 2)
+
+class CancelJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue(no_worker, lambda worker: None)
+        self.addCleanup(self.queue._bailing_out)
+        self.statuses:dict[Job, list[str]] = {}
+        for status in self.queue.report_handlers:
+            self.queue.report_handlers[status] = lambda job, report: self.statuses.setdefault(job, []).append(report.status)
+
+    def add_job(self, user_id:int = 1) -> Job:
+        job = Job(None, iterations = 4, user_id = user_id)
+        self.queue.add_job(job)
+        return job
+
+    def start_jobs(self):
+        # What main_task does, before the workers pick them
+        self.queue._start_next_jobs_if_possible()
+
+    def test_queued_job(self):
+        job = self.add_job()
+
+        self.assertTrue(self.queue.cancel_job(job.job_id))
+        self.assertEqual(self.statuses[job], ["Canceled"])
+        self.assertIsNone(self.queue.get_job(job.job_id))
+        self.assertEqual(self.queue.to_do, [])
+
+    def test_running_job(self):
+        job = self.add_job()
+        self.start_jobs()
+
+        self.assertTrue(self.queue.cancel_job(job.job_id))
+        self.assertTrue(job.finished)
+        self.assertEqual(job.log[-1].status, "Canceled")
+        self.assertNotIn(job, self.queue.in_progress)
+
+    def test_finished_job(self):
+        job = self.add_job()
+        self.start_jobs()
+        with self.queue.jobs_available:
+            JobQueue._finish_job(job, self.queue.in_progress, "Finished", None)
+
+        self.assertFalse(self.queue.cancel_job(job.job_id))
+        self.assertEqual(job.log[-1].status, "Finished")
+
+    def test_unknown_job(self):
+        self.assertFalse(self.queue.cancel_job(123456789))
+
+    def test_user_jobs(self):
+        running = self.add_job(user_id = 1)
+        finished = self.add_job(user_id = 1)
+        other_user = self.add_job(user_id = 2)
+        self.start_jobs()
+        queued = self.add_job(user_id = 1)
+        with self.queue.jobs_available:
+            JobQueue._finish_job(finished, self.queue.in_progress, "Finished", None)
+
+        self.assertEqual(self.queue.cancel_user_jobs(1), 2)
+        self.assertEqual(self.statuses[queued], ["Canceled"])
+        self.assertEqual(running.log[-1].status, "Canceled")
+        self.assertEqual(finished.log[-1].status, "Finished")
+        self.assertFalse(other_user.finished)
+
+def generation_job(name:str, user_id:int, n_images:int, n_inferences:int = 10, size:int = 512) -> Job:
+    # Named through external_reference, for readable failures
+    return Job(name, iterations = n_images, user_id = user_id, kwargs = {
+        "n_inferences": n_inferences, "width": size, "height": size})
+
+def dequeue_order(policy:SchedulingPolicy, jobs:list[Job]) -> list[str]:
+    """Names of the jobs getting each image, one image at a time,
+    like the workers"""
+    remaining = {job: job.iterations for job in jobs}
+    served = []
+    while remaining:
+        job = policy.order(list(remaining))[0]
+        policy.charge(job, 1)
+        served.append(job.external_reference)
+        remaining[job] -= 1
+        if remaining[job] == 0:
+            del remaining[job]
+            policy.forget(job)
+    return served
+
+class SchedulingPoliciesTest(unittest.TestCase):
+
+    def test_fifo_serves_whole_jobs_in_arrival_order(self):
+        jobs = [generation_job("A", 1, 2), generation_job("B", 2, 2)]
+        self.assertEqual(dequeue_order(SchedulingPolicy(), jobs), ["A", "A", "B", "B"])
+
+    def test_round_robin_alternates_between_jobs(self):
+        jobs = [generation_job("A", 1, 4), generation_job("B", 1, 1), generation_job("C", 2, 2)]
+        self.assertEqual(dequeue_order(RoundRobinPolicy(), jobs), ["A", "B", "C", "A", "C", "A", "A"])
+
+    def test_fair_alternates_between_users_not_jobs(self):
+        # User 1 submitted A and B, user 2 only C
+        jobs = [generation_job("A", 1, 2), generation_job("B", 1, 2), generation_job("C", 2, 4)]
+        self.assertEqual(dequeue_order(WeightedFairPolicy(), jobs), ["A", "C", "A", "C", "B", "C", "B", "C"])
+
+    def test_fair_follows_the_users_weights(self):
+        jobs = [generation_job("Heavy", 1, 6), generation_job("Light", 2, 3)]
+        served = dequeue_order(WeightedFairPolicy({1: 2}), jobs)
+        self.assertEqual(served[:6], ["Heavy", "Light", "Heavy", "Heavy", "Light", "Heavy"])
+
+    def test_fair_charges_the_job_costs(self):
+        # The images of user 1 take 4 times more steps
+        jobs = [generation_job("Expensive", 1, 2, n_inferences = 40), generation_job("Cheap", 2, 8, n_inferences = 10)]
+        served = dequeue_order(WeightedFairPolicy(), jobs)
+        self.assertEqual(served[:6], ["Expensive", "Cheap", "Cheap", "Cheap", "Cheap", "Expensive"])
+
+    def test_fair_returning_users_cant_claim_their_absence(self):
+        policy = WeightedFairPolicy()
+        busy = generation_job("Busy", 1, 10)
+        for _ in range(6):
+            policy.charge(busy, 1)
+        # The newcomer starts at the current virtual time, not at 0.
+        # It doesn't get 6 images in a row, to catch up.
+        served = dequeue_order(policy, [busy, generation_job("Newcomer", 2, 3)])
+        self.assertEqual(served[:6], ["Newcomer", "Busy", "Newcomer", "Busy", "Newcomer", "Busy"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+from concurrent.futures import Future
+import os
+import tempfile
+import unittest
+
+from myylibs.processworker import ProcessWorker
+from myylibs.stubworker import StubWorker
+from myylibs.tinypipeline import TINY_MODEL_NAME
+from sdworker import DeguDiffusionWorker
+
+class ProcessWorkerTest(unittest.TestCase):
+
+    def start_worker(self, worker_class, worker_kwargs:dict) -> ProcessWorker:
+        worker = ProcessWorker(worker_class, worker_kwargs)
+        self.addCleanup(worker.close)
+        return worker
+
+    def test_images_buffers_are_copied_back(self):
+        worker = self.start_worker(StubWorker, {"step_seconds": 0.001})
+        results = worker.generate_batch(2, n_inferences = 2, width = 64, height = 64)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertTrue(result["image_data"].getvalue().startswith(b"\x89PNG"))
+        self.assertEqual(worker.cache_stats(), {})
+
+    def test_encoded_images_are_resolved_in_the_bot_process(self):
+        output_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(output_directory.cleanup)
+        worker = self.start_worker(DeguDiffusionWorker, {
+            "sd_token":         "",
+            "output_folder":    output_directory.name,
+            "model_name":       TINY_MODEL_NAME,
+            "torch_device":     "cpu",
+            "mode":             "fp32",
+            "results_cache_mb": 0,
+            "batch_size":       2,
+            "encoding_threads": 1})
+
+        # Returned before being encoded, and resolved later
+        results = worker.generate_batch(2, prompt = "Degu", n_inferences = 2, width = 64, height = 64)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, Future)
+            report = result.result(timeout = 60)
+            self.assertTrue(os.path.getsize(report["filepath"]) > 0)
+
+        # The worker keeps answering the following calls
+        report = worker.generate_image(prompt = "Degu", n_inferences = 2, width = 64, height = 64)
+        self.assertTrue(report["filepath"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import asyncio
+import io
+import unittest
+
+from myylibs.uploadqueue import UploadQueue, default_retry_delay
+
+class HTTPError(Exception):
+    def __init__(self, status:int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+def no_wait(exception:Exception, attempt:int) -> float:
+    return default_retry_delay(exception, attempt, base_delay = 0)
+
+def attachment(name:str) -> tuple:
+    return (io.BytesIO(b"image"), name)
+
+class FakeSend:
+    """Records the messages sent. errors are raised by the first sends."""
+
+    def __init__(self, errors:list[Exception] = None, duration:float = 0):
+        self.sent:list[tuple] = []
+        self.attempts:int = 0
+        self.errors:list[Exception] = list(errors or [])
+        self.duration:float = duration
+        self.concurrent:int = 0
+        self.max_concurrent:int = 0
+
+    async def __call__(self, destination, content, attachments, ephemeral):
+        self.attempts += 1
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            await asyncio.sleep(self.duration)
+            if self.errors:
+                raise self.errors.pop(0)
+            self.sent.append((destination, content, [filename for _, filename in attachments]))
+        finally:
+            self.concurrent -= 1
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+class UploadQueueTest(unittest.TestCase):
+
+    def test_messages_to_a_destination_keep_their_order(self):
+        send = FakeSend(duration = 0.001)
+        async def scenario():
+            queue = UploadQueue(send, max_concurrency = 4)
+            for index in range(5):
+                queue.enqueue("thread A", f"A{index}")
+                queue.enqueue("thread B", f"B{index}")
+            await queue.join()
+        run(scenario())
+
+        for destination in ("thread A", "thread B"):
+            contents = [content for sent_to, content, _ in send.sent if sent_to == destination]
+            self.assertEqual(contents, [f"{destination[-1]}{index}" for index in range(5)])
+
+    def test_consecutive_attachments_are_coalesced(self):
+        send = FakeSend()
+        async def scenario():
+            queue = UploadQueue(send, max_attachments = 3, coalesce_delay = 0.01)
+            for index in range(4):
+                queue.enqueue("thread", f"Seed {index}", [attachment(f"{index}.png")])
+            queue.enqueue("thread", "Job finished !")
+            await queue.join()
+        run(scenario())
+
+        self.assertEqual(send.sent, [
+            ("thread", "Seed 0\nSeed 1\nSeed 2", ["0.png", "1.png", "2.png"]),
+            ("thread", "Seed 3", ["3.png"]),
+            ("thread", "Job finished !", []),
+        ])
+
+    def test_rate_limits_and_server_errors_are_retried(self):
+        send = FakeSend(errors = [HTTPError(429), HTTPError(503)])
+        async def scenario():
+            queue = UploadQueue(send, max_attempts = 4, retry_delay = no_wait)
+            queue.enqueue("thread", "Hello")
+            await queue.join()
+            return queue.stats()
+        stats = run(scenario())
+
+        self.assertEqual(send.attempts, 3)
+        self.assertEqual(send.sent, [("thread", "Hello", [])])
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["rate_limited"], 1)
+        self.assertEqual(stats["failures"], 0)
+
+    def test_other_client_errors_are_not_retried(self):
+        send = FakeSend(errors = [HTTPError(403)])
+        async def scenario():
+            queue = UploadQueue(send, max_attempts = 4, retry_delay = no_wait)
+            queue.enqueue("thread", "Hello")
+            queue.enqueue("thread", "Still there ?")
+            await queue.join()
+            return queue.stats()
+        stats = run(scenario())
+
+        self.assertEqual(send.attempts, 2)
+        self.assertEqual(send.sent, [("thread", "Still there ?", [])])
+        self.assertEqual(stats["retries"], 0)
+        self.assertEqual(stats["failures"], 1)
+
+    def test_missing_attachments_are_not_retried(self):
+        self.assertIsNone(default_retry_delay(FileNotFoundError("gone.png"), 0))
+        self.assertIsNone(default_retry_delay(PermissionError("locked.png"), 0))
+        self.assertIsNotNone(default_retry_delay(ConnectionResetError(), 0))
+
+    def test_concurrent_sends_are_limited(self):
+        send = FakeSend(duration = 0.01)
+        async def scenario():
+            queue = UploadQueue(send, max_concurrency = 2)
+            for index in range(6):
+                queue.enqueue(f"thread {index}", "Hello")
+            await queue.join()
+        run(scenario())
+
+        self.assertEqual(len(send.sent), 6)
+        self.assertEqual(send.max_concurrent, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import asyncio
+from concurrent.futures import Future
+import tempfile
+import threading
+import unittest
+
+from myylibs.jobsmanager import Job, JobQueue
+from myylibs.tinypipeline import TINY_MODEL_NAME
+from sdworker import DeguDiffusionWorker
+
+N_WORKERS = 2
+
+class TinyPipelinesPoolTest(unittest.TestCase):
+    """Several workers, each with its own tiny random pipeline, on CPU"""
+
+    def setUp(self):
+        self.output_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output_directory.cleanup)
+
+    def create_worker(self, index:int) -> DeguDiffusionWorker:
+        return DeguDiffusionWorker(
+            sd_token         = "",
+            output_folder    = self.output_directory.name,
+            model_name       = TINY_MODEL_NAME,
+            torch_device     = "cpu",
+            mode             = "fp32",
+            results_cache_mb = 0,
+            encoding_threads = 1)
+
+    def test_jobs_are_spread_over_the_workers(self):
+        # Every result returned by the workers, Futures included
+        results:list = []
+        results_lock = threading.Lock()
+        def batch_method(worker:DeguDiffusionWorker):
+            def generate_batch(*args, **kwargs):
+                batch_results = worker.generate_batch(*args, **kwargs)
+                with results_lock:
+                    results.extend(batch_results)
+                return batch_results
+            return generate_batch
+
+        queue = JobQueue(
+            self.create_worker,
+            lambda worker: worker.generate_image,
+            batch_method,
+            ("width", "height", "n_inferences", "guidance_scale"),
+            max_batch_images = 1,
+            n_workers = N_WORKERS)
+        statuses:dict[Job, list[str]] = {}
+        for status in queue.report_handlers:
+            queue.report_handlers[status] = lambda job, report: statuses.setdefault(job, []).append(report.status)
+
+        jobs = [
+            Job(None, iterations = 2, kwargs = {
+                "prompt": f"Degu {index}",
+                "n_inferences": 2,
+                "guidance_scale": 7.5,
+                "deterministic": True,
+                "width": 64,
+                "height": 64})
+            for index in range(4)]
+
+        async def run_jobs():
+            main_task = asyncio.ensure_future(queue.main_task())
+            while any(worker_status.state == "Starting" for worker_status in queue.workers_status):
+                await asyncio.sleep(0.05)
+            queue.add_jobs(jobs)
+            try:
+                for _ in range(1200):
+                    if not queue.jobs_by_id:
+                        break
+                    await asyncio.sleep(0.05)
+            finally:
+                queue._bailing_out()
+                main_task.cancel()
+
+        asyncio.run(run_jobs())
+
+        self.assertNotIn("Failed", [worker_status.state for worker_status in queue.workers_status])
+        for job in jobs:
+            self.assertEqual(statuses[job].count("Progress"), 2)
+            self.assertEqual(statuses[job][-1], "Finished")
+        # Both workers generated images
+        for worker_status in queue.workers_status:
+            self.assertGreater(worker_status.images_done, 0)
+        self.assertEqual(sum(worker_status.images_done for worker_status in queue.workers_status), 8)
+
+        self.assertEqual(len(results), 8)
+        for result in results:
+            if isinstance(result, Future):
+                result = result.result(timeout = 30)
+            self.assertTrue(result["filepath"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,7 +11,7 @@ set VENV_PYTHON="venv\Scripts\python.exe"
 %VENV_PYTHON% -m pip install -r requirements.txt
 if NOT %ERRORLEVEL% == 0 goto :dependencies_install_failed
 
-%VENV_PYTHON% %1
+%VENV_PYTHON% %*
 pause
 exit 0
 
@@ -45,4 +45,4 @@ select_python_venv () {
 python -m venv venv || venv_preparation_failed
 select_python_venv venv
 "${VENV_PYTHON}" -m pip install -r requirements.txt || pip_requirements_failed
-"${VENV_PYTHON}" "${SCRIPT_TO_EXECUTE}"
+"${VENV_PYTHON}" "${SCRIPT_TO_EXECUTE}" "${@:2}"